@@ -0,0 +1,210 @@
+import collections
+import concurrent.futures
+import gzip
+import lzma
+import os
+import sys
+import tarfile
+import time
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+
+import copy
+import instrumentation
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is only available with the zstandard package installed.
+    zstandard = None
+
+# Every block of the archive is compressed on its own so blocks can be compressed in parallel. The output is a series
+# of complete gzip members, xz streams or zstd frames, which their decompressors read back as a single stream.
+compression_block_size = 4 * 1024 * 1024
+default_levels = {"gzip": 6, "xz": 6, "zstd": 3}
+default_workers = os.cpu_count() or 1
+archive_suffixes = {None: ".tar", "gzip": ".tar.gz", "xz": ".tar.xz", "zstd": ".tar.zst"}
+read_size = 1024 * 1024
+archive_strategy = "archive"
+
+
+def compressions() -> List[str]:
+    """
+    Retrieves the compressions available on this system.
+
+    :return: The compression names write_archive accepts.
+    """
+    return ["gzip", "xz"] + (["zstd"] if zstandard is not None else [])
+
+
+@instrumentation.measured("archive", copy.count_copied)
+def write_archive(file_name: Union[Tuple[str, str], List[Tuple[str, str]]], output_path: str,
+                  compression: str = None, level: int = None,
+                  workers: int = default_workers) -> List[copy.CopyResult]:
+    """
+    Streams file(s) into a single tar archive laid out like copy_files lays out a destination, <section>/<file name>,
+    without staging a copy of the files anywhere.
+
+    :param file_name: The file(s) in (section name, absolute path) tuple pair to be archived.
+    :param output_path: The archive's path, or "-" to write the archive to the standard output.
+    :param compression: One of compressions(), None for an uncompressed archive.
+    :param level: The compression level, None for the compression's default.
+    :param workers: The number of blocks compressed at the same time.
+    :return: A CopyResult for every file, in the same order as the file(s) were given, the destination is the file's
+             name in the archive. Raises a ValueError if the compression is unavailable or the archive would be
+             written to a terminal.
+    """
+    if not isinstance(file_name, List):
+        file_name = [file_name]
+    if compression is not None and compression not in compressions():
+        raise ValueError("The compression [%s] is not available!" % compression)
+    if output_path == "-" and sys.stdout.isatty():
+        raise ValueError("Refusing to write an archive to a terminal!")
+    compress = None
+    if compression is not None:
+        compress = _compressor(compression, default_levels[compression] if level is None else level)
+
+    # Imported here so commands that never archive start faster.
+    import tqdm
+
+    results = []
+    total_bar = tqdm.tqdm(desc="Archiving", total=0, unit="B", unit_scale=True)
+    temp_path = None
+    if output_path == "-":
+        output = sys.stdout.buffer
+    else:
+        temp_path = output_path + copy.partial_suffix
+        output = open(temp_path, "wb")
+    try:
+        writer = _BlockWriter(output, compress, workers)
+        try:
+            sections = set()
+            for section, source in file_name:
+                if section not in sections:
+                    sections.add(section)
+                    writer.write(_header(section, tarfile.DIRTYPE, 0, 0o755, time.time()))
+                start = time.perf_counter()
+                results.append(_add_file(writer, section, source, total_bar))
+                instrumentation.record_latency("archive", time.perf_counter() - start)
+            # The end of an archive is two zero blocks, padded to a whole record like tarfile does.
+            writer.write(bytes(2 * tarfile.BLOCKSIZE))
+            writer.write(bytes(-writer.written % tarfile.RECORDSIZE))
+            writer.close()
+        finally:
+            writer.abort()
+        output.flush()
+    except BaseException:
+        if temp_path is not None:
+            output.close()
+            os.remove(temp_path)
+        raise
+    finally:
+        total_bar.close()
+    if temp_path is not None:
+        output.close()
+        os.replace(temp_path, output_path)
+    return results
+
+
+def _add_file(writer: "_BlockWriter", section: str, source: str, bar) -> copy.CopyResult:
+    name = section + "/" + os.path.split(source)[1]
+    try:
+        file_in = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    except os.error as e:
+        return copy.CopyResult(section, source, name, 0, None, str(e))
+    try:
+        stat = os.fstat(file_in)
+        bar.total += stat.st_size
+        bar.refresh()
+        writer.write(_header(name, tarfile.REGTYPE, stat.st_size, stat.st_mode & 0o7777, stat.st_mtime))
+        # The header is already out, so the member must get exactly the size it announced whatever happens to the
+        # file while it is read.
+        remaining = stat.st_size
+        error = None
+        try:
+            while remaining:
+                data = os.read(file_in, min(read_size, remaining))
+                if not data:
+                    error = "The file shrank while it was archived, its end was replaced with zeros."
+                    break
+                writer.write(data)
+                remaining -= len(data)
+                bar.update(len(data))
+        except os.error as e:
+            error = str(e)
+        writer.write(bytes(remaining))
+        bar.update(remaining)
+        writer.write(bytes(-stat.st_size % tarfile.BLOCKSIZE))
+    finally:
+        os.close(file_in)
+    if error:
+        return copy.CopyResult(section, source, name, stat.st_size, None, error)
+    return copy.CopyResult(section, source, name, stat.st_size,
+                           copy.CopyStats(archive_strategy, transferred=stat.st_size), None)
+
+
+def _header(name: str, member_type: bytes, size: int, mode: int, mtime: float) -> bytes:
+    # tarfile.TarFile.addfile() relies on the standard copy module, which copy.py shadows, so the headers are built
+    # directly. The pax format has no limit on file sizes.
+    info = tarfile.TarInfo(name)
+    info.type = member_type
+    info.size = size
+    info.mode = mode
+    info.mtime = mtime
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _compressor(compression: str, level: int) -> Callable[[bytes], bytes]:
+    # Each of these release the GIL while compressing.
+    if compression == "gzip":
+        return lambda block: gzip.compress(block, level, mtime=0)
+    elif compression == "xz":
+        return lambda block: lzma.compress(block, preset=level)
+    # A ZstdCompressor cannot be shared between threads.
+    return lambda block: zstandard.ZstdCompressor(level=level).compress(block)
+
+
+class _BlockWriter:
+    """
+    Writes the archive to its output, cutting it into blocks compressed by a pool of threads when it is compressed.
+    """
+
+    def __init__(self, output: BinaryIO, compress: Optional[Callable[[bytes], bytes]], workers: int):
+        self._output = output
+        self._compress = compress
+        self._workers = max(1, workers)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) if compress else None
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        # The number of bytes of the uncompressed archive written so far.
+        self.written = 0
+
+    def write(self, data: bytes):
+        self.written += len(data)
+        if self._compress is None:
+            self._output.write(data)
+            return
+        self._buffer += data
+        while len(self._buffer) >= compression_block_size:
+            self._submit(bytes(self._buffer[:compression_block_size]))
+            del self._buffer[:compression_block_size]
+
+    def close(self):
+        if self._compress is None:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._output.write(self._pending.popleft().result())
+
+    def abort(self):
+        if self._executor is not None:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(self._compress, block))
+        # Keep every worker busy with a block ready behind it, but no more so memory stays bounded.
+        while len(self._pending) > 2 * self._workers:
+            self._output.write(self._pending.popleft().result())
@@ -0,0 +1,226 @@
+import argparse
+import collections
+import configparser
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, OrderedDict
+
+import build
+import config_cache
+import copy
+import initialization
+import test_env
+
+benchmark_build = "benchmark"
+default_repeat = 3
+# The repository shapes benchmarked by default, from a handful of builds to a repository the size of a release line.
+scales = collections.OrderedDict([
+    ("small", test_env.RepositorySpec(bases=3, depth=3, fan_out=4, files=200, mean_size=256 * 1024)),
+    ("medium", test_env.RepositorySpec(bases=3, depth=4, fan_out=5, files=2000, mean_size=64 * 1024)),
+    ("large", test_env.RepositorySpec(bases=3, depth=5, fan_out=5, files=20000, mean_size=16 * 1024))])
+default_scales = ["small", "medium"]
+# A phase is only a regression if it got slower by more than this share of its previous time...
+default_tolerance = 0.25
+# ...and by more than this many seconds, shorter differences are noise.
+comparison_floor = 0.05
+
+
+def run_benchmark(root: str, spec: test_env.RepositorySpec, repeat: int = default_repeat,
+                  workers: int = copy.default_workers) -> Dict:
+    """
+    Times the crawl, the file lookup and the copy of a build on a synthetic repository. Nothing clears the page cache
+    between runs, so every phase after the first run of a crawl reads warm metadata and file contents.
+
+    :param root: An empty directory the repository, the configuration and the copies are created in.
+    :param spec: The shape of the repository.
+    :param repeat: How many times every phase is timed.
+    :param workers: The number of directories listed and files copied at the same time.
+    :return: The repository's shape and size and, for every phase, the seconds of every run, the fastest and the
+             median.
+    """
+    repository = test_env.create_synthetic_repository(os.path.join(root, "repository"), spec)
+    project = os.path.join(root, "project")
+    file_list_path = os.path.join(project, initialization.file_list_config_name)
+    configuration = collections.OrderedDict([("base_directory", ", ".join(repository.bases))])
+    for category in spec.categories:
+        configuration["%s_directory" % category] = category
+    initialization.create_file_list_config(project, configuration=configuration)
+    config = configparser.ConfigParser()
+    config[initialization.CONFIGURATION_SECTION] = {initialization.file_list_config_name: file_list_path}
+    # The build asks for every file below a category directory.
+    config[benchmark_build] = collections.OrderedDict(
+        (category, ", ".join(names)) for category, names in repository.categories.items() if names)
+    config_path = os.path.join(project, initialization.base_config_name)
+    with open(config_path, "w") as config_file:
+        config.write(config_file)
+    config_cache.invalidate()
+
+    destination = os.path.join(root, "destination")
+    files = []
+
+    def crawl():
+        initialization.crawl_system(project, workers=workers)
+
+    def crawl_incremental():
+        initialization.crawl_system(project, workers=workers, incremental=True)
+
+    def build_paths():
+        nonlocal files
+        # Read the configuration and the catalog again like a new process would.
+        config_cache.invalidate()
+        _, files = build.build_paths(benchmark_build, config_path)
+
+    def remove_destination():
+        shutil.rmtree(destination, ignore_errors=True)
+
+    def copy_build():
+        copy.copy_files(files, destination, workers=workers)
+
+    def sync_build():
+        copy.copy_files(files, destination, workers=workers, sync=True)
+
+    phases = collections.OrderedDict()
+    phases["crawl"] = _time(crawl, repeat)
+    phases["crawl_incremental"] = _time(crawl_incremental, repeat)
+    phases["build_paths"] = _time(build_paths, repeat)
+    phases["copy"] = _time(copy_build, repeat, remove_destination)
+    # The last copy is left in place, every file is up to date.
+    phases["sync"] = _time(sync_build, repeat)
+    remove_destination()
+    return collections.OrderedDict([
+        ("spec", spec._asdict()),
+        ("repository", collections.OrderedDict([("directories", repository.directories),
+                                                ("files", repository.files),
+                                                ("build_files", len(files)),
+                                                ("size", repository.size),
+                                                ("data", repository.data)])),
+        ("phases", phases)])
+
+
+def run_benchmarks(root: str = None, names: List[str] = None, overrides: Dict = None, repeat: int = default_repeat,
+                   workers: int = copy.default_workers, label: str = None, keep: bool = False) -> Dict:
+    """
+    Runs run_benchmark for several scales, each in a directory of its own.
+
+    :param root: The directory the scales are benchmarked in, None for a new temporary directory.
+    :param names: The names of the scales, defaults to default_scales.
+    :param overrides: RepositorySpec fields replaced in every scale's spec, e.g. {"sparse_ratio": 0.5}.
+    :param repeat: How many times every phase is timed.
+    :param workers: The number of directories listed and files copied at the same time.
+    :param label: A name for the results, e.g. the release being benchmarked.
+    :param keep: True to keep the repositories and configurations, otherwise they are removed afterwards.
+    :return: The results of every scale with a description of the system they were measured on. Raises a KeyError
+             for an unknown scale.
+    """
+    if names is None:
+        names = default_scales
+    specs = collections.OrderedDict((name, scales[name]._replace(**(overrides or {}))) for name in names)
+    if root is None:
+        root = tempfile.mkdtemp(prefix="file-picker-benchmark-")
+    results = collections.OrderedDict([
+        ("label", label),
+        ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("cpus", os.cpu_count()),
+        ("workers", workers),
+        ("repeat", repeat),
+        ("scales", collections.OrderedDict())])
+    try:
+        for name, spec in specs.items():
+            scale_root = os.path.join(root, name)
+            shutil.rmtree(scale_root, ignore_errors=True)
+            os.makedirs(scale_root)
+            print("Benchmarking the %s repository..." % name, file=sys.stderr)
+            results["scales"][name] = run_benchmark(scale_root, spec, repeat, workers)
+    finally:
+        if not keep:
+            for name in specs:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return results
+
+
+def compare_results(previous: Dict, current: Dict, tolerance: float = default_tolerance) -> List[str]:
+    """
+    Finds the phases that got slower between two sets of results, only comparing scales and phases in both.
+
+    :param previous: Results returned by run_benchmarks, e.g. of the last release.
+    :param current: Results returned by run_benchmarks.
+    :param tolerance: The share a phase's median may grow by before it counts as a regression.
+    :return: A description of every regression, empty if there are none.
+    """
+    regressions = []
+    for name, scale in current["scales"].items():
+        previous_scale = previous.get("scales", {}).get(name)
+        if previous_scale is None:
+            continue
+        for phase, timing in scale["phases"].items():
+            previous_timing = previous_scale["phases"].get(phase)
+            if previous_timing is None:
+                continue
+            before, after = previous_timing["median"], timing["median"]
+            if after > before * (1 + tolerance) and after - before > comparison_floor:
+                regressions.append("%s %s: %.3fs -> %.3fs (+%.0f%%)" % (name, phase, before, after,
+                                                                       (after / before - 1) * 100 if before else 100))
+    return regressions
+
+
+def _time(phase: Callable[[], object], repeat: int, before: Callable[[], object] = None) -> OrderedDict[str, object]:
+    runs = []
+    for _ in range(max(1, repeat)):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        phase()
+        runs.append(time.perf_counter() - start)
+    return collections.OrderedDict([("runs", runs), ("min", min(runs)), ("median", statistics.median(runs))])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time crawling, looking up and copying builds on synthetic "
+                                                 "repositories and print the results as JSON.")
+    parser.add_argument("--scale", nargs="+", choices=list(scales), default=default_scales,
+                        help="The repository sizes to benchmark.")
+    parser.add_argument("--root", help="The directory to benchmark in, a temporary directory by default.")
+    parser.add_argument("--repeat", type=int, default=default_repeat, help="How many times every phase is timed.")
+    parser.add_argument("--jobs", type=int, default=copy.default_workers,
+                        help="The number of directories listed and files copied at a time.")
+    parser.add_argument("--label", help="A name for the results, e.g. the release being benchmarked.")
+    parser.add_argument("--output", help="Write the results to this file instead of the standard output.")
+    parser.add_argument("--compare", help="Results of a previous run, exit with 1 if a phase got slower.")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance,
+                        help="How much slower, as a share, a phase may get before it counts as a regression.")
+    parser.add_argument("--keep", action="store_true", help="Keep the repositories after benchmarking.")
+    spec_arguments = parser.add_argument_group("repository shape", "Replace these in the shape of every scale.")
+    spec_arguments.add_argument("--bases", type=int, help="The number of base directories.")
+    spec_arguments.add_argument("--depth", type=int, help="The number of directory levels below each base.")
+    spec_arguments.add_argument("--fan-out", type=int, help="The number of subdirectories of every directory.")
+    spec_arguments.add_argument("--files", type=int, help="The number of files.")
+    spec_arguments.add_argument("--size-distribution", choices=test_env.size_distributions,
+                                help="How file sizes are spread around the mean.")
+    spec_arguments.add_argument("--mean-size", type=int, help="The mean file size in bytes.")
+    spec_arguments.add_argument("--sparse-ratio", type=float, help="The share of sparse files.")
+    spec_arguments.add_argument("--duplicate-ratio", type=float, help="The share of duplicated files.")
+    spec_arguments.add_argument("--seed", type=int, help="The seed of the repository layout.")
+    arguments = parser.parse_args()
+    spec_overrides = {x: getattr(arguments, x) for x in test_env.RepositorySpec._fields
+                      if getattr(arguments, x, None) is not None}
+    benchmark_results = run_benchmarks(arguments.root, arguments.scale, spec_overrides, arguments.repeat,
+                                       arguments.jobs, arguments.label, arguments.keep)
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
+    else:
+        print(json.dumps(benchmark_results, indent=2))
+    if arguments.compare:
+        with open(arguments.compare, "r") as compare_file:
+            found = compare_results(json.load(compare_file), benchmark_results, arguments.tolerance)
+        for regression in found:
+            print("Slower: %s" % regression, file=sys.stderr)
+        sys.exit(1 if found else 0)
@@ -3,7 +3,11 @@ import configparser
 import os
 from typing import List, Tuple, OrderedDict
 
+import build_store
+import catalog
+import config_cache
 import initialization
+import instrumentation
 
 
 def get_builds() -> List[str]:
@@ -13,8 +17,7 @@ def get_builds() -> List[str]:
     :return: Returns a list containing all available sections inside config.ini excluding the
              "CONFIGURATION" and "HOST_NAMES" section.
     """
-    config = configparser.ConfigParser()
-    config.read(initialization.get_config())
+    config = config_cache.read_config(initialization.get_config())
     sections = config.sections()
     sections.remove(initialization.CONFIGURATION_SECTION)
     sections.remove(initialization.HOST_NAMES_SECTION)
@@ -23,14 +26,23 @@ def get_builds() -> List[str]:
 
 def get_options(config_file: str, section: str) -> OrderedDict[str, str]:
     """
-    Retrieves all the options in a section of a configuration file.
+    Retrieves all the options in a section of a configuration file. File list configuration files are answered from
+    their artifact catalog when it is up to date.
 
     :param config_file: The full path to the configuration file to use.
     :param section: The section name to use.
     :return: An ordered {option: option value}, may raise a configparser.NoSectionError or EmptySectionError.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file)
+    with catalog.open_catalog(config_file) as connection:
+        if connection is not None:
+            if not catalog.has_category(connection, section):
+                raise configparser.NoSectionError(section)
+            option_dictionary = collections.OrderedDict(
+                (filename, ", ".join(paths)) for filename, paths in catalog.get_artifacts(connection, section).items())
+            if option_dictionary:
+                return option_dictionary
+            raise EmptySectionError
+    config = config_cache.read_config(config_file)
     try:
         options = config.options(section)
         option_dictionary = collections.OrderedDict()
@@ -44,33 +56,43 @@ def get_options(config_file: str, section: str) -> OrderedDict[str, str]:
         raise
 
 
-def build_paths(section: str) -> Tuple[OrderedDict[str, str], List[Tuple[str, str]]]:
+@instrumentation.measured("path_resolution", lambda x: (len(x[1]), 0))
+def build_paths(section: str, config_file: str = None) -> Tuple[OrderedDict[str, str], List[Tuple[str, str]]]:
     """
     Build all the file paths for section based on the section's options.
 
     :param section: The build name to use.
+    :param config_file: The full path to the configuration file holding the build, defaults to get_config().
     :return: An ordered {option: filename} of skipped files and a list containing tuples of section name
              and absolute paths pairings of all files described in the section's option.
     """
-    config = configparser.ConfigParser()
-    config.read(initialization.get_config())
-    subsection = config[section]
+    config = config_cache.read_config(config_file or initialization.get_config())
+    subsection = config.options(section)
     retrieved_files = []
     skipped_options = collections.OrderedDict()
-    file_list = configparser.ConfigParser()
-    file_list.read(config.get(initialization.CONFIGURATION_SECTION, initialization.file_list_config_name))
+    file_list_path = config.get(initialization.CONFIGURATION_SECTION, initialization.file_list_config_name)
+
+    # The files are in a csv format while the guide will be a whole directory containing multiple documents.
+    build_lists = collections.OrderedDict(
+        (entry, list(map(lambda i: i.strip(), config.get(section, entry).split(",")))) for entry in subsection)
 
     # Iterate through the entries and create a list that contains the absolute paths to all associated files.
-    for entry in subsection:
-        # The files are in a csv format while the guide will be a whole directory containing multiple documents.
-        build_list = list(map(lambda i: i.strip(), config.get(section, entry).split(",")))
-        for file in build_list:
-            if file_list.has_option(entry, file):
-                for i in file_list.get(entry, file).split(","):
-                    retrieved_files.append((entry, i.strip()))
-    available_files = list(map(lambda i: os.path.split(i[1])[1], retrieved_files))
-    for entry in subsection:
-        build_list = list(map(lambda i: i.strip(), config.get(section, entry).split(",")))
+    with catalog.open_catalog(file_list_path) as connection:
+        if connection is not None:
+            for entry, build_list in build_lists.items():
+                for file in build_list:
+                    # File names are case insensitive, the same as configparser options.
+                    for i in catalog.get_paths(connection, entry, file.lower()):
+                        retrieved_files.append((entry, i))
+        else:
+            file_list = config_cache.read_config(file_list_path)
+            for entry, build_list in build_lists.items():
+                for file in build_list:
+                    if file_list.has_option(entry, file):
+                        for i in file_list.get(entry, file).split(","):
+                            retrieved_files.append((entry, i.strip()))
+    available_files = set(map(lambda i: os.path.split(i[1])[1], retrieved_files))
+    for entry, build_list in build_lists.items():
         for file in build_list:
             if file not in available_files:
                 if entry in skipped_options.keys():
@@ -87,11 +109,9 @@ def add_new_build(section: str, options: OrderedDict[str, str]):
     :param section: The new build's name.
     :param options: The options for the new build.
     """
-    with open(os.path.join(initialization.get_config()), "a") as config_file:
-        config = configparser.ConfigParser()
-        config.add_section(section)
-        config[section] = options
-        config.write(config_file)
+    # Appended to the configuration file's journal, see build_store.
+    build_store.add_build(initialization.get_config(), section, options)
+    config_cache.invalidate(initialization.get_config())
 
 
 def remove_build(build: str):
@@ -100,12 +120,8 @@ def remove_build(build: str):
 
     :param build: The build to remove from the configuration file.
     """
-    config = configparser.ConfigParser()
-    config.read(initialization.get_config())
-    config.remove_section(build)
-    with open(initialization.get_config(), "w") as config_file:
-        config.write(config_file)
-        config_file.close()
+    build_store.remove_build(initialization.get_config(), build)
+    config_cache.invalidate(initialization.get_config())
 
 
 def edit_build(build: str, new_options: OrderedDict[str, str]):
@@ -114,16 +130,12 @@ def edit_build(build: str, new_options: OrderedDict[str, str]):
 
     :param build: The build to edit.
     :param new_options: The new options for the edited build, if the value is blank then it will reuse the
-                        old option's value.
+                        old option's value. Options the build does not have are ignored.
     """
-    config = configparser.ConfigParser()
-    config.read(initialization.get_config())
-    old_options = get_options(initialization.get_config(), build)
-    for k, v in old_options.items():
-        if k in new_options and new_options.get(k).strip():
-            config[build][k] = new_options.get(k)
-    with open(initialization.get_config(), "w") as f:
-        config.write(f)
+    if not config_cache.read_config(initialization.get_config()).has_section(build):
+        raise configparser.NoSectionError(build)
+    build_store.edit_build(initialization.get_config(), build, new_options)
+    config_cache.invalidate(initialization.get_config())
 
 
 def convert_to_filenames(config_file: str, entries: List[int], section: str) -> str:
@@ -135,9 +147,11 @@ def convert_to_filenames(config_file: str, entries: List[int], section: str) ->
     :param section: The section to use from the configuration file.
     :return: A comma delimited string containing filename(s) retrieved from the configuration file.
     """
-    config = configparser.ConfigParser()
-    config.read(config_file)
-    options = config.options(section)
+    with catalog.open_catalog(config_file) as connection:
+        if connection is not None and catalog.has_category(connection, section):
+            options = catalog.get_filenames(connection, section)
+        else:
+            options = config_cache.read_config(config_file).options(section)
     files = ""
     for entry in entries:
         files += options[entry - 1] + ", "
@@ -0,0 +1,236 @@
+import configparser
+import contextlib
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, TextIO
+
+try:
+    import fcntl
+except ImportError:
+    # Not running on a POSIX system, changes from parallel processes are not serialized.
+    fcntl = None
+
+journal_suffix = ".journal"
+lock_suffix = ".lock"
+# The journal is folded back into the configuration file once it grows past this many bytes.
+compact_journal_size = 256 * 1024
+
+# Serializes the threads of this process, the file lock only serializes processes.
+_lock = threading.RLock()
+_compacting = set()
+
+
+def get_journal(config_path: str) -> str:
+    """
+    Retrieves the path of the change journal of a configuration file.
+
+    :param config_path: The full path to the configuration file.
+    :return: The journal path.
+    """
+    return str(config_path) + journal_suffix
+
+
+def add_build(config_path: str, build: str, options: Dict[str, str]):
+    """
+    Adds a build, or replaces it if it already exists.
+
+    :param config_path: The full path to the configuration file.
+    :param build: The build's name.
+    :param options: The build's options. Raises a ValueError if the name or a value is not valid in a configuration
+                    file, e.g. a value has a lone "%".
+    """
+    if build == configparser.DEFAULTSECT:
+        raise ValueError("A build cannot be named %s!" % build)
+    # Check the options now so a bad value never makes it into the journal, where it would break every read.
+    configparser.ConfigParser().read_dict({build: options})
+    _append(config_path, {"op": "set", "build": build, "options": options})
+
+
+def edit_build(config_path: str, build: str, options: Dict[str, str]):
+    """
+    Changes options of a build. Only options the build already has are changed, and only to a value that is not blank.
+
+    :param config_path: The full path to the configuration file.
+    :param build: The build's name.
+    :param options: The new option values.
+    """
+    configparser.ConfigParser().read_dict({build: options})
+    _append(config_path, {"op": "edit", "build": build, "options": options})
+
+
+def remove_build(config_path: str, build: str):
+    """
+    Removes a build, nothing happens if it does not exist.
+
+    :param config_path: The full path to the configuration file.
+    :param build: The build's name.
+    """
+    _append(config_path, {"op": "remove", "build": build})
+
+
+def load(config_path: str) -> configparser.ConfigParser:
+    """
+    Parses a configuration file with its journal replayed over it.
+
+    :param config_path: The full path to the configuration file.
+    :return: The configuration, empty if the file does not exist like configparser does.
+    """
+    with _locked(config_path, exclusive=False):
+        return _load(config_path)
+
+
+def replace(config_path: str, config: configparser.ConfigParser):
+    """
+    Atomically replaces a configuration file and empties its journal.
+
+    :param config_path: The full path to the configuration file.
+    :param config: The new configuration.
+    """
+    with _locked(config_path, exclusive=True):
+        _write(config_path, config)
+
+
+def compact(config_path: str):
+    """
+    Folds the journal into the configuration file, nothing happens if the journal is empty. Reads never see a partly
+    compacted file, and a compaction that is interrupted is simply replayed on the next read.
+
+    :param config_path: The full path to the configuration file.
+    """
+    with _locked(config_path, exclusive=True):
+        try:
+            if os.path.getsize(get_journal(config_path)) == 0:
+                return
+        except OSError:
+            return
+        _write(config_path, _load(config_path))
+
+
+def export(config_path: str, output: TextIO) -> List[str]:
+    """
+    Writes the configuration, journal included, in configuration file format.
+
+    :param config_path: The full path to the configuration file.
+    :param output: Where to write the configuration to.
+    :return: The names of the sections written.
+    """
+    config = load(config_path)
+    config.write(output)
+    return config.sections()
+
+
+def _append(config_path: str, change: Dict):
+    line = (json.dumps(change) + "\n").encode("utf-8")
+    with _locked(config_path, exclusive=True):
+        journal = os.open(get_journal(config_path), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(journal).st_size
+            if size:
+                # Not pread, Windows does not have it. The write below appends whatever the position is.
+                os.lseek(journal, -1, os.SEEK_END)
+                if os.read(journal, 1) != b"\n":
+                    # Start after the torn line a crash left behind, instead of becoming part of it.
+                    line = b"\n" + line
+            # A single write, a crash leaves at most a torn last line which replaying skips.
+            os.write(journal, line)
+            os.fsync(journal)
+            size = os.fstat(journal).st_size
+        finally:
+            os.close(journal)
+    if size > compact_journal_size:
+        _compact_in_background(config_path)
+
+
+def _compact_in_background(config_path: str):
+    config_path = str(config_path)
+    with _lock:
+        if config_path in _compacting:
+            return
+        _compacting.add(config_path)
+
+    def run():
+        try:
+            compact(config_path)
+        except OSError:
+            # The next append tries again, until then the journal is replayed on every read.
+            pass
+        finally:
+            with _lock:
+                _compacting.discard(config_path)
+
+    # Not a daemon so a command that ends right after an edit still finishes the compaction it started.
+    threading.Thread(target=run, name="build-store-compaction").start()
+
+
+def _load(config_path: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    try:
+        with open(get_journal(config_path), "r", encoding="utf-8") as journal:
+            for line in journal:
+                change = _parse(line)
+                if change is not None:
+                    _apply(config, change)
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def _parse(line: str) -> Optional[Dict]:
+    try:
+        change = json.loads(line)
+    except ValueError:
+        # Torn by a crash while it was written.
+        return None
+    return change if isinstance(change, dict) and "op" in change and "build" in change else None
+
+
+def _apply(config: configparser.ConfigParser, change: Dict):
+    # Every change sets values rather than adjusting them, so replaying changes that were already compacted into the
+    # file is harmless.
+    build = change["build"]
+    if change["op"] == "set":
+        if config.has_section(build):
+            config.remove_section(build)
+        config.add_section(build)
+        for k, v in change["options"].items():
+            config.set(build, k, v)
+    elif change["op"] == "edit":
+        if config.has_section(build):
+            for k, v in change["options"].items():
+                if config.has_option(build, k) and v.strip():
+                    config.set(build, k, v)
+    elif change["op"] == "remove":
+        config.remove_section(build)
+
+
+def _write(config_path: str, config: configparser.ConfigParser):
+    temp_path = str(config_path) + ".tmp"
+    with open(temp_path, "w") as config_file:
+        config.write(config_file)
+        config_file.flush()
+        os.fsync(config_file.fileno())
+    os.replace(temp_path, config_path)
+    # Only emptied once the file holds every change, a crash in between replays them again.
+    with open(get_journal(config_path), "w"):
+        pass
+
+
+@contextlib.contextmanager
+def _locked(config_path: str, exclusive: bool) -> Iterator[None]:
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        directory = os.path.dirname(str(config_path))
+        if directory and not os.path.isdir(directory):
+            # Nothing to lock yet, the configuration file does not exist.
+            yield
+            return
+        lock_file = os.open(str(config_path) + lock_suffix, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(lock_file)
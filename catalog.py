@@ -0,0 +1,272 @@
+import collections
+import contextlib
+import os
+import sqlite3
+from typing import Dict, Iterator, List, Optional, OrderedDict, Tuple
+
+catalog_suffix = ".db"
+
+_schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE categories (category TEXT PRIMARY KEY, position INTEGER NOT NULL);
+CREATE TABLE artifacts (category TEXT NOT NULL,
+                        filename TEXT NOT NULL,
+                        position INTEGER NOT NULL,
+                        path_position INTEGER NOT NULL,
+                        path TEXT NOT NULL,
+                        PRIMARY KEY (category, filename, path_position));
+CREATE INDEX artifacts_by_position ON artifacts (category, position, path_position);
+CREATE TABLE digests (path TEXT NOT NULL,
+                      algorithm TEXT NOT NULL,
+                      size INTEGER NOT NULL,
+                      mtime INTEGER NOT NULL,
+                      digest TEXT NOT NULL,
+                      PRIMARY KEY (path, algorithm));
+"""
+
+
+def get_catalog(file_list_path: str) -> str:
+    """
+    Retrieves the path of the artifact catalog kept next to a file list configuration file.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :return: The artifact catalog path.
+    """
+    return os.path.splitext(file_list_path)[0] + catalog_suffix
+
+
+def write_catalog(file_list_path: str, artifacts: OrderedDict[str, OrderedDict[str, List[str]]]):
+    """
+    Atomically replaces the artifact catalog of a file list configuration file, the file list must already be
+    written since the catalog records which version of it the catalog matches.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :param artifacts: An ordered {category: {filename: [absolute paths]}}, in the same order as the file list.
+    """
+    catalog_path = get_catalog(file_list_path)
+    temp_path = catalog_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    with contextlib.closing(sqlite3.connect(temp_path)) as connection:
+        connection.executescript(_schema)
+        connection.execute("INSERT INTO meta VALUES ('source', ?)", (_signature(file_list_path),))
+        connection.executemany("INSERT INTO categories VALUES (?, ?)",
+                               ((category, position) for position, category in enumerate(artifacts)))
+        connection.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)", _rows(artifacts))
+        connection.commit()
+        _carry_over_digests(connection, catalog_path)
+    os.replace(temp_path, catalog_path)
+
+
+@contextlib.contextmanager
+def open_catalog(file_list_path: str) -> Iterator[Optional[sqlite3.Connection]]:
+    """
+    Opens the artifact catalog of a file list configuration file for reading.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :return: A context manager yielding a connection to the catalog, or None if there is no catalog or the file list
+             was changed after the catalog was written. Callers should fall back to the file list in that case.
+    """
+    catalog_path = get_catalog(file_list_path)
+    connection = None
+    try:
+        if os.path.exists(catalog_path):
+            connection = sqlite3.connect("file:%s?mode=ro" % catalog_path, uri=True)
+            row = connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            if row is None or row[0] != _signature(file_list_path):
+                connection.close()
+                connection = None
+    except (OSError, sqlite3.Error):
+        # An unreadable catalog is as good as no catalog.
+        if connection is not None:
+            connection.close()
+        connection = None
+    try:
+        yield connection
+    finally:
+        if connection is not None:
+            connection.close()
+
+
+def update_catalog(file_list_path: str, categories: List[str], removed: List[Tuple[str, str, str]],
+                   added: List[Tuple[str, str, str]], dropped: List[str] = None) -> bool:
+    """
+    Changes the files of an artifact catalog in place, e.g. for the few directories a watched repository changed. New
+    files are added after the files already in their category, and new paths after the paths already known for their
+    file name, the next full write puts everything back in crawl order.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :param categories: The categories that must exist, even without files.
+    :param removed: A (category, file name, absolute path) for every file that is gone, once for every time it was
+                    listed.
+    :param added: A (category, file name, absolute path) for every new file, in crawl order.
+    :param dropped: The categories that no longer exist, with whatever files they still have.
+    :return: True if the catalog was changed. False if there is no catalog, or it does not match the file list any
+             more, the catalog must be written from scratch then.
+    """
+    catalog_path = get_catalog(file_list_path)
+    try:
+        if not os.path.exists(catalog_path):
+            return False
+        with contextlib.closing(sqlite3.connect(catalog_path)) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            if row is None or row[0] != _signature(file_list_path):
+                return False
+            for category in dict.fromkeys(categories + [x[0] for x in added]):
+                connection.execute("INSERT OR IGNORE INTO categories SELECT ?, COALESCE(MAX(position) + 1, 0) "
+                                   "FROM categories", (category,))
+            shortened = set()
+            for category, filename, path in removed:
+                connection.execute("DELETE FROM artifacts WHERE rowid = (SELECT rowid FROM artifacts WHERE "
+                                   "category = ? AND filename = ? AND path = ? LIMIT 1)", (category, filename, path))
+                shortened.add((category, filename))
+            for category, filename in shortened:
+                # Close the gaps, the first path of a file name is the one with path_position 0.
+                rows = connection.execute("SELECT rowid FROM artifacts WHERE category = ? AND filename = ? "
+                                          "ORDER BY path_position", (category, filename)).fetchall()
+                connection.executemany("UPDATE artifacts SET path_position = ? WHERE rowid = ?",
+                                       ((path_position, x[0]) for path_position, x in enumerate(rows)))
+            for category, filename, path in added:
+                row = connection.execute("SELECT position, MAX(path_position) + 1 FROM artifacts "
+                                         "WHERE category = ? AND filename = ?", (category, filename)).fetchone()
+                if row[0] is None:
+                    row = connection.execute("SELECT COALESCE(MAX(position) + 1, 0), 0 FROM artifacts "
+                                             "WHERE category = ?", (category,)).fetchone()
+                connection.execute("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                                   (category, filename, row[0], row[1], path))
+            for category in dropped or []:
+                connection.execute("DELETE FROM artifacts WHERE category = ?", (category,))
+                connection.execute("DELETE FROM categories WHERE category = ?", (category,))
+            connection.commit()
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def has_category(connection: sqlite3.Connection, category: str) -> bool:
+    """
+    Checks if a category (file list section) exists in the catalog.
+
+    :param connection: An open catalog.
+    :param category: The category to look for.
+    :return: True if the category exists, even if it holds no files, otherwise False.
+    """
+    return connection.execute("SELECT 1 FROM categories WHERE category = ?", (category,)).fetchone() is not None
+
+
+def get_filenames(connection: sqlite3.Connection, category: str) -> List[str]:
+    """
+    Retrieves the file names of a category in file list order.
+
+    :param connection: An open catalog.
+    :param category: The category to use.
+    :return: The file names, empty if the category does not exist.
+    """
+    rows = connection.execute("SELECT filename FROM artifacts WHERE category = ? AND path_position = 0 "
+                              "ORDER BY position", (category,))
+    return [row[0] for row in rows]
+
+
+def get_artifacts(connection: sqlite3.Connection, category: str) -> OrderedDict[str, List[str]]:
+    """
+    Retrieves all files of a category in file list order.
+
+    :param connection: An open catalog.
+    :param category: The category to use.
+    :return: An ordered {filename: [absolute paths]}, empty if the category does not exist.
+    """
+    artifacts = collections.OrderedDict()
+    rows = connection.execute("SELECT filename, path FROM artifacts WHERE category = ? "
+                              "ORDER BY position, path_position", (category,))
+    for filename, path in rows:
+        artifacts.setdefault(filename, []).append(path)
+    return artifacts
+
+
+def get_paths(connection: sqlite3.Connection, category: str, filename: str) -> List[str]:
+    """
+    Retrieves every location of a file in a category.
+
+    :param connection: An open catalog.
+    :param category: The category to use.
+    :param filename: The file name, as written in the file list.
+    :return: The absolute paths of the file, empty if the file is unknown.
+    """
+    rows = connection.execute("SELECT path FROM artifacts WHERE category = ? AND filename = ? "
+                              "ORDER BY path_position", (category, filename))
+    return [row[0] for row in rows]
+
+
+def load_digests(file_list_path: str, files: List[Tuple[str, int, int]], algorithm: str) -> Dict[str, str]:
+    """
+    Looks up previously computed content digests, whether or not the rest of the catalog is up to date.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :param files: An (absolute path, size, modification time in ns) for every file to look up.
+    :param algorithm: The hashlib algorithm of the digests.
+    :return: A {absolute path: hexadecimal digest} of every file whose size and modification time still match.
+    """
+    digests = {}
+    catalog_path = get_catalog(file_list_path)
+    if not os.path.exists(catalog_path):
+        return digests
+    try:
+        with contextlib.closing(sqlite3.connect("file:%s?mode=ro" % catalog_path, uri=True)) as connection:
+            for path, size, mtime in files:
+                row = connection.execute("SELECT digest FROM digests WHERE path = ? AND algorithm = ? AND size = ? "
+                                         "AND mtime = ?", (path, algorithm, size, mtime)).fetchone()
+                if row is not None:
+                    digests[path] = row[0]
+    except sqlite3.Error:
+        # A catalog written before digests were kept, or an unreadable one.
+        pass
+    return digests
+
+
+def save_digests(file_list_path: str, digests: List[Tuple[str, int, int, str]], algorithm: str):
+    """
+    Keeps content digests in the catalog for later lookups, nothing is saved if there is no catalog.
+
+    :param file_list_path: The full path to the file list configuration file.
+    :param digests: An (absolute path, size, modification time in ns, hexadecimal digest) for every file.
+    :param algorithm: The hashlib algorithm of the digests.
+    """
+    catalog_path = get_catalog(file_list_path)
+    if not os.path.exists(catalog_path):
+        return
+    try:
+        with contextlib.closing(sqlite3.connect(catalog_path)) as connection:
+            connection.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                                   ((path, algorithm, size, mtime, digest) for path, size, mtime, digest in digests))
+            connection.commit()
+    except sqlite3.Error:
+        # The digests are only a cache.
+        pass
+
+
+def _carry_over_digests(connection: sqlite3.Connection, catalog_path: str):
+    # Digests of files that are still part of the file list survive a new crawl, they are keyed on size and
+    # modification time anyway.
+    if not os.path.exists(catalog_path):
+        return
+    try:
+        connection.execute("ATTACH DATABASE ? AS previous", (catalog_path,))
+        connection.execute("INSERT OR IGNORE INTO digests SELECT * FROM previous.digests "
+                           "WHERE path IN (SELECT path FROM artifacts)")
+        connection.commit()
+        connection.execute("DETACH DATABASE previous")
+    except sqlite3.Error:
+        # The previous catalog was written before digests were kept.
+        pass
+
+
+def _rows(artifacts: OrderedDict[str, OrderedDict[str, List[str]]]) -> Iterator[tuple]:
+    for category, files in artifacts.items():
+        for position, (filename, paths) in enumerate(files.items()):
+            for path_position, path in enumerate(paths):
+                yield category, filename, position, path_position, path
+
+
+def _signature(file_list_path: str) -> str:
+    stat = os.stat(file_list_path)
+    return "%d:%d" % (stat.st_mtime_ns, stat.st_size)
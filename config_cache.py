@@ -0,0 +1,85 @@
+import configparser
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import build_store
+import instrumentation
+
+_cache: Dict[str, Tuple[Tuple[Optional[Tuple[int, int]], ...], "ConfigView"]] = {}
+_lock = threading.Lock()
+
+
+class ConfigView:
+    """
+    A read-only view over a parsed configuration file, shared between every caller reading the same file.
+    """
+
+    def __init__(self, parser: configparser.ConfigParser):
+        self._parser = parser
+
+    def sections(self) -> List[str]:
+        return self._parser.sections()
+
+    def has_section(self, section: str) -> bool:
+        return self._parser.has_section(section)
+
+    def options(self, section: str) -> List[str]:
+        return self._parser.options(section)
+
+    def has_option(self, section: str, option: str) -> bool:
+        return self._parser.has_option(section, option)
+
+    def get(self, section: str, option: str) -> str:
+        return self._parser.get(section, option)
+
+    def items(self, section: str) -> List[Tuple[str, str]]:
+        return self._parser.items(section)
+
+
+def read_config(config_file: str) -> ConfigView:
+    """
+    Parses a configuration file with its change journal replayed over it, or reuses the previous parse if neither the
+    file's nor the journal's modification time and size changed.
+
+    :param config_file: The full path to the configuration file to use.
+    :return: A read-only view of the configuration file, empty if the file does not exist like configparser does.
+    """
+    key = os.path.abspath(str(config_file))
+    signature = (_signature(key), _signature(build_store.get_journal(key)))
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with instrumentation.phase("config_parse") as counter:
+            if signature[1] is not None and signature[1][1]:
+                parser = build_store.load(key)
+            else:
+                parser = configparser.ConfigParser()
+                parser.read(key)
+            counter.add(1, sum(map(lambda x: x[1], filter(None, signature))))
+        view = ConfigView(parser)
+        _cache[key] = (signature, view)
+        return view
+
+
+def invalidate(config_file: str = None):
+    """
+    Drops the cached parse of a configuration file, must be called after writing to it since a quick rewrite may keep
+    the same modification time and size.
+
+    :param config_file: The full path to the configuration file that changed, or None to drop every cached file.
+    """
+    with _lock:
+        if config_file is None:
+            _cache.clear()
+        else:
+            _cache.pop(os.path.abspath(str(config_file)), None)
+
+
+def _signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
@@ -1,72 +1,1294 @@
+import collections
+import concurrent.futures
+import errno
+import hashlib
+import io
+import itertools
+import json
 import os
+import queue
+import sys
+import threading
+import time
 from pathlib import Path
-from typing import Union, Tuple, List
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, OrderedDict, Tuple, Union
 
-import tqdm
+import catalog
+import instrumentation
+import manifest
 
+try:
+    import fcntl
+except ImportError:
+    # Not running on a POSIX system.
+    fcntl = None
 
-def copy_files(file_name: Union[Tuple[str, str], List[Tuple[str, str]]], destination_directory: str):
+# FICLONE from linux/fs.h, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+# From linux/falloc.h.
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+buffer_size = 128 * 1024
+# The ring of buffers between the reader and the writer of copies going through user space.
+pipeline_buffer_count = 4
+pipeline_buffer_size = 1024 * 1024
+# The number of files copied at the same time when copying a whole build.
+default_workers = 4
+# The number of files copied at the same time from one source device to one destination device, more than a couple of
+# streams make a spinning array seek back and forth.
+default_per_device_workers = 2
+# Kernel side copies move bigger chunks, the chunk size only bounds how often the progress bar is updated.
+kernel_chunk_size = 16 * 1024 * 1024
+# The strategy reported for files a sync found already up to date at the destination.
+unchanged_strategy = "unchanged"
+# Modification times closer than this are equal for a sync, SMB and FAT only keep them to 2 seconds.
+sync_mtime_tolerance_ns = 2 * 10 ** 9
+# Block size of delta copies, a changed byte costs rewriting one block.
+delta_block_size = 1024 * 1024
+# The digest used to find identical files.
+dedup_algorithm = "blake2b"
+# Copies are written next to their destination under this suffix until complete.
+partial_suffix = ".partial"
+checkpoint_suffix = ".ckpt"
+# How many bytes are copied between two checkpoints of a .partial file.
+checkpoint_interval = 256 * 1024 * 1024
+_zeros = bytes(buffer_size)
+fan_out_strategy = "fan-out"
+# The number of chunks a destination of a fan-out copy may fall behind the source before it holds back the others.
+fan_out_buffer_count = 8
+# Errors meaning a strategy does not work for this pair of files (other filesystem, not supported by the
+# filesystem or kernel, ...) rather than the copy failing.
+_unsupported_errors = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY,
+                       errno.ETXTBSY, errno.EBADF}
+
+
+@instrumentation.measured("copy", lambda x: count_copied(x))
+def copy_files(file_name: Union[Tuple[str, str], List[Tuple[str, str]]], destination_directory: Union[str, List[str]],
+               workers: int = 1, per_device_workers: int = default_per_device_workers, sync: bool = False,
+               compare_contents: bool = False, delta: bool = False, digest: str = None, dedup: bool = False,
+               file_list: str = None,
+               prepared: Tuple[List["CopyJob"], List[Optional["CopyResult"]]] = None,
+               sources: Dict[str, str] = None
+               ) -> Union[List["CopyResult"], OrderedDict[str, List["CopyResult"]]]:
     """
     Copies file(s) to the provided destination.
 
     :param file_name: The file(s) in (section name, absolute path) tuple pair to be copied.
-    :param destination_directory: The location where the file(s) will be copied to.
-    :return: True if the operation was successful, otherwise false.
-    """
-    # Create the directories if it does not exist.
-    if not Path(destination_directory).exists():
-        os.makedirs(destination_directory)
-
-    if isinstance(file_name, List):
-        for file in file_name:
-            # Create the final destination directories that mirrors the repository then copy files.
-            final_path = str(os.path.join(destination_directory, file[0]))
-            if not Path(final_path).exists():
-                os.makedirs(final_path)
-            head_tail = os.path.split(file[1])
-            destination = os.path.join(final_path, head_tail[1])
-            __copy(file[1], destination)
-    else:
-        # Create the final destination directories that mirrors the repository then copy file.
-        final_path = str(os.path.join(destination_directory, file_name[0]))
+    :param destination_directory: The location where the file(s) will be copied to, or a list of locations to copy
+                                  the file(s) to all of them at once, reading each file only once. Delta and dedup
+                                  are only used with a single location.
+    :param workers: The number of files copied at the same time.
+    :param per_device_workers: The number of files copied at the same time between the same pair of source and
+                               destination devices.
+    :param sync: True to skip files already at the destination with the same size and modification time.
+    :param compare_contents: True to also compare the contents of files sync would skip.
+    :param delta: True to only rewrite the blocks that differ when the destination already exists.
+    :param digest: The hashlib algorithm (e.g. sha256, blake2b) of the digest computed while copying each file, the
+                   digests are saved in a manifest at the destination. None to skip hashing.
+    :param dedup: True to copy identical files only once, the other copies become reflinks or hard links of it.
+    :param file_list: The full path to the file list configuration file whose catalog caches the content digests
+                      dedup needs, None to not cache them.
+    :param prepared: The jobs and results returned by prepare_jobs for the same file(s) and (first) location, e.g. by
+                     a deploy plan, None to stat the file(s) now.
+    :param sources: A {absolute path: local path} of files to read from another place holding the same contents, e.g.
+                    a staging cache. The results still name the original path. None to read every file where it is.
+    :return: A CopyResult for every file, in the same order as the file(s) were given. A {location: CopyResults} if
+             a list of locations was given.
+    """
+    if not isinstance(file_name, List):
+        file_name = [file_name]
+    options = CopyOptions(sync, compare_contents, delta, digest, sources)
+    if isinstance(destination_directory, List):
+        if len(destination_directory) == 1:
+            return collections.OrderedDict([(destination_directory[0], copy_files(
+                file_name, destination_directory[0], workers, per_device_workers, sync, compare_contents, delta,
+                digest, dedup, file_list, prepared, sources))])
+        return _fan_out_files(file_name, destination_directory, workers, per_device_workers, options, prepared)
+    if prepared is None:
+        prepared = prepare_jobs(file_name, destination_directory, workers)
+    jobs, results = prepared[0], list(prepared[1])
+    _make_directories(file_name, destination_directory)
+    links = []
+    if dedup:
+        jobs, links = _deduplicate(jobs, destination_directory, file_list, workers)
+    for result in run_jobs(jobs, workers, per_device_workers, options):
+        results[result[0]] = result[1]
+
+    # Link the duplicates once the file they point to is in place, or copy them after all if that is not possible.
+    fallbacks = []
+    for job, target in links:
+        if isinstance(target, CopyJob):
+            if results[target.position].error:
+                fallbacks.append(job)
+                continue
+            target = target.destination
+        try:
+            results[job.position] = CopyResult(job.section, job.source, job.destination, job.size,
+                                               _link_copy(target, job, options.sync), None)
+        except os.error:
+            fallbacks.append(job)
+    for result in run_jobs(fallbacks, workers, per_device_workers, options):
+        results[result[0]] = result[1]
+    if digest:
+        manifest.write_manifest(destination_directory, digest,
+                                [(x.destination, x.size, x.stats.digest) for x in results if x.stats], workers)
+    return results
+
+
+def count_copied(results: Union[List["CopyResult"], OrderedDict[str, List["CopyResult"]]]) -> Tuple[int, int]:
+    """
+    Totals what a copy did.
+
+    :param results: The results returned by copy_files.
+    :return: The number of files copied (or found up to date) and the number of bytes written, over every destination.
+    """
+    if not isinstance(results, List):
+        results = [x for destination_results in results.values() for x in destination_results]
+    copied = [x for x in results if x.stats]
+    return len(copied), sum(map(lambda x: x.stats.transferred, copied))
+
+
+def _fan_out_files(file_name: List[Tuple[str, str]], destination_directories: List[str], workers: int,
+                   per_device_workers: int, options: "CopyOptions",
+                   prepared: Optional[Tuple[List["CopyJob"], List[Optional["CopyResult"]]]]
+                   ) -> OrderedDict[str, List["CopyResult"]]:
+    # The jobs of the first destination are run, the same jobs retargeted at the other destinations ride along as
+    # their mirrors. Mirrors are numbered after the files of the destinations before theirs.
+    if prepared is None:
+        prepared = prepare_jobs(file_name, destination_directories[0], workers)
+    jobs, first_results = prepared
+    results = []
+    mirrors = {}
+    for index, destination_directory in enumerate(destination_directories):
+        destination_devices = _make_directories(file_name, destination_directory)
+        for result in first_results:
+            if result is not None:
+                result = result._replace(destination=os.path.join(destination_directory, result.section,
+                                                                  os.path.split(result.source)[1]))
+            results.append(result)
+        if index == 0:
+            continue
+        for job in jobs:
+            mirrors.setdefault(job.position, []).append(job._replace(
+                position=job.position + index * len(file_name),
+                destination=os.path.join(destination_directory, job.section, os.path.split(job.source)[1]),
+                destination_device=destination_devices[job.section]))
+    for position, result in run_jobs(jobs, workers, per_device_workers, options, mirrors):
+        results[position] = result
+
+    copies = collections.OrderedDict()
+    for index, destination_directory in enumerate(destination_directories):
+        copies[destination_directory] = results[index * len(file_name):(index + 1) * len(file_name)]
+        if options.digest:
+            manifest.write_manifest(destination_directory, options.digest,
+                                    [(x.destination, x.size, x.stats.digest)
+                                     for x in copies[destination_directory] if x.stats], workers)
+    return copies
+
+
+def _make_directories(file_name: List[Tuple[str, str]], destination_directory: str) -> Dict[str, int]:
+    # Create the final destination directories that mirrors the repository once, before any copy starts.
+    destination_devices = {}
+    for section in set(map(lambda x: x[0], file_name)):
+        final_path = str(os.path.join(destination_directory, section))
         if not Path(final_path).exists():
             os.makedirs(final_path)
-        head_tail = os.path.split(file_name[1])
-        destination = os.path.join(final_path, head_tail[1])
-        __copy(file_name[1], destination)
+        destination_devices[section] = os.stat(final_path).st_dev
+    return destination_devices
+
+
+class CopyJob(NamedTuple):
+    """
+    A single file to copy, with what is needed to schedule it.
+    """
+    # The position of the file in the list given to copy_files, counting the files of every destination before this
+    # one when copying to several.
+    position: int
+    section: str
+    source: str
+    destination: str
+    size: int
+    source_device: int
+    source_inode: int
+    source_mtime: int
+    destination_device: int
+    # The number of bytes the source takes on disk, less than its size if it is sparse.
+    allocated: int
+
+
+class CopyOptions(NamedTuple):
+    """
+    How every file of a copy is handled, see copy_files.
+    """
+    sync: bool = False
+    compare_contents: bool = False
+    delta: bool = False
+    digest: Optional[str] = None
+    # The local path to read each file from instead, by the file's absolute path.
+    sources: Optional[Dict[str, str]] = None
+
+
+class CopyStats(NamedTuple):
+    """
+    How a single file was copied.
+    """
+    # The strategy that copied the data.
+    strategy: str
+    # The number of bytes that actually had to be written.
+    transferred: int = 0
+    # The number of bytes taken over from an interrupted copy.
+    resumed: int = 0
+    # The number of bytes a delta copy found already identical at the destination.
+    reused: int = 0
+    # The number of bytes of holes in a sparse source that were skipped.
+    holes: int = 0
+    # The digest of the contents, if one was asked for.
+    digest: Optional[str] = None
+
+
+class CopyResult(NamedTuple):
+    """
+    The outcome of copying a single file.
+    """
+    section: str
+    source: str
+    destination: str
+    size: int
+    # How the file was copied, None if the copy failed.
+    stats: Optional[CopyStats]
+    # Why the copy failed, None if it succeeded.
+    error: Optional[str]
+
+
+def prepare_jobs(file_name: List[Tuple[str, str]], destination_directory: str,
+                 workers: int = 1) -> Tuple[List[CopyJob], List[Optional[CopyResult]]]:
+    """
+    Stats every file to copy, several files at a time. Nothing is written, the destination directories are only
+    created by copy_files.
+
+    :param file_name: The files in (section name, absolute path) tuple pair to be copied.
+    :param destination_directory: The location where the files will be copied to.
+    :param workers: The number of files stat'ed at the same time.
+    :return: The jobs to run and a list with one slot per file, already holding a failed CopyResult for every file
+             that could not be stat'ed. Files with the same name in the same section get the same destination, the
+             last one given is the one left there.
+    """
+    # A destination directory that does not exist yet will be created on the device of its nearest existing parent.
+    destination_devices = {}
+    for section in set(map(lambda x: x[0], file_name)):
+        final_path = str(os.path.join(destination_directory, section))
+        destination_devices[section] = os.stat(nearest_existing_directory(final_path)).st_dev
+
+    def prepare(entry: Tuple[int, Tuple[str, str]]) -> Union[CopyJob, CopyResult]:
+        position, (section, source) = entry
+        destination = os.path.join(destination_directory, section, os.path.split(source)[1])
+        try:
+            stat = os.stat(source)
+            return CopyJob(position, section, source, destination, stat.st_size, stat.st_dev, stat.st_ino,
+                           stat.st_mtime_ns, destination_devices[section], allocated_size(stat))
+        except os.error as e:
+            return CopyResult(section, source, destination, 0, None, str(e))
+
+    jobs = []
+    results = [None] * len(file_name)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for position, prepared in enumerate(executor.map(prepare, enumerate(file_name))):
+            if isinstance(prepared, CopyJob):
+                jobs.append(prepared)
+            else:
+                results[position] = prepared
+    return jobs, results
+
+
+def nearest_existing_directory(path: str) -> str:
+    """
+    Retrieves the closest directory that exists on the way up to a path.
+
+    :param path: The path, which may not exist yet.
+    :return: The absolute path of the path itself if it is an existing directory, otherwise of its closest existing
+             parent.
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def allocated_size(stat: os.stat_result) -> int:
+    """
+    Retrieves the number of bytes a file takes on disk.
+
+    :param stat: The file's stat result.
+    :return: The allocated size, or the size of the file on platforms that do not report allocated blocks.
+    """
+    blocks = getattr(stat, "st_blocks", None)
+    # st_blocks is always in 512 byte units, whatever the filesystem's block size.
+    return stat.st_size if blocks is None else blocks * 512
+
+
+def run_jobs(jobs: List[CopyJob], workers: int = 1, per_device_workers: int = default_per_device_workers,
+             options: CopyOptions = CopyOptions(),
+             mirrors: Dict[int, List[CopyJob]] = None) -> List[Tuple[int, CopyResult]]:
+    """
+    Copies the files of the jobs, files on the same pair of source and destination devices are copied in inode order
+    by at most per_device_workers workers at a time so reads stay sequential on each spindle, while different devices
+    are copied in parallel.
+
+    :param jobs: The jobs to run.
+    :param workers: The number of files copied at the same time.
+    :param per_device_workers: The number of files copied at the same time between the same pair of devices.
+    :param options: How every file is handled.
+    :param mirrors: The jobs copying the same file as a job to other destinations, by the position of that job. Each
+                    file is read once for all of its destinations.
+    :return: A (job position, CopyResult) pair for every job and mirror, in the order they finished.
+    """
+    if mirrors is None:
+        mirrors = {}
+    rounds = _collision_rounds(jobs)
+    if len(rounds) > 1:
+        # Files with the same name in the same section share a destination, they are copied one after another in
+        # the order they were given so the last one stays, never at the same time. Only the first round may find its
+        # destinations up to date, the later ones would compare against the copy the round before just made.
+        results = []
+        for index, round_jobs in enumerate(rounds):
+            results.extend(run_jobs(round_jobs, workers, per_device_workers,
+                                    options if index == 0 else options._replace(sync=False), mirrors))
+        return results
+    # One queue per pair of devices, each drained by up to per_device_workers lanes. The lanes of different devices
+    # are interleaved so every device gets a worker before any device gets a second one.
+    devices = collections.OrderedDict()
+    for job in jobs:
+        devices.setdefault((job.source_device, job.destination_device), []).append(job)
+    lane_counts = []
+    for key, group in devices.items():
+        group.sort(key=lambda x: x.source_inode)
+        devices[key] = collections.deque(group)
+        lane_counts.append((devices[key], min(max(1, per_device_workers), len(group))))
+    lanes = []
+    for lane in range(max(map(lambda x: x[1], lane_counts), default=0)):
+        lanes.extend(pending for pending, count in lane_counts if lane < count)
+
+    # Imported here so commands that never copy start faster.
+    import tqdm
+
+    workers = max(1, min(workers, len(lanes)))
+    # One total progress bar per destination.
+    totals = collections.OrderedDict()
+    for job in jobs + [x for group in mirrors.values() for x in group]:
+        totals[_destination_directory(job)] = totals.get(_destination_directory(job), 0) + job.size
+    total_bars = {}
+    for position, (destination, size) in enumerate(totals.items()):
+        total_bars[destination] = tqdm.tqdm(desc="Total" if len(totals) == 1 else os.path.basename(destination)[:20],
+                                            total=size, unit="B", unit_scale=True, position=position)
+    total_lock = threading.Lock()
+    # Every worker owns one progress bar, reused for each file it copies.
+    worker_bars = queue.Queue()
+    for position in range(workers):
+        worker_bars.put(tqdm.tqdm(total=0, unit="B", unit_scale=True, position=len(totals) + position,
+                                  leave=False))
+    worker_bar = threading.local()
+    results = []
+
+    def updater(job: CopyJob) -> Callable[[int], object]:
+        # Fan-out copies update the bars from several writer threads.
+        bar = worker_bar.bar
+        total_bar = total_bars[_destination_directory(job)]
+
+        def update(n: int):
+            with total_lock:
+                bar.update(n)
+                total_bar.update(n)
+
+        return update
+
+    def copy_one(job: CopyJob, update: Callable[[int], object]) -> CopyResult:
+        try:
+            if options.sync and is_unchanged(job, options.compare_contents):
+                update(job.size)
+                return CopyResult(job.section, job.source, job.destination, job.size,
+                                  CopyStats(unchanged_strategy), None)
+            stats = _copy_staged(job, update, options)
+            return CopyResult(job.section, job.source, job.destination, job.size, stats, None)
+        except os.error as e:
+            return CopyResult(job.section, job.source, job.destination, job.size, None, str(e))
+
+    def copy_many(targets: List[CopyJob]) -> List[CopyResult]:
+        # The destinations that are already up to date are left out of the fan-out.
+        results = []
+        pending = []
+        for target in targets:
+            try:
+                if options.sync and is_unchanged(target, options.compare_contents):
+                    updater(target)(target.size)
+                    results.append(CopyResult(target.section, target.source, target.destination, target.size,
+                                              CopyStats(unchanged_strategy), None))
+                else:
+                    pending.append(target)
+            except os.error as e:
+                results.append(CopyResult(target.section, target.source, target.destination, target.size, None,
+                                          str(e)))
+        if len(pending) == 1:
+            results.append(copy_one(pending[0], updater(pending[0])))
+        elif pending:
+            try:
+                outcomes = _copy_fan_out(_staged_source(pending[0].source, options),
+                                         [x.destination for x in pending], [updater(x) for x in pending],
+                                         options.digest)
+            except os.error as e:
+                outcomes = [str(e)] * len(pending)
+            for target, outcome in zip(pending, outcomes):
+                if isinstance(outcome, CopyStats):
+                    results.append(CopyResult(target.section, target.source, target.destination, target.size,
+                                              outcome, None))
+                else:
+                    results.append(CopyResult(target.section, target.source, target.destination, target.size, None,
+                                              outcome))
+        return results
+
+    def run(job: CopyJob) -> List[Tuple[int, CopyResult]]:
+        worker_bar.bar = worker_bars.get()
+        start = time.perf_counter()
+        try:
+            targets = [job] + mirrors.get(job.position, [])
+            worker_bar.bar.reset(total=job.size * len(targets))
+            worker_bar.bar.set_description(os.path.split(job.source)[1][:20])
+            if len(targets) == 1:
+                return [(job.position, copy_one(job, updater(job)))]
+            positions = {x.destination: x.position for x in targets}
+            return [(positions[x.destination], x) for x in copy_many(targets)]
+        finally:
+            # A fan-out copy counts once, for all of its destinations.
+            instrumentation.record_latency("copy", time.perf_counter() - start)
+            worker_bars.put(worker_bar.bar)
+
+    def drain(pending: collections.deque):
+        while True:
+            try:
+                job = pending.popleft()
+            except IndexError:
+                return
+            results.extend(run(job))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(drain, pending) for pending in lanes]:
+                future.result()
+    finally:
+        while not worker_bars.empty():
+            worker_bars.get().close()
+        for total_bar in total_bars.values():
+            total_bar.close()
+    return results
+
+
+def _staged_source(source: str, options: CopyOptions) -> str:
+    # A staged copy that went missing, e.g. evicted by another deploy, is read from the original file instead.
+    if options.sources and source in options.sources and os.path.exists(options.sources[source]):
+        return options.sources[source]
+    return source
+
+
+def _copy_staged(job: CopyJob, update: Callable[[int], object], options: CopyOptions) -> "CopyStats":
+    source = _staged_source(job.source, options)
+    try:
+        return __copy(source, job.destination, update, options.delta, options.digest)
+    except FileNotFoundError:
+        if source == job.source:
+            raise
+    # Evicted between the check and the copy.
+    return __copy(job.source, job.destination, update, options.delta, options.digest)
+
+
+def copy_file(src: str, dst: str, update: Callable[[int], object] = None) -> "CopyStats":
+    """
+    Copies a single file with the strategies copy_files uses, keeping its modification time. An interrupted copy is
+    resumed from its last checkpoint.
+
+    :param src: The full path to the file to copy.
+    :param dst: The full path to the copy, its directory must exist.
+    :param update: Called with the number of bytes copied as the copy progresses.
+    :return: How the file was copied. Raises an os.error if the copy failed.
+    """
+    return __copy(src, dst, update)
+
+
+def _collision_rounds(jobs: List[CopyJob]) -> List[List[CopyJob]]:
+    # The n-th round holds the n-th job of every destination, so no round writes a destination twice.
+    rounds = []
+    counts = {}
+    for job in sorted(jobs, key=lambda x: x.position):
+        index = counts.get(job.destination, 0)
+        counts[job.destination] = index + 1
+        if index == len(rounds):
+            rounds.append([])
+        rounds[index].append(job)
+    return rounds
 
 
-def __copy(src: str, dst: str):
+def _destination_directory(job: CopyJob) -> str:
+    # The destination directory given to copy_files, the destination is <destination directory>/<section>/<file>.
+    return os.path.dirname(os.path.dirname(job.destination))
+
+
+def __copy(src: str, dst: str, update: Callable[[int], object] = None, delta: bool = False,
+           algorithm: str = None) -> "CopyStats":
+    """
+    Copies a single file with the fastest strategy both files support.
+
+    The data goes to a .partial file next to the destination, which is renamed over the destination once complete.
+    Holes of sparse files are not copied, the copy is left just as sparse. Every checkpoint_interval bytes the
+    .partial file is flushed and a sidecar checkpoint records the offset and a SHA-256 of everything before it, an
+    interrupted copy resumes from the checkpoint if the source did not change and the .partial file still matches the
+    digest.
+
+    In delta mode an existing destination is compared block by block with the source and only the blocks that differ
+    are rewritten.
+
+    Asking for a digest of the contents computes it from the same reads that feed the copy, which rules out the kernel
+    side strategies since the data has to pass through user space.
+
+    :param src: The absolute path of the file to copy.
+    :param dst: The absolute path of the copy.
+    :param update: Called with the number of bytes copied after every chunk, resumed bytes are reported up front.
+    :param delta: True to only rewrite the blocks of an existing destination that differ from the source.
+    :param algorithm: The hashlib algorithm of the digest to compute, or None.
+    :return: How the file was copied, raises an os.error if the copy failed.
+    """
     # https://stackoverflow.com/questions/22078621/python-how-to-copy-files-fast
     # shutil library reported to be slow for windows based system because of limited buffer size.
     try:
         o_binary = os.O_BINARY
-    except os.error:
+    except AttributeError:
         # Not running on Windows.
         o_binary = 0
     read_flags = os.O_RDONLY | o_binary
-    write_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | o_binary
-    buffer_size = 128 * 1024
+    # Read access is needed to hash the written data back for checkpoints.
+    write_flags = os.O_RDWR | os.O_CREAT | o_binary
+    if update is None:
+        update = lambda n: None
+    partial = dst + partial_suffix
+    checkpoint = partial + checkpoint_suffix
+    file_in = None
+    file_out = None
     try:
         file_in = os.open(src, read_flags)
         stat = os.fstat(file_in)
-        file_out = os.open(dst, write_flags, stat.st_mode)
-        with tqdm.tqdm(desc=os.path.split(src)[1], total=stat.st_size, unit_scale=True, unit="") as bar:
-            for x in iter(lambda: os.read(file_in, buffer_size), b''):
-                os.write(file_out, x)
-                bar.update(len(x))
-    except os.error:
-        print("Copy failed for %s!" % src)
+        if delta and _is_delta_basis(dst):
+            # The previous copy becomes the .partial file and is patched in place.
+            os.replace(dst, partial)
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        file_out = os.open(partial, write_flags, stat.st_mode)
+        offset, digest = _resume(checkpoint, file_out, src, stat)
+        resumed = offset
+        reused = 0
+        holes = 0
+        update(resumed)
+        content = hashlib.new(algorithm) if algorithm else None
+        if content is not None:
+            # The resumed part is hashed from the local copy, it was verified against the checkpoint already.
+            _hash_range(file_out, 0, resumed, content)
+
+        strategy = None
+        if offset == 0 and delta and os.fstat(file_out).st_size > 0:
+            # Also picks up the .partial file of an interrupted delta or of a copy that never reached a checkpoint.
+            reused, holes = _copy_delta(file_in, file_out, stat.st_size, update, content)
+            strategy = "delta"
+            offset = stat.st_size
+        else:
+            os.ftruncate(file_out, offset)
+        if offset == 0 and content is None and _strategies[0][0] == "reflink":
+            try:
+                _copy_reflink(file_in, file_out, 0, stat.st_size, update)
+                strategy = "reflink"
+                offset = stat.st_size
+            except _StrategyUnavailable:
+                pass
+        hashed = offset
+        while offset < stat.st_size:
+            end = min(offset + checkpoint_interval, stat.st_size)
+            # Only the data extents are copied, the holes in between are left unwritten so the copy stays sparse.
+            for start, stop in _data_extents(file_in, offset, end):
+                holes += start - offset
+                update(start - offset)
+                _hash_zeros(start - offset, content)
+                strategy = _copy_range(file_in, file_out, start, stop, update, content)
+                offset = stop
+            holes += end - offset
+            update(end - offset)
+            _hash_zeros(end - offset, content)
+            if os.fstat(file_in).st_size != stat.st_size:
+                raise os.error("%s changed size while being copied." % src)
+            offset = end
+            if offset < stat.st_size:
+                if os.fstat(file_out).st_size < offset:
+                    # The segment ended in a hole.
+                    os.ftruncate(file_out, offset)
+                hashed = _save_checkpoint(checkpoint, file_out, src, stat, offset, digest, hashed)
+        # Extends the copy over a trailing hole.
+        os.ftruncate(file_out, stat.st_size)
+        os.close(file_out)
+        file_out = None
+        os.replace(partial, dst)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        # Keep the source's modification time so a later sync can tell the copy is up to date.
+        os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        transferred = 0 if strategy == "reflink" else stat.st_size - resumed - reused - holes
+        return CopyStats(strategy or _strategies[-1][0], transferred, resumed, reused, holes,
+                         content.hexdigest() if content is not None else None)
     finally:
         try:
-            os.close(file_in)
+            if file_in is not None:
+                os.close(file_in)
         except os.error:
             # Failed to close file.
             # TODO: Error logging.
             pass
         try:
-            os.close(file_out)
+            if file_out is not None:
+                os.close(file_out)
         except os.error:
             # Failed to close file.
             # TODO: Error logging.
             pass
+
+
+def _copy_fan_out(src: str, dsts: List[str], updates: List[Callable[[int], object]],
+                  algorithm: str = None) -> List[Union["CopyStats", str]]:
+    """
+    Copies a single file to several destinations, reading it only once.
+
+    Every destination is written by its own thread from a queue of chunks read from the source, a slow destination
+    only holds back the others once fan_out_buffer_count chunks are waiting for it. A destination that fails is dropped
+    without stopping the others. Holes of sparse files are skipped like __copy does, but there are no checkpoints and
+    no delta.
+
+    :param src: The absolute path of the file to copy.
+    :param dsts: The absolute paths of the copies.
+    :param updates: Called with the number of bytes copied to the destination at the same position.
+    :param algorithm: The hashlib algorithm of the digest to compute, or None.
+    :return: How the file was copied, or why its copy failed, for every destination in order. Raises an os.error if
+             the source could not be read.
+    """
+    o_binary = getattr(os, "O_BINARY", 0)
+    file_in = os.open(src, os.O_RDONLY | o_binary)
+    outputs = []
+    errors = []
+    try:
+        stat = os.fstat(file_in)
+        for dst in dsts:
+            try:
+                outputs.append(os.open(dst + partial_suffix, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | o_binary,
+                                       stat.st_mode))
+                errors.append(None)
+            except os.error as e:
+                outputs.append(None)
+                errors.append(str(e))
+        queues = [queue.Queue(maxsize=max(1, fan_out_buffer_count)) for _ in dsts]
+
+        def write(index: int):
+            while True:
+                chunk = queues[index].get()
+                if chunk is None:
+                    return
+                if errors[index] is not None:
+                    continue
+                offset, data = chunk
+                try:
+                    os.lseek(outputs[index], offset, os.SEEK_SET)
+                    _write_chunk(outputs[index], memoryview(data), None)
+                    updates[index](len(data))
+                except os.error as e:
+                    errors[index] = str(e)
+
+        threads = [threading.Thread(target=write, args=(x,), name="copy-writer", daemon=True) for x in range(len(dsts))]
+        for thread in threads:
+            thread.start()
+        content = hashlib.new(algorithm) if algorithm else None
+        holes = 0
+        offset = 0
+        try:
+            _advise(file_in, 0, stat.st_size, "POSIX_FADV_SEQUENTIAL")
+            for start, stop in _data_extents(file_in, 0, stat.st_size):
+                holes += start - offset
+                _hash_zeros(start - offset, content)
+                for index, update in enumerate(updates):
+                    if errors[index] is None:
+                        update(start - offset)
+                offset = os.lseek(file_in, start, os.SEEK_SET)
+                while offset < stop and not all(errors):
+                    data = os.read(file_in, min(pipeline_buffer_size, stop - offset))
+                    if not data:
+                        raise os.error("%s changed size while being copied." % src)
+                    if content is not None:
+                        content.update(data)
+                    # Blocks once the slowest destination is fan_out_buffer_count chunks behind.
+                    for index, chunk_queue in enumerate(queues):
+                        if errors[index] is None:
+                            chunk_queue.put((offset, data))
+                    _advise(file_in, offset, len(data), "POSIX_FADV_DONTNEED")
+                    offset += len(data)
+            holes += stat.st_size - offset
+            _hash_zeros(stat.st_size - offset, content)
+            for index, update in enumerate(updates):
+                if errors[index] is None:
+                    update(stat.st_size - offset)
+            if os.fstat(file_in).st_size != stat.st_size:
+                raise os.error("%s changed size while being copied." % src)
+        finally:
+            for chunk_queue in queues:
+                chunk_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        outcomes = []
+        for index, dst in enumerate(dsts):
+            if errors[index] is None:
+                try:
+                    # Extends the copy over a trailing hole.
+                    os.ftruncate(outputs[index], stat.st_size)
+                    os.close(outputs[index])
+                    outputs[index] = None
+                    os.replace(dst + partial_suffix, dst)
+                    if os.path.exists(dst + partial_suffix + checkpoint_suffix):
+                        os.remove(dst + partial_suffix + checkpoint_suffix)
+                    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                    outcomes.append(CopyStats(fan_out_strategy, stat.st_size - holes, holes=holes,
+                                              digest=content.hexdigest() if content is not None else None))
+                    continue
+                except os.error as e:
+                    errors[index] = str(e)
+            outcomes.append(errors[index])
+        return outcomes
+    finally:
+        os.close(file_in)
+        for index, file_out in enumerate(outputs):
+            if file_out is None:
+                continue
+            # Without a checkpoint the .partial file of a failed fan-out cannot be resumed.
+            try:
+                os.close(file_out)
+                os.remove(dsts[index] + partial_suffix)
+            except os.error:
+                pass
+
+
+def content_digests(jobs: List[CopyJob], file_list: str = None, workers: int = None) -> Dict[str, str]:
+    """
+    Computes the content digest of every source with a pool of processes, digests cached in the artifact catalog are
+    reused as long as the file's size and modification time did not change.
+
+    :param jobs: The jobs whose sources should be hashed.
+    :param file_list: The full path to the file list configuration file whose catalog caches digests, or None.
+    :param workers: The number of files hashed at the same time, None for one per CPU.
+    :return: A {source path: hexadecimal digest}, sources that could not be read are left out.
+    """
+    return file_digests([(job.source, job.size, job.source_mtime) for job in jobs], file_list, workers)
+
+
+def file_digests(files: List[Tuple[str, int, int]], file_list: str = None, workers: int = None) -> Dict[str, str]:
+    """
+    Computes the content digest of files with a pool of processes, digests cached in the artifact catalog are reused
+    as long as the file's size and modification time did not change.
+
+    :param files: An (absolute path, size, modification time in ns) for every file to hash.
+    :param file_list: The full path to the file list configuration file whose catalog caches digests, or None.
+    :param workers: The number of files hashed at the same time, None for one per CPU.
+    :return: A {path: hexadecimal digest}, files that could not be read are left out.
+    """
+    files = list(collections.OrderedDict((x, None) for x in files))
+    digests = catalog.load_digests(file_list, files, dedup_algorithm) if file_list else {}
+    missing = [x for x in files if x[0] not in digests]
+    if missing:
+        computed = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(x, executor.submit(manifest.file_digest, x[0], dedup_algorithm)) for x in missing]
+            for (path, size, mtime), future in futures:
+                try:
+                    digests[path] = future.result()
+                    computed.append((path, size, mtime, digests[path]))
+                except os.error:
+                    pass
+        if file_list:
+            catalog.save_digests(file_list, computed, dedup_algorithm)
+    return digests
+
+
+def _deduplicate(jobs: List[CopyJob], destination_directory: str, file_list: Optional[str],
+                 workers: int) -> Tuple[List[CopyJob], List[Tuple[CopyJob, Union[CopyJob, str]]]]:
+    """
+    Splits the jobs into the ones that must be copied and the ones whose contents will already be at the destination,
+    either copied by another job or listed in the destination's manifest.
+
+    :param jobs: The jobs to deduplicate.
+    :param destination_directory: The location where the files will be copied to.
+    :param file_list: The full path to the file list configuration file whose catalog caches digests, or None.
+    :param workers: The number of files hashed at the same time.
+    :return: The jobs to copy, and (job, job copying the same contents or path of an identical file) pairs to link.
+    """
+    digests = content_digests(jobs, file_list, workers)
+    destinations = set(map(lambda x: x.destination, jobs))
+    existing = {}
+    previous = manifest.load_manifest(destination_directory)
+    if previous is not None and previous.get("algorithm") == dedup_algorithm:
+        for relative_path, entry in previous["files"].items():
+            path = os.path.join(destination_directory, *relative_path.split("/"))
+            # Files this copy is about to overwrite cannot be linked to.
+            if path in destinations:
+                continue
+            try:
+                stat = os.stat(path)
+            except os.error:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime"]):
+                existing[entry["digest"]] = path
+
+    # A job whose destination a later job overwrites is copied in turn before it, see run_jobs, and is neither linked
+    # after every copy nor linked to.
+    last = {x.destination: x.position for x in sorted(jobs, key=lambda x: x.position)}
+    copies = []
+    links = []
+    first = {}
+    for job in jobs:
+        digest = digests.get(job.source)
+        if digest is None or last[job.destination] != job.position:
+            copies.append(job)
+        elif digest in existing:
+            links.append((job, existing[digest]))
+        elif digest in first:
+            links.append((job, first[digest]))
+        else:
+            first[digest] = job
+            copies.append(job)
+    return copies, links
+
+
+def _link_copy(target: str, job: CopyJob, sync: bool = False) -> "CopyStats":
+    """
+    Makes the destination of a job share the contents of an identical file already at the destination, as a reflink
+    if the filesystem supports it, otherwise as a hard link.
+
+    :param target: The absolute path of the identical file.
+    :param job: The job to complete.
+    :param sync: True to leave the destination alone if it already is a hard link of the target.
+    :return: How the file was copied, raises an os.error if neither kind of link can be made.
+    """
+    if sync and os.path.exists(job.destination) and os.path.samefile(target, job.destination):
+        return CopyStats(unchanged_strategy)
+    temp_path = job.destination + partial_suffix
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    strategy = "reflink"
+    try:
+        if fcntl is None:
+            raise _StrategyUnavailable(0)
+        file_in = os.open(target, os.O_RDONLY)
+        try:
+            file_out = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, os.fstat(file_in).st_mode)
+            try:
+                _copy_reflink(file_in, file_out, 0, os.fstat(file_in).st_size, lambda n: None)
+            finally:
+                os.close(file_out)
+        finally:
+            os.close(file_in)
+        os.utime(temp_path, ns=(job.source_mtime, job.source_mtime))
+    except _StrategyUnavailable:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        strategy = "hardlink"
+        os.link(target, temp_path)
+    os.replace(temp_path, job.destination)
+    return CopyStats(strategy)
+
+
+def is_unchanged(job: CopyJob, compare_contents: bool = False) -> bool:
+    """
+    Checks if the destination of a job already holds the same file as the source.
+
+    :param job: The job to check.
+    :param compare_contents: True to also compare the BLAKE2 digests of both files.
+    :return: True if the destination has the source's size and modification time, and contents if asked to.
+    """
+    try:
+        stat = os.stat(job.destination)
+    except os.error:
+        return False
+    if stat.st_size != job.size or abs(stat.st_mtime_ns - job.source_mtime) > sync_mtime_tolerance_ns:
+        return False
+    return not compare_contents or manifest.file_digest(job.source) == manifest.file_digest(job.destination)
+
+
+def _is_delta_basis(dst: str) -> bool:
+    try:
+        stat = os.lstat(dst)
+    except os.error:
+        return False
+    # Patching a file with other hard links would change the other names as well.
+    return os.path.isfile(dst) and not os.path.islink(dst) and stat.st_nlink == 1 and stat.st_size > 0
+
+
+def _copy_delta(file_in: int, file_out: int, size: int, update: Callable[[int], object],
+                content: "hashlib._Hash" = None) -> Tuple[int, int]:
+    """
+    Patches the open .partial file into a copy of the source: the data extents of the source are compared block by
+    block with the old copy and only the blocks that differ are written. The holes of a sparse source are neither
+    read nor written, whatever data the old copy has there is punched out so the copy stays as sparse as the source.
+
+    :param file_in: The source file descriptor.
+    :param file_out: The .partial file descriptor, holding the old copy.
+    :param size: The size of the source.
+    :param update: Called with the number of bytes handled after every block.
+    :param content: A digest to add the source's contents to, or None.
+    :return: The number of bytes that were already identical and the number of bytes of holes.
+    """
+    if os.fstat(file_out).st_size > size:
+        os.ftruncate(file_out, size)
+    reused = 0
+    holes = 0
+    offset = 0
+    for start, stop in itertools.chain(_data_extents(file_in, 0, size), [(size, size)]):
+        for hole_start, hole_stop in _data_extents(file_out, offset, start):
+            _punch_hole(file_out, hole_start, hole_stop)
+        holes += start - offset
+        update(start - offset)
+        _hash_zeros(start - offset, content)
+        offset = start
+        while offset < stop:
+            # Blocks stay on the same boundaries whatever the extents, a partial block only happens at their ends.
+            x = _pread(file_in, min(delta_block_size - offset % delta_block_size, stop - offset), offset)
+            if not x:
+                _ended_early(offset)
+            if content is not None:
+                content.update(x)
+            if _pread(file_out, len(x), offset) == x:
+                reused += len(x)
+            else:
+                view = memoryview(x)
+                position = offset
+                while view:
+                    written = _pwrite(file_out, view, position)
+                    view = view[written:]
+                    position += written
+            offset += len(x)
+            update(len(x))
+    return reused, holes
+
+
+def _resume(checkpoint: str, file_out: int, src: str, stat: os.stat_result) -> Tuple[int, "hashlib._Hash"]:
+    """
+    Finds where an interrupted copy can resume from.
+
+    :param checkpoint: The path of the sidecar checkpoint.
+    :param file_out: The open .partial file.
+    :param src: The absolute path of the file to copy.
+    :param stat: The source's stat.
+    :return: The verified offset to resume from and the digest of everything before it, (0, empty digest) if there is
+             nothing usable to resume from.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(checkpoint, "r") as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        if (saved["source"], saved["size"], saved["mtime"]) != (src, stat.st_size, stat.st_mtime_ns) or \
+                os.fstat(file_out).st_size < saved["offset"]:
+            return 0, digest
+        _hash_range(file_out, 0, saved["offset"], digest)
+        if digest.hexdigest() == saved["sha256"]:
+            return saved["offset"], digest
+    except (OSError, ValueError, KeyError, TypeError):
+        # No checkpoint or an unusable one, start over.
+        pass
+    return 0, hashlib.sha256()
+
+
+def _save_checkpoint(checkpoint: str, file_out: int, src: str, stat: os.stat_result, offset: int,
+                     digest: "hashlib._Hash", hashed: int) -> int:
+    """
+    Flushes the .partial file and records that everything before offset is safely copied.
+
+    :param checkpoint: The path of the sidecar checkpoint.
+    :param file_out: The open .partial file.
+    :param src: The absolute path of the file to copy.
+    :param stat: The source's stat.
+    :param offset: The number of bytes copied so far.
+    :param digest: The digest of the first hashed bytes, brought up to offset.
+    :param hashed: The number of bytes already added to the digest.
+    :return: The number of bytes added to the digest, which is offset.
+    """
+    # The digest is computed by reading the freshly written bytes back, so it also works for kernel side copies
+    # where the data never reaches user space.
+    _hash_range(file_out, hashed, offset, digest)
+    getattr(os, "fdatasync", os.fsync)(file_out)
+    # Everything before the checkpoint is hashed and on disk, drop it from the page cache.
+    _advise(file_out, 0, offset, "POSIX_FADV_DONTNEED")
+    temp_path = checkpoint + ".tmp"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump({"source": src, "size": stat.st_size, "mtime": stat.st_mtime_ns, "offset": offset,
+                   "sha256": digest.hexdigest()}, checkpoint_file)
+    os.replace(temp_path, checkpoint)
+    return offset
+
+
+def _hash_zeros(count: int, digest: Optional["hashlib._Hash"]):
+    # Holes read back as zeros.
+    while digest is not None and count > 0:
+        digest.update(_zeros[:min(count, len(_zeros))])
+        count -= len(_zeros)
+
+
+def _hash_range(file_descriptor: int, offset: int, end: int, digest: "hashlib._Hash"):
+    while offset < end:
+        x = _pread(file_descriptor, min(buffer_size, end - offset), offset)
+        if not x:
+            raise os.error("Unexpected end of file while hashing.")
+        digest.update(x)
+        offset += len(x)
+
+
+def _pread(file_descriptor: int, length: int, offset: int) -> bytes:
+    # Windows has no pread, the fallback moves the file position, which every caller sets again before using it.
+    if hasattr(os, "pread"):
+        return os.pread(file_descriptor, length, offset)
+    os.lseek(file_descriptor, offset, os.SEEK_SET)
+    return os.read(file_descriptor, length)
+
+
+def _pwrite(file_descriptor: int, data: Union[bytes, memoryview], offset: int) -> int:
+    if hasattr(os, "pwrite"):
+        return os.pwrite(file_descriptor, data, offset)
+    os.lseek(file_descriptor, offset, os.SEEK_SET)
+    return os.write(file_descriptor, data)
+
+
+class _StrategyUnavailable(Exception):
+    """
+    A copy strategy cannot be used for this pair of files, carries the offset the strategy got to before giving up.
+    """
+
+    def __init__(self, offset: int):
+        super().__init__(offset)
+        self.offset = offset
+
+
+def _copy_range(file_in: int, file_out: int, offset: int, end: int, update: Callable[[int], object],
+                content: "hashlib._Hash" = None) -> str:
+    """
+    Copies [offset, end) between two open files, trying each strategy in turn until one of them is supported.
+    Only the read/write loop is used when the data has to be hashed.
+
+    :param file_in: The file descriptor to read from.
+    :param file_out: The file descriptor to write to.
+    :param offset: The first byte to copy.
+    :param end: The byte to stop at.
+    :param update: Called with the number of bytes copied after every chunk.
+    :param content: A digest to add the copied data to, or None.
+    :return: The name of the strategy that finished the copy. Raises an os.error if the source ends before end.
+    """
+    if content is not None:
+        _copy_read_write(file_in, file_out, offset, end, update, content)
+        return "read/write"
+    for name, strategy in _strategies:
+        try:
+            strategy(file_in, file_out, offset, end, update)
+            return name
+        except _StrategyUnavailable as e:
+            offset = e.offset
+    # The read/write loop supports everything, this is never reached.
+    raise os.error("No copy strategy available.")
+
+
+def _data_extents(file_in: int, offset: int, end: int) -> Iterator[Tuple[int, int]]:
+    """
+    Finds the allocated regions of a sparse file with SEEK_DATA/SEEK_HOLE.
+
+    :param file_in: The file descriptor to inspect.
+    :param offset: The first byte to look at.
+    :param end: The byte to stop at.
+    :return: The (start, stop) of every data region between offset and end, the whole range if the platform or the
+             filesystem cannot tell holes apart.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        yield offset, end
+        return
+    while offset < end:
+        try:
+            start = os.lseek(file_in, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Nothing but a hole up to the end of the file.
+                return
+            if e.errno in _unsupported_errors:
+                yield offset, end
+                return
+            raise
+        if start >= end:
+            return
+        stop = min(os.lseek(file_in, start, os.SEEK_HOLE), end)
+        yield start, stop
+        offset = stop
+
+
+def _ended_early(offset: int):
+    # A source that shrank while it was copied, the rest of the copy would silently be zeros.
+    raise os.error(errno.EIO, "The source ended at byte %d, before the end of the copy." % offset)
+
+
+def _punch_hole(file_descriptor: int, offset: int, end: int):
+    # Deallocates [offset, end) so it reads back as zeros, zeros are written instead where holes cannot be punched.
+    if sys.platform.startswith("linux"):
+        # Imported here, only delta copies of sparse files punch holes.
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        if fallocate(file_descriptor, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, end - offset) == 0:
+            return
+        if ctypes.get_errno() not in _unsupported_errors:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    while offset < end:
+        offset += _pwrite(file_descriptor, _zeros[:min(len(_zeros), end - offset)], offset)
+
+
+def _unavailable(error: OSError, offset: int):
+    if error.errno in _unsupported_errors:
+        raise _StrategyUnavailable(offset) from error
+    raise error
+
+
+def _copy_reflink(file_in: int, file_out: int, offset: int, end: int, update: Callable[[int], object]):
+    # Cloning shares the extents of the whole file on copy-on-write filesystems (btrfs, XFS), no data is moved.
+    if offset != 0 or end == 0 or os.fstat(file_in).st_size != end:
+        raise _StrategyUnavailable(offset)
+    try:
+        fcntl.ioctl(file_out, FICLONE, file_in)
+    except OSError as e:
+        _unavailable(e, offset)
+    update(end)
+
+
+def _copy_copy_file_range(file_in: int, file_out: int, offset: int, end: int, update: Callable[[int], object]):
+    # The kernel copies the data, or offloads it to the server on NFS/SMB, without it ever reaching user space.
+    while offset < end:
+        try:
+            copied = os.copy_file_range(file_in, file_out, min(kernel_chunk_size, end - offset), offset, offset)
+        except OSError as e:
+            _unavailable(e, offset)
+        if not copied:
+            _ended_early(offset)
+        offset += copied
+        update(copied)
+
+
+def _copy_sendfile(file_in: int, file_out: int, offset: int, end: int, update: Callable[[int], object]):
+    # sendfile writes at the current position of the destination.
+    os.lseek(file_out, offset, os.SEEK_SET)
+    while offset < end:
+        try:
+            copied = os.sendfile(file_out, file_in, offset, min(kernel_chunk_size, end - offset))
+        except OSError as e:
+            _unavailable(e, offset)
+        if not copied:
+            _ended_early(offset)
+        offset += copied
+        update(copied)
+
+
+def _copy_read_write(file_in: int, file_out: int, offset: int, end: int, update: Callable[[int], object],
+                     content: "hashlib._Hash" = None):
+    """
+    Copies [offset, end) through user space. A reader thread fills a ring of preallocated buffers while this thread
+    hashes and writes the previous ones, so the read latency of network storage overlaps the write latency of the
+    destination.
+    """
+    _advise(file_in, offset, end - offset, "POSIX_FADV_SEQUENTIAL")
+    os.lseek(file_out, offset, os.SEEK_SET)
+    if end - offset <= pipeline_buffer_size:
+        # Not worth a thread.
+        reader = io.FileIO(file_in, "rb", closefd=False)
+        reader.seek(offset)
+        buffer = bytearray(max(0, end - offset))
+        count = 0
+        while count < len(buffer):
+            read = reader.readinto(memoryview(buffer)[count:]) or 0
+            if not read:
+                _ended_early(offset + count)
+            count += read
+        _write_chunk(file_out, memoryview(buffer), content)
+        _advise(file_in, offset, count, "POSIX_FADV_DONTNEED")
+        update(count)
+        return
+
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _ in range(max(2, pipeline_buffer_count)):
+        free.put(bytearray(pipeline_buffer_size))
+    stop = threading.Event()
+
+    def read():
+        reader = io.FileIO(file_in, "rb", closefd=False)
+        position = offset
+        try:
+            reader.seek(position)
+            while position < end and not stop.is_set():
+                buffer = free.get()
+                if buffer is None:
+                    break
+                count = reader.readinto(memoryview(buffer)[:min(len(buffer), end - position)]) or 0
+                if not count:
+                    _ended_early(position)
+                filled.put((buffer, count, None))
+                position += count
+        except BaseException as e:
+            filled.put((None, 0, e))
+            return
+        filled.put((None, 0, None))
+
+    thread = threading.Thread(target=read, name="copy-reader", daemon=True)
+    thread.start()
+    try:
+        position = offset
+        while True:
+            buffer, count, error = filled.get()
+            if error is not None:
+                raise error
+            if buffer is None or not count:
+                break
+            _write_chunk(file_out, memoryview(buffer)[:count], content)
+            # The source pages will not be read again, keep the page cache for the production workloads.
+            _advise(file_in, position, count, "POSIX_FADV_DONTNEED")
+            position += count
+            update(count)
+            free.put(buffer)
+    finally:
+        stop.set()
+        # Unblock the reader if it is waiting for a buffer.
+        free.put(None)
+        thread.join()
+
+
+def _write_chunk(file_out: int, view: memoryview, content: Optional["hashlib._Hash"]):
+    if content is not None:
+        content.update(view)
+    while view:
+        view = view[os.write(file_out, view):]
+
+
+def _advise(file_descriptor: int, offset: int, length: int, advice: str):
+    # posix_fadvise is only a hint, it does not exist on Windows and macOS.
+    if length > 0 and hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(file_descriptor, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+# Tried in order, each strategy gives up with _StrategyUnavailable when the files or the platform do not support it.
+_strategies = []
+if fcntl is not None and sys.platform.startswith("linux"):
+    _strategies.append(("reflink", _copy_reflink))
+if hasattr(os, "copy_file_range"):
+    _strategies.append(("copy_file_range", _copy_copy_file_range))
+if hasattr(os, "sendfile"):
+    _strategies.append(("sendfile", _copy_sendfile))
+_strategies.append(("read/write", _copy_read_write))
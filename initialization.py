@@ -1,8 +1,21 @@
 import collections
+import concurrent.futures
 import configparser
+import contextlib
+import fnmatch
+import json
 import os
+import queue
+import re
+import sqlite3
+import time
 from pathlib import Path
-from typing import Dict, OrderedDict
+from typing import Callable, Dict, FrozenSet, List, Optional, OrderedDict, Tuple
+
+import build_store
+import catalog
+import config_cache
+import instrumentation
 
 USER_HOME = str(os.path.expanduser("~"))
 CONFIGURATION_SECTION = "CONFIGURATION"
@@ -10,7 +23,12 @@ HOST_NAMES_SECTION = "HOST_NAMES"
 base_config_name = "config.ini"
 file_list_config_name = "file-list.ini"
 project_root = str(os.path.join(USER_HOME, "file-picker"))
-base_paths = {file_list_config_name: str(os.path.join(project_root, file_list_config_name))}
+base_paths = {file_list_config_name: str(os.path.join(project_root, file_list_config_name)),
+              # A local directory deployed files are staged in so repeat deploys do not read the repository again,
+              # blank for no staging cache.
+              "cache_directory": "",
+              # The room the staging cache may take, in bytes or with a K, M, G or T unit.
+              "cache_capacity": "20G"}
 
 file_list_default = collections.OrderedDict({"base_directory": "file-picker-dev1, file-picker-dev2, file-picker-dev3",
                                              "firmware_directory": "firmware",
@@ -19,7 +37,23 @@ file_list_default = collections.OrderedDict({"base_directory": "file-picker-dev1
                                              "iso_directory": "iso_images",
                                              "config_directory": "configs",
                                              "delta_directory:": "deltas",
-                                             "tools_directory": "tools"})
+                                             "tools_directory": "tools",
+                                             # Comma separated glob patterns of file and directory names to skip.
+                                             "exclude": "",
+                                             # How many levels below a base directory to descend, blank for all.
+                                             "max_depth": "",
+                                             # True to skip the subdirectories of a category directory.
+                                             "prune_matched": "False"})
+# CONFIGURATION options of the file list that steer the crawl instead of naming a category directory.
+crawl_rule_options = ["base_directory", "exclude", "max_depth", "prune_matched"]
+
+# The crawl is bound by directory listing latency on network mounts rather than CPU, so oversubscribe the cores.
+default_crawl_workers = min(32, (os.cpu_count() or 1) * 4)
+# A directory modified this close to the crawl may change again within the same timestamp tick, its listing is
+# never trusted by the next incremental crawl.
+racy_mtime_window_ns = 2 * 10 ** 9
+directory_index_suffix = ".idx"
+_directory_index_schema = "CREATE TABLE directories (path TEXT PRIMARY KEY, entry TEXT NOT NULL)"
 
 default_host_names = {"firmware": "True",
                       "network": "True",
@@ -39,6 +73,83 @@ test_build = {"firmware": "test_1.1, test_1.2, test_1.3",
               "tools": "install, test, misc"}
 
 
+class CrawlRules:
+    """
+    What a crawl collects and which directories it enters, compiled from the CONFIGURATION section of a file list.
+
+    A directory belongs to every category whose name is part of its path. All the category names are searched for at
+    once with a single regular expression, and only in the part of a path its parent's path did not already cover.
+    """
+
+    def __init__(self, categories: List[str], exclude: List[str] = None, max_depth: int = None,
+                 prune_matched: bool = False):
+        # In option order, a category listed twice collects its files twice like it always did.
+        self.categories = categories
+        self.exclude = exclude or []
+        self.max_depth = max_depth
+        self.prune_matched = prune_matched
+        unique = sorted(set(categories), key=len, reverse=True)
+        self._categories = unique
+        self._any_category = re.compile("|".join(map(re.escape, unique))) if unique else None
+        # A category name found in a path but not in its parent's path ends in the new part, so it starts at most
+        # this many characters before it.
+        self._overlap = max(map(len, unique), default=1) - 1
+        self._excluded = re.compile("|".join(map(fnmatch.translate, self.exclude))) if self.exclude else None
+
+    def match(self, path: str, parent: str = None, parent_matches: FrozenSet[str] = frozenset()) -> FrozenSet[str]:
+        """
+        Finds the categories a directory belongs to.
+
+        :param path: The directory's absolute path.
+        :param parent: The parent's absolute path, None to search the whole path.
+        :param parent_matches: The categories the parent belongs to.
+        :return: The names of the categories the directory belongs to.
+        """
+        if self._any_category is None:
+            return frozenset()
+        tail = path if parent is None else path[max(0, len(parent) - self._overlap):]
+        if not self._any_category.search(tail):
+            return parent_matches
+        return parent_matches | frozenset(x for x in self._categories if x in tail)
+
+    def is_excluded(self, name: str) -> bool:
+        """
+        Checks a file or directory name against the exclude patterns, case sensitively.
+
+        :param name: The name of the file or directory.
+        :return: True if the crawl skips it.
+        """
+        return self._excluded is not None and self._excluded.match(name) is not None
+
+    def descends(self, depth: int, matches: FrozenSet[str]) -> bool:
+        """
+        Checks if the crawl enters the subdirectories of a directory.
+
+        :param depth: How many levels below its base directory the directory is, 0 for the base directory itself.
+        :param matches: The categories the directory belongs to.
+        :return: True if the subdirectories are crawled.
+        """
+        if self.max_depth is not None and depth >= self.max_depth:
+            return False
+        return not (self.prune_matched and matches)
+
+    def subdirectories(self, directory: str, depth: int, matches: FrozenSet[str],
+                       names: List[str]) -> List[Tuple[int, str]]:
+        """
+        Picks the subdirectories of a directory the crawl enters.
+
+        :param directory: The directory's absolute path.
+        :param depth: How many levels below its base directory the directory is.
+        :param matches: The categories the directory belongs to.
+        :param names: The names of the directory's subdirectories, in listing order.
+        :return: The (position in names, absolute path) of every subdirectory to crawl.
+        """
+        if not self.descends(depth, matches):
+            return []
+        return [(position, os.path.join(directory, name)) for position, name in enumerate(names)
+                if not self.is_excluded(name)]
+
+
 def initialize():
     """
     Convenience method to initialize everything at startup.
@@ -90,9 +201,9 @@ def create_config(path: str = project_root, file_name: str = base_config_name, c
     # TODO: Remove this line!
     config["test_build"] = test_build
 
-    # Write the configuration into the file.
-    with open(os.path.join(path, file_name), "w") as config_file:
-        config.write(config_file)
+    # Write the configuration into the file, changes journaled for the previous one no longer apply.
+    build_store.replace(os.path.join(path, file_name), config)
+    config_cache.invalidate(os.path.join(path, file_name))
 
     return os.path.join(path, file_name)
 
@@ -117,15 +228,46 @@ def create_file_list_config(path: str = project_root, file_name: str = file_list
 
     with open(os.path.join(path, file_name), "w") as config_file:
         config.write(config_file)
+    config_cache.invalidate(os.path.join(path, file_name))
 
 
-def crawl_system(path: str = project_root, file_name: str = file_list_config_name):
+def crawl_system(path: str = project_root, file_name: str = file_list_config_name,
+                 workers: int = default_crawl_workers, incremental: bool = False) -> Tuple[int, int]:
     """
     Crawls the system using the supplied configuration file as the starting point. It will populate the file with
     discovered files.
 
+    Every crawl saves the listing of each visited directory next to the configuration file, an incremental crawl
+    reuses the saved listing of every directory whose modification time has not changed instead of listing it again.
+    The exclude, max_depth and prune_matched options of the CONFIGURATION section keep the crawl out of directories
+    that cannot contribute files.
+
+    :param path: The location of the configuration file.
+    :param file_name: The name of the configuration file.
+    :param workers: The maximum number of directories listed at the same time.
+    :param incremental: True to reuse the directory index of the previous crawl, otherwise everything is listed again.
+    :return: The number of directories visited and the number of them that had to be listed.
+    """
+    with instrumentation.phase("crawl") as counter:
+        config, tops = get_crawl_config(path, file_name)
+        index_path = get_directory_index(path, file_name)
+        previous_index = load_directory_index(index_path) if incremental else {}
+        listing, index, relisted = _walk_parallel(tops, workers, previous_index, rules=get_crawl_rules(config))
+        write_artifacts(path, file_name, config, listing, index)
+        # Files found, whether or not they belong to a category.
+        counter.add(sum(map(lambda x: len(x[1]), listing)))
+    return len(listing), relisted
+
+
+def get_crawl_config(path: str = project_root,
+                     file_name: str = file_list_config_name) -> Tuple[configparser.ConfigParser, List[str]]:
+    """
+    Reads what a crawl needs from a file list configuration file.
+
     :param path: The location of the configuration file.
     :param file_name: The name of the configuration file.
+    :return: The configuration file with only its CONFIGURATION section left, and the absolute paths of the base
+             directories to crawl.
     """
     config = configparser.ConfigParser()
     config.read(os.path.join(path, file_name))
@@ -135,28 +277,402 @@ def crawl_system(path: str = project_root, file_name: str = file_list_config_nam
 
     # Crawling block.
     # Iterate over a list created out of the base_directory option.
-    for base in filter(None, map(lambda x: x.strip(), config.get(CONFIGURATION_SECTION, "base_directory").split(","))):
-        # print("Crawling %s..." % base)
-        os_root_and_base = os.path.join(os.path.abspath(os.sep), base)
-        # Start crawling from the root directory + base, / for Linux and C:\ for Windows.
-        # e.g. /dev1 for Linux, C:\dev1 for Windows.
-        # May take a while...
-        for current_path, dirs, files in os.walk(os_root_and_base):
-            for directory in config[CONFIGURATION_SECTION]:
-                if directory != "base_directory":
-                    option_value = config.get(CONFIGURATION_SECTION, directory)
-                    if current_path.find(option_value) >= 0:
-                        # Create a new section if necessary, based on the CONFIGURATION section's option.
-                        if not config.has_section(option_value):
-                            config.add_section(option_value)
-                        # Add each file as the option's name and the file's path as the option's value.
-                        for file in files:
-                            if config.has_option(option_value, file):
-                                # If there are multiple files with the same name, create a csv for the value.
-                                ov = config.get(option_value, file)
-                                nv = ov + ", " + os.path.join(current_path, file)
-                                config.set(option_value, file, nv)
-                            else:
-                                config.set(option_value, file, os.path.join(current_path, file))
-    with open(os.path.join(path, file_name), "w") as config_file:
+    # Start crawling from the root directory + base, / for Linux and C:\ for Windows.
+    # e.g. /dev1 for Linux, C:\dev1 for Windows.
+    bases = filter(None, map(lambda x: x.strip(), config.get(CONFIGURATION_SECTION, "base_directory").split(",")))
+    tops = [os.path.join(os.path.abspath(os.sep), base) for base in bases]
+    return config, tops
+
+
+def get_crawl_rules(config: configparser.ConfigParser) -> CrawlRules:
+    """
+    Compiles the crawl rules of a file list configuration.
+
+    :param config: The configuration returned by get_crawl_config.
+    :return: The crawl rules. Raises a ValueError if max_depth is not a number or prune_matched is not a boolean.
+    """
+    options = config[CONFIGURATION_SECTION]
+    # Every other option names a directory whose files should be collected.
+    categories = [options[x] for x in options if x not in crawl_rule_options]
+    exclude = list(filter(None, map(lambda x: x.strip(), options.get("exclude", "").split(","))))
+    max_depth = options.get("max_depth", "").strip()
+    prune_matched = options.get("prune_matched", "").strip()
+    return CrawlRules(categories, exclude, int(max_depth) if max_depth else None,
+                      bool(prune_matched) and options.getboolean("prune_matched"))
+
+
+def write_artifacts(path: str, file_name: str, config: configparser.ConfigParser,
+                    listing: List[Tuple[str, List[str]]], index: Dict[str, list]):
+    """
+    Populates the file list configuration file with the files of a crawl, then replaces the artifact catalog and the
+    directory index to match.
+
+    :param path: The location of the configuration file.
+    :param file_name: The name of the configuration file.
+    :param config: The configuration returned by get_crawl_config.
+    :param listing: The (directory path, file names) pairs of the crawled directories, in os.walk order.
+    :param index: The directory index of the crawled directories.
+    """
+    rules = get_crawl_rules(config)
+
+    # Collect {section: {file: [paths]}} first, both the file list and the artifact catalog are written from it.
+    artifacts = collections.OrderedDict()
+    matches = {}
+    for current_path, files in listing:
+        # Parents come before their subdirectories, only the part of the path below the parent is searched again.
+        parent = os.path.dirname(current_path)
+        if parent in matches:
+            found = rules.match(current_path, parent, matches[parent])
+        else:
+            found = rules.match(current_path)
+        matches[current_path] = found
+        if not found:
+            continue
+        for option_value in rules.categories:
+            if option_value in found:
+                # Create a new section if necessary, based on the CONFIGURATION section's option.
+                section = artifacts.setdefault(option_value, collections.OrderedDict())
+                # Add each file as the option's name and the file's path as the option's value.
+                # If there are multiple files with the same name, they all end up in the same option.
+                for file in files:
+                    if not rules.is_excluded(file):
+                        section.setdefault(config.optionxform(file), []).append(os.path.join(current_path, file))
+    for section, files in artifacts.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for file, paths in files.items():
+            # Multiple files with the same name are saved as a csv.
+            config.set(section, file, ", ".join(paths))
+    # Written aside and renamed so a build looked up in the meantime never reads a half written file list.
+    temp_path = os.path.join(path, file_name) + ".tmp"
+    with open(temp_path, "w") as config_file:
         config.write(config_file)
+    os.replace(temp_path, os.path.join(path, file_name))
+    config_cache.invalidate(os.path.join(path, file_name))
+    catalog.write_catalog(os.path.join(path, file_name), artifacts)
+    save_directory_index(get_directory_index(path, file_name), index)
+
+
+def get_directory_index(path: str = project_root, file_name: str = file_list_config_name) -> str:
+    """
+    Retrieves the path of the directory index kept next to a file list configuration file.
+
+    :param path: The location of the configuration file.
+    :param file_name: The name of the configuration file.
+    :return: The directory index file path.
+    """
+    return os.path.join(path, os.path.splitext(file_name)[0] + directory_index_suffix)
+
+
+def load_directory_index(index_path: str) -> Dict[str, list]:
+    """
+    Loads a directory index written by a previous crawl.
+
+    :param index_path: The full path to the directory index.
+    :return: A {directory: [mtime in ns, subdirectories, files]}, empty if the index is missing or unreadable.
+    """
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with contextlib.closing(sqlite3.connect("file:%s?mode=ro" % index_path, uri=True)) as connection:
+            rows = connection.execute("SELECT path, entry FROM directories")
+            index = {directory: json.loads(entry) for directory, entry in rows}
+    except (sqlite3.Error, ValueError):
+        # Also an index from before it was kept in SQLite, the next crawl lists everything again.
+        return {}
+    # Entries that still hold an entry count from older indexes are listed again.
+    return {directory: entry for directory, entry in index.items() if len(entry) == 3}
+
+
+def save_directory_index(index_path: str, index: Dict[str, list]):
+    """
+    Atomically replaces the directory index with a new one.
+
+    :param index_path: The full path to the directory index.
+    :param index: A {directory: [mtime in ns, subdirectories, files]}.
+    """
+    temp_path = index_path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    with contextlib.closing(sqlite3.connect(temp_path)) as connection:
+        connection.execute(_directory_index_schema)
+        connection.executemany("INSERT INTO directories VALUES (?, ?)",
+                               ((path, json.dumps(entry, separators=(",", ":"))) for path, entry in index.items()))
+        connection.commit()
+    os.replace(temp_path, index_path)
+
+
+def update_directory_index(index_path: str, entries: Dict[str, Optional[list]]) -> bool:
+    """
+    Changes the entries of a few directories of the directory index in place.
+
+    :param index_path: The full path to the directory index.
+    :param entries: The new entry of every directory that changed, None for a directory that is gone.
+    :return: True if the index was updated, False if it is missing or unreadable and must be saved from scratch.
+    """
+    if not os.path.exists(index_path):
+        return False
+    try:
+        with contextlib.closing(sqlite3.connect(index_path)) as connection:
+            connection.executemany("DELETE FROM directories WHERE path = ?",
+                                   ((x,) for x, entry in entries.items() if entry is None))
+            connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?)",
+                                   ((x, json.dumps(entry, separators=(",", ":")))
+                                    for x, entry in entries.items() if entry is not None))
+            connection.commit()
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def update_artifacts(path: str, file_name: str, previous_index: Dict[str, list], index: Dict[str, list],
+                     rules: CrawlRules) -> bool:
+    """
+    Brings the artifact catalog and the directory index up to date with the directories that changed between two
+    versions of the directory index, only their rows are rewritten. The file list itself is left as it is, readers
+    are answered from the catalog, see write_artifacts to rewrite it.
+
+    :param path: The location of the configuration file.
+    :param file_name: The name of the configuration file.
+    :param previous_index: The directory index the catalog matches, entries are replaced rather than changed when
+                           the index is updated so a shallow copy taken before the update does.
+    :param index: The updated directory index.
+    :param rules: The crawl rules the catalog was written with.
+    :return: True if the catalog and the directory index were updated. False if the catalog does not match the file
+             list any more, e.g. the file list was edited, write_artifacts must be used then.
+    """
+    optionxform = configparser.ConfigParser().optionxform
+    changed = {}
+    categories = []
+    orphaned = set()
+    removed = []
+    added = []
+    for directory in list(previous_index) + [x for x in index if x not in previous_index]:
+        before, after = previous_index.get(directory), index.get(directory)
+        if before is after:
+            continue
+        changed[directory] = after
+        old_files = [] if before is None else before[2]
+        new_files = [] if after is None else after[2]
+        found = rules.match(directory)
+        if after is not None and before is None:
+            categories.extend(x for x in rules.categories if x in found)
+        elif after is None:
+            orphaned.update(found)
+        # File names are unique within a directory, files that stay keep their place in the catalog.
+        kept = set(old_files) & set(new_files)
+        gone = [x for x in old_files if x not in kept]
+        new = [x for x in new_files if x not in kept]
+        for files, rows in [(gone, removed), (new, added)]:
+            for option_value in rules.categories:
+                if option_value in found:
+                    rows.extend((option_value, optionxform(x), os.path.join(directory, x))
+                                for x in files if not rules.is_excluded(x))
+    # A category whose last directory is gone is dropped, like a crawl would not find it at all.
+    for directory in index if orphaned else []:
+        orphaned -= rules.match(directory)
+        if not orphaned:
+            break
+    if not catalog.update_catalog(os.path.join(path, file_name), categories, removed, added, sorted(orphaned)):
+        return False
+    if not update_directory_index(get_directory_index(path, file_name), changed):
+        save_directory_index(get_directory_index(path, file_name), index)
+    return True
+
+
+def listing_from_index(tops: List[str], index: Dict[str, list],
+                       rules: CrawlRules = None) -> List[Tuple[str, List[str]]]:
+    """
+    Rebuilds the listing of a crawl from a directory index, without touching the file system.
+
+    :param tops: The directories that were crawled.
+    :param index: The directory index, holding every directory below the tops.
+    :param rules: The crawl rules deciding which directories are entered, None to enter every directory.
+    :return: The (directory path, file names) pairs in the order os.walk would produce them, directories missing from
+             the index are skipped along with everything below them.
+    """
+    rules = rules or CrawlRules([])
+    listing = []
+    pending = [(top, 0, None, frozenset()) for top in reversed(tops)]
+    while pending:
+        directory, depth, parent, parent_matches = pending.pop()
+        entry = index.get(directory)
+        if entry is None:
+            continue
+        listing.append((directory, entry[2]))
+        matches = rules.match(directory, parent, parent_matches)
+        pending.extend(reversed([(x, depth + 1, directory, matches)
+                                 for _, x in rules.subdirectories(directory, depth, matches, entry[1])]))
+    return listing
+
+
+def refresh_directories(directories: List[str], index: Dict[str, list], watch: Callable[[str], object] = None,
+                        tops: List[str] = None, rules: CrawlRules = None) -> bool:
+    """
+    Lists directories that are known to have changed again and updates the directory index in place. Subdirectories
+    that appeared are listed as well, the ones that disappeared are dropped from the index with everything below them.
+
+    :param directories: The directories to list again.
+    :param index: The directory index to update.
+    :param watch: Called with every directory before it is listed, so a change made while it is listed is not missed.
+    :param tops: The directories that were crawled, to know how deep the directories are.
+    :param rules: The crawl rules deciding which new subdirectories are entered, None to enter every directory.
+    :return: True if the index changed.
+    """
+    rules = rules or CrawlRules([])
+    trusted_before_ns = time.time_ns() - racy_mtime_window_ns
+    changed = False
+    pending = []
+    for directory in directories:
+        top = max(filter(lambda x: directory == x or directory.startswith(x.rstrip(os.sep) + os.sep), tops or []),
+                  key=len, default=directory)
+        depth = len(os.path.relpath(directory, top).split(os.sep)) if directory != top else 0
+        pending.append((directory, depth, rules.match(directory)))
+    while pending:
+        directory, depth, matches = pending.pop()
+        if watch is not None:
+            watch(directory)
+        try:
+            entry, _ = _scan_directory(directory, None, trusted_before_ns)
+        except OSError:
+            changed |= drop_directory(index, directory)
+            continue
+        previous = index.get(directory)
+        if previous is not None:
+            for name in set(previous[1]) - set(entry[1]):
+                drop_directory(index, os.path.join(directory, name))
+        pending.extend((x, depth + 1, rules.match(x, directory, matches))
+                       for _, x in rules.subdirectories(directory, depth, matches, entry[1]) if x not in index)
+        changed |= previous is None or previous[1:] != entry[1:]
+        index[directory] = entry
+    return changed
+
+
+def poll_directories(tops: List[str], index: Dict[str, list], workers: int = default_crawl_workers,
+                     rules: CrawlRules = None) -> bool:
+    """
+    Checks every directory below the tops for changes with a single stat call each, like an incremental crawl does,
+    and updates the directory index in place.
+
+    :param tops: The directories to check.
+    :param index: The directory index to update.
+    :param workers: The maximum number of directories checked at the same time.
+    :param rules: The crawl rules deciding which directories are entered, None to enter every directory.
+    :return: True if the index changed.
+    """
+    _, polled, _ = _walk_parallel(tops, workers, index, progress=False, rules=rules)
+    below = [x for x in index if any(x == top or x.startswith(top.rstrip(os.sep) + os.sep) for top in tops)]
+    removed = set(below) - set(polled)
+    for directory in removed:
+        del index[directory]
+    # A directory listed again because its modification time was too recent to trust may still hold the same entries.
+    changed = any(index.get(x) is None or index[x][1:] != entry[1:] for x, entry in polled.items())
+    index.update(polled)
+    return bool(changed or removed)
+
+
+def drop_directory(index: Dict[str, list], directory: str) -> bool:
+    """
+    Removes a directory and everything below it from a directory index.
+
+    :param index: The directory index to update.
+    :param directory: The directory that no longer exists.
+    :return: True if the index held the directory.
+    """
+    prefix = directory.rstrip(os.sep) + os.sep
+    below = [x for x in index if x == directory or x.startswith(prefix)]
+    for x in below:
+        del index[x]
+    return bool(below)
+
+
+def _scan_directory(path: str, cached: Optional[list], trusted_before_ns: int) -> Tuple[list, bool]:
+    """
+    Lists a single directory the same way os.walk does, reusing a cached listing if the directory has not changed.
+
+    :param path: The directory to list.
+    :param cached: The directory's entry from the previous directory index, or None.
+    :param trusted_before_ns: Modification times at or after this point are too recent to be trusted later on.
+    :return: The directory's new index entry [mtime in ns, subdirectories, files] and True if the directory had to be
+             listed again. Symbolic links to directories are left out of both lists since os.walk neither descends into
+             them nor reports them as files.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    if cached is not None and cached[0] == mtime:
+        return cached, False
+
+    dirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+                continue
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = False
+            if not is_symlink:
+                dirs.append(entry.name)
+    return [mtime if mtime < trusted_before_ns else None, dirs, files], True
+
+
+def _walk_parallel(tops: List[str], workers: int, previous_index: Dict[str, list], progress: bool = True,
+                   rules: CrawlRules = None) -> Tuple[List[Tuple[str, List[str]]], Dict[str, list], int]:
+    """
+    Walks several directory trees at the same time with a bounded pool of workers, each call to the pool lists a
+    single directory with os.scandir.
+
+    A directory's modification time only changes when its own entries do, so every directory is still checked with
+    a single stat call but only the changed ones are listed again.
+
+    :param tops: The directories to walk, a directory listed twice is walked twice.
+    :param workers: The maximum number of directories listed at the same time.
+    :param previous_index: The directory index of the previous crawl, may be empty.
+    :param progress: True to show a progress bar.
+    :param rules: The crawl rules deciding which directories are entered, None to enter every directory.
+    :return: The (directory path, file names) pairs in the exact order os.walk would have produced them one top
+             after another, the new directory index and the number of directories that were listed again.
+             Directories that cannot be listed are skipped, like os.walk does.
+    """
+    # Imported here so commands that never crawl start faster.
+    import tqdm
+
+    rules = rules or CrawlRules([])
+    # Every directory is keyed by the positions taken to reach it from its top, sorting on these keys gives back the
+    # top-down order of os.walk no matter in which order the workers finished.
+    listed = []
+    index = {}
+    relisted = 0
+    trusted_before_ns = time.time_ns() - racy_mtime_window_ns
+    completed = queue.Queue()
+    outstanding = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor, \
+            tqdm.tqdm(desc="Crawling", unit="dir", disable=not progress) as bar:
+        def submit(key: Tuple[int, ...], directory: str, matches: FrozenSet[str]):
+            future = executor.submit(_scan_directory, directory, previous_index.get(directory), trusted_before_ns)
+            future.add_done_callback(lambda f: completed.put((key, directory, matches, f)))
+
+        for position, top in enumerate(tops):
+            submit((position,), top, rules.match(top))
+            outstanding += 1
+        while outstanding:
+            key, directory, matches, future = completed.get()
+            outstanding -= 1
+            bar.update()
+            try:
+                entry, changed = future.result()
+            except OSError:
+                continue
+            index[directory] = entry
+            relisted += changed
+            listed.append((key, directory, entry[2]))
+            for position, subdirectory in rules.subdirectories(directory, len(key) - 1, matches, entry[1]):
+                submit(key + (position,), subdirectory, rules.match(subdirectory, directory, matches))
+                outstanding += 1
+    listed.sort(key=lambda x: x[0])
+    return [(directory, files) for _, directory, files in listed], index, relisted
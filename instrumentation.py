@@ -0,0 +1,396 @@
+import collections
+import contextlib
+import functools
+import io
+import math
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, OrderedDict, Tuple
+
+# The counters of /proc/self/io kept for every phase: bytes passed to read/write-like calls, the number of those
+# calls, and the bytes actually fetched from or sent to the storage layer.
+io_counters = ["rchar", "wchar", "syscr", "syscw", "read_bytes", "write_bytes"]
+# The number of functions and allocation sites listed by the profiles.
+profile_top = 20
+# Histogram buckets are powers of two of seconds, from about a microsecond up.
+_smallest_bucket = -20
+
+_lock = threading.Lock()
+_phases: OrderedDict[str, "PhaseStats"] = collections.OrderedDict()
+_histograms: OrderedDict[str, "Histogram"] = collections.OrderedDict()
+# The phases running on each thread, a phase entered again from inside itself (e.g. a recursive call) is only
+# measured once.
+_active = threading.local()
+_cpu_profiles = []
+_cpu_profiling = False
+# The memory profile taken when tracing stopped.
+_memory_snapshot: Optional[Dict] = None
+_started = time.time()
+
+
+class PhaseStats:
+    """
+    The totals of every run of a single phase.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.files = 0
+        # The number of bytes the phase handled, e.g. copied or hashed.
+        self.size = 0
+        self.io: Optional[Dict[str, int]] = None
+        # The highest memory use traced during a run of the phase, None unless memory profiling is on.
+        self.peak_memory: Optional[int] = None
+
+    def to_json(self) -> Dict:
+        return collections.OrderedDict([
+            ("calls", self.calls), ("seconds", self.seconds), ("cpu_seconds", self.cpu_seconds),
+            ("files", self.files), ("bytes", self.size),
+            ("files_per_second", self.files / self.seconds if self.seconds else None),
+            ("megabytes_per_second", self.size / self.seconds / 1024 / 1024 if self.seconds else None),
+            ("io", self.io), ("peak_memory", self.peak_memory)])
+
+
+class PhaseCounter:
+    """
+    Handed to the code running a phase to count what it handled.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, files: int = 0, size: int = 0):
+        """
+        Counts files and bytes handled by the phase, from any thread.
+
+        :param files: The number of files.
+        :param size: The number of bytes.
+        """
+        with self._lock:
+            self.files += files
+            self.size += size
+
+
+class Histogram:
+    """
+    A latency histogram with a bucket for every power of two of seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        # The bucket holds the latencies up to 2 ** exponent seconds.
+        exponent = max(_smallest_bucket, math.frexp(seconds)[1]) if seconds > 0 else _smallest_bucket
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def percentile(self, share: float) -> float:
+        """
+        Estimates a percentile of the latencies.
+
+        :param share: The percentile as a share, e.g. 0.99.
+        :return: The upper bound of the bucket the percentile falls in, in seconds, never more than the maximum.
+        """
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= share * self.count:
+                return min(2.0 ** exponent, self.maximum)
+        return self.maximum
+
+    def to_json(self) -> Dict:
+        return collections.OrderedDict([
+            ("count", self.count), ("mean", self.total / self.count if self.count else None),
+            ("p50", self.percentile(0.5)), ("p90", self.percentile(0.9)), ("p99", self.percentile(0.99)),
+            ("max", self.maximum),
+            # {upper bound in seconds: count}, the lower bound is half the upper bound.
+            ("buckets", collections.OrderedDict((str(2.0 ** x), self.buckets[x]) for x in sorted(self.buckets)))])
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[PhaseCounter]:
+    """
+    Measures a run of a phase: wall and CPU time, the process' I/O and what the phase counts. Phases running at the
+    same time on different threads share the process wide counters, I/O and CPU time of concurrent work are
+    attributed to each of them.
+
+    :param name: The phase's name, e.g. "copy".
+    :return: A context manager yielding a PhaseCounter for the phase to count its files and bytes.
+    """
+    running = _active.__dict__.setdefault("phases", set())
+    counter = PhaseCounter()
+    if name in running:
+        yield counter
+        return
+    running.add(name)
+    tracemalloc = sys.modules.get("tracemalloc")
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    io_before = read_io()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield counter
+    finally:
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        io_after = read_io()
+        running.discard(name)
+        with _lock:
+            stats = _phases.setdefault(name, PhaseStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.cpu_seconds += cpu_seconds
+            stats.files += counter.files
+            stats.size += counter.size
+            if io_before is not None and io_after is not None:
+                if stats.io is None:
+                    stats.io = collections.OrderedDict((x, 0) for x in io_counters)
+                for x in io_counters:
+                    stats.io[x] += io_after[x] - io_before[x]
+            if tracing and tracemalloc.is_tracing():
+                stats.peak_memory = max(stats.peak_memory or 0, tracemalloc.get_traced_memory()[1])
+
+
+def measured(name: str, count: Callable[[object], Tuple[int, int]] = None) -> Callable:
+    """
+    Decorates a function so every call is measured as a run of a phase.
+
+    :param name: The phase's name.
+    :param count: Turns the function's return value into the (files, bytes) it handled, None to count nothing.
+    :return: The decorator.
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name) as counter:
+                result = function(*args, **kwargs)
+                if count is not None:
+                    counter.add(*count(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def record_latency(name: str, seconds: float):
+    """
+    Adds a latency to a histogram, e.g. how long a single file took to copy.
+
+    :param name: The histogram's name, usually the phase's.
+    :param seconds: The latency.
+    """
+    with _lock:
+        _histograms.setdefault(name, Histogram()).add(seconds)
+
+
+def read_io() -> Optional[Dict[str, int]]:
+    """
+    Reads the I/O counters of the process.
+
+    :return: A {counter: value} of io_counters, None where /proc/self/io cannot be read, i.e. anywhere but Linux.
+    """
+    try:
+        with open("/proc/self/io", "r") as counters:
+            values = dict(line.split(":", 1) for line in counters if ":" in line)
+        return {x: int(values[x]) for x in io_counters}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def start_profiling(cpu: bool = False, memory: bool = False):
+    """
+    Turns on the profilers, their results are part of get_report() until reset() is called.
+
+    :param cpu: True to profile function calls with cProfile, on every thread started from now on as well.
+    :param memory: True to trace memory allocations with tracemalloc, which slows every allocation down.
+    """
+    global _cpu_profiling
+    if memory:
+        # Imported here since they slow down every command, profiled or not.
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    if cpu and not _cpu_profiling:
+        import cProfile
+        _cpu_profiling = True
+
+        def start_thread(*_):
+            # Called by the first profiling event of every new thread, which hands it over to a profiler of its own.
+            sys.setprofile(None)
+            if _cpu_profiling:
+                _start_cpu_profile(cProfile)
+        threading.setprofile(start_thread)
+        _start_cpu_profile(cProfile)
+
+
+def stop_profiling():
+    """
+    Turns off the profilers, what they recorded stays part of get_report() until reset() is called.
+    """
+    global _cpu_profiling
+    if _cpu_profiling:
+        _cpu_profiling = False
+        threading.setprofile(None)
+        # Only the calling thread's profiler can be disabled, the others stop with their threads.
+        _cpu_profiles[0].disable()
+    tracemalloc = sys.modules.get("tracemalloc")
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        _memory_profile()
+        tracemalloc.stop()
+
+
+def reset():
+    """
+    Drops everything recorded so far and turns off the profilers.
+    """
+    global _started, _memory_snapshot
+    stop_profiling()
+    with _lock:
+        _phases.clear()
+        _histograms.clear()
+        del _cpu_profiles[:]
+        _memory_snapshot = None
+        _started = time.time()
+
+
+def get_report() -> OrderedDict[str, object]:
+    """
+    Retrieves everything recorded since the start, or since the last reset().
+
+    :return: The totals of every phase and every latency histogram, in the order they were first recorded, and the
+             profiles if profiling was turned on.
+    """
+    with _lock:
+        report = collections.OrderedDict([
+            ("since", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_started))),
+            ("phases", collections.OrderedDict((k, v.to_json()) for k, v in _phases.items())),
+            ("latencies", collections.OrderedDict((k, v.to_json()) for k, v in _histograms.items()))])
+    if _cpu_profiles:
+        report["cpu_profile"] = _cpu_profile()
+    memory = _memory_profile()
+    if memory is not None:
+        report["memory_profile"] = memory
+    return report
+
+
+def format_report(report: Dict = None) -> str:
+    """
+    Formats a report for people to read.
+
+    :param report: The report returned by get_report(), None to get it now.
+    :return: The report as lines of text.
+    """
+    if report is None:
+        report = get_report()
+    lines = ["Performance report since %s:" % report["since"]]
+    if not report["phases"]:
+        lines.append("\tNothing was recorded yet.")
+    else:
+        lines.append("\t%-16s %6s %10s %10s %8s %10s %10s %10s %12s %12s" %
+                     ("Phase", "Calls", "Seconds", "CPU s", "Files", "Files/s", "MB", "MB/s", "Syscalls r/w",
+                      "Disk MB r/w"))
+    for name, stats in report["phases"].items():
+        io_stats = stats["io"]
+        lines.append("\t%-16s %6d %10.3f %10.3f %8d %10s %10.1f %10s %12s %12s" % (
+            name[:16], stats["calls"], stats["seconds"], stats["cpu_seconds"], stats["files"],
+            _format_rate(stats["files_per_second"]), stats["bytes"] / 1024 / 1024,
+            _format_rate(stats["megabytes_per_second"]),
+            "-" if io_stats is None else "%d/%d" % (io_stats["syscr"], io_stats["syscw"]),
+            "-" if io_stats is None else "%.0f/%.0f" % (io_stats["read_bytes"] / 1024 / 1024,
+                                                        io_stats["write_bytes"] / 1024 / 1024)))
+        if stats["peak_memory"] is not None:
+            lines.append("\t%-16s peak memory %.1f MB" % ("", stats["peak_memory"] / 1024 / 1024))
+    for name, histogram in report["latencies"].items():
+        lines.append("Per file %s latency, %d file(s): mean %s, p50 %s, p90 %s, p99 %s, max %s" % (
+            name, histogram["count"], _format_seconds(histogram["mean"]), _format_seconds(histogram["p50"]),
+            _format_seconds(histogram["p90"]), _format_seconds(histogram["p99"]), _format_seconds(histogram["max"])))
+        largest = max(histogram["buckets"].values(), default=0)
+        for bound, count in histogram["buckets"].items():
+            lines.append("\t<= %-10s %-40s %d" % (_format_seconds(float(bound)), "#" * max(1, 40 * count // largest),
+                                                 count))
+    if "cpu_profile" in report:
+        lines.append("Functions by cumulative time:")
+        for entry in report["cpu_profile"]:
+            lines.append("\t%10.3f s %10.3f s own %8d call(s)  %s" % (entry["cumulative_seconds"],
+                                                                    entry["own_seconds"], entry["calls"],
+                                                                    entry["function"]))
+    if "memory_profile" in report:
+        memory = report["memory_profile"]
+        lines.append("Memory: %.1f MB traced now, %.1f MB at the peak. Largest allocation sites:" %
+                     (memory["current"] / 1024 / 1024, memory["peak"] / 1024 / 1024))
+        for entry in memory["top"]:
+            lines.append("\t%10.1f KB %8d block(s)  %s" % (entry["size"] / 1024, entry["count"], entry["location"]))
+    return "\n".join(lines)
+
+
+def _start_cpu_profile(cprofile_module):
+    profile = cprofile_module.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12 and later only allow one profiler at a time, which already covers every thread.
+        return
+    with _lock:
+        _cpu_profiles.append(profile)
+
+
+def _cpu_profile() -> List[Dict]:
+    import pstats
+    # Only the collected numbers are used, keep anything pstats prints off the standard output.
+    stats = None
+    for profile in list(_cpu_profiles):
+        profile.create_stats()
+        if stats is None:
+            stats = pstats.Stats(profile, stream=io.StringIO())
+        else:
+            stats.add(profile)
+    if _cpu_profiling:
+        # create_stats() turned the calling thread's profiler off.
+        _cpu_profiles[0].enable()
+    entries = []
+    for (file_name, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+        entries.append(collections.OrderedDict([("function", "%s:%d(%s)" % (file_name, line, function)),
+                                                ("calls", calls), ("own_seconds", own),
+                                                ("cumulative_seconds", cumulative)]))
+    entries.sort(key=lambda x: x["cumulative_seconds"], reverse=True)
+    return entries[:profile_top]
+
+
+def _memory_profile() -> Optional[Dict]:
+    global _memory_snapshot
+    tracemalloc = sys.modules.get("tracemalloc")
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return _memory_snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics("lineno")[:profile_top]
+    _memory_snapshot = collections.OrderedDict([
+        ("current", current), ("peak", peak),
+        ("top", [collections.OrderedDict([("location", str(x.traceback)), ("size", x.size), ("count", x.count)])
+                 for x in top])])
+    return _memory_snapshot
+
+
+def _format_rate(rate: Optional[float]) -> str:
+    return "-" if rate is None else "%.1f" % rate
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return "%.0fus" % (seconds * 1e6)
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1e3)
+    return "%.2fs" % seconds
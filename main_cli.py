@@ -1,22 +1,33 @@
+import argparse
 import collections
 import configparser
+import datetime
+import json
 import os
 import shutil
+import sys
 from pathlib import Path
-from typing import List, Union, OrderedDict
+from typing import Dict, List, OrderedDict, Tuple, Union
 
 import build
+import build_store
 import copy
 import initialization
+import instrumentation
 import test_env
 
 
-def select_build() -> str:
+def select_build(prefetch: bool = False) -> str:
     """
     Reads, display, then allow the selection of a specific build from the configuration file.
 
+    :param prefetch: True to start fetching the files of the selected build into the staging cache while the
+                     selection is being confirmed, the prefetch is cancelled if it is not confirmed.
     :return: The selected build name, or None if no builds are available in the configuration file.
     """
+    if prefetch:
+        # Imported here so commands that never deploy start faster.
+        import staging_cache
     index = None
     selection = None
     sections = build.get_builds()
@@ -38,6 +49,9 @@ def select_build() -> str:
         try:
             options = build.get_options(initialization.get_config(), selection)
             display_entries(options)
+            cache = staging_cache.get_cache() if prefetch else None
+            if cache is not None:
+                staging_cache.prefetch(cache, [x[1] for x in build.build_paths(selection)[1]])
         except build.EmptySectionError:
             print("Section [%s] has no options!" % selection)
         except configparser.NoSectionError:
@@ -45,8 +59,9 @@ def select_build() -> str:
         confirm = input("Enter 'y/Y' to confirm selection: ")
         if confirm in ["y", "Y"]:
             break
-        else:
-            index = None
+        if prefetch:
+            staging_cache.cancel_prefetches()
+        index = None
     return selection
 
 
@@ -80,6 +95,52 @@ def display_entries(entries: Union[List[str], OrderedDict[str, str]], numbered:
                 print("\t", text.ljust(20), "=", v)
 
 
+def display_copy_results(results: List[copy.CopyResult]):
+    """
+    Prints a summary of a copy, listing every file that could not be copied.
+
+    :param results: The results returned by copy.copy_files.
+    """
+    failed = list(filter(lambda x: x.error, results))
+    copied = list(filter(lambda x: x.stats, results))
+    transferred = sum(map(lambda x: x.stats.transferred, copied))
+    print("\nCopied %d of %d file(s), %d byte(s) transferred, %d byte(s) skipped." %
+          (len(copied), len(results), transferred, sum(map(lambda x: x.size, copied)) - transferred))
+    reused = sum(map(lambda x: x.stats.reused, filter(lambda x: x.stats and x.stats.strategy == "delta", copied)))
+    delta_size = sum(map(lambda x: x.size, filter(lambda x: x.stats and x.stats.strategy == "delta", copied)))
+    if delta_size:
+        print("Delta copies reused %.1f%% of their blocks." % (100.0 * reused / delta_size))
+    holes = sum(map(lambda x: x.stats.holes, copied))
+    if holes:
+        print("%d byte(s) of holes in sparse files were skipped." % holes)
+    resumed = sum(map(lambda x: x.stats.resumed, copied))
+    if resumed:
+        print("%d byte(s) were taken over from interrupted copies." % resumed)
+    for result in failed:
+        print("\t Copy failed for %s: %s" % (result.source, result.error))
+
+
+def display_plan(plan: "planner.DeployPlan"):
+    """
+    Prints what a deploy will copy, and whether it fits at the destination.
+
+    :param plan: The plan returned by planner.plan_deploy.
+    """
+    print("\nDeploying to %s:" % plan.destination_directory)
+    for section, totals in plan.categories.items():
+        print("\t", section.ljust(20), "%d file(s), %d byte(s), %d byte(s) on disk, %d byte(s) to copy" %
+              (totals.files, totals.logical, totals.allocated, totals.transfer))
+    for result in filter(None, plan.results):
+        print("\t Cannot copy %s: %s" % (result.source, result.error))
+    for space in plan.space:
+        print("%d byte(s) needed on %s, %d byte(s) free." % (space.needed, space.path, space.free))
+    if plan.estimated_seconds is None:
+        print("%d byte(s) to copy, no previous deploy to estimate the time from." % plan.transfer)
+    else:
+        print("%d byte(s) to copy, estimated time %s." %
+              (plan.transfer, datetime.timedelta(seconds=round(plan.estimated_seconds))))
+
+
 def get_new_build_option() -> OrderedDict[str, str]:
     """
     Create an ordered dictionary from user's input.
@@ -165,7 +226,290 @@ def is_value_valid_int(value: str, maximum: int) -> bool:
         return False
 
 
-def main():
+def parse_arguments(argv: List[str]) -> argparse.Namespace:
+    """
+    Parses the arguments of the non-interactive commands.
+
+    :param argv: The command line arguments, without the program name.
+    :return: The parsed arguments, the command name is in "command".
+    """
+    parser = argparse.ArgumentParser(prog="main_cli", description="Deploy builds without the interactive menu, "
+                                                                  "every command prints its result as JSON.")
+    parser.add_argument("--init", action="store_true",
+                        help="Reinitialize config.ini and file-list.ini and crawl before running the command.")
+    parser.add_argument("--report", action="store_true",
+                        help="Add the time, I/O and throughput of every phase of the command to its result.")
+    parser.add_argument("--profile", choices=["cpu", "memory", "all"],
+                        help="Profile function calls (cProfile), memory allocations (tracemalloc) or both, and add "
+                             "the profiles to the report. Implies --report.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    deploy = commands.add_parser("deploy", help="Copy the files of a build.")
+    deploy.add_argument("build", help="The build name.")
+    output = deploy.add_mutually_exclusive_group(required=True)
+    output.add_argument("--dest", nargs="+", help="The location(s) where the files will be copied to, every file "
+                                                  "is read once for all of them.")
+    output.add_argument("--archive", help="Stream the files into this tar archive instead, \"-\" for the standard "
+                                          "output. The JSON result then goes to the standard error.")
+    deploy.add_argument("--compress", choices=["gzip", "xz", "zstd"],
+                        help="Compress the archive, zstd needs the zstandard package.")
+    deploy.add_argument("--level", type=int, help="The compression level.")
+    deploy.add_argument("--compress-jobs", type=int,
+                        help="The number of archive blocks compressed at a time, defaults to the number of CPUs.")
+    deploy.add_argument("--jobs", type=int, default=copy.default_workers, help="The number of files copied at a time.")
+    deploy.add_argument("--device-jobs", type=int, default=copy.default_per_device_workers,
+                        help="The number of files copied at a time between the same pair of devices.")
+    deploy.add_argument("--no-sync", action="store_true", help="Copy files even if they are already up to date.")
+    deploy.add_argument("--compare-contents", action="store_true", help="Also compare contents when syncing.")
+    deploy.add_argument("--delta", action="store_true", help="Only rewrite the blocks that changed.")
+    deploy.add_argument("--digest", help="Hash the files while copying (e.g. sha256) and write a manifest.")
+    deploy.add_argument("--dedup", action="store_true", help="Link identical files instead of copying them again.")
+    deploy.add_argument("--no-cache", action="store_true",
+                        help="Read every file from the repository even if a staging cache is configured.")
+    deploy.add_argument("--dry-run", action="store_true", help="Only print what would be copied.")
+    deploy.add_argument("--force", action="store_true", help="Copy even if the destination looks too small.")
+
+    diff = commands.add_parser("diff", help="List the files added, removed, changed and unchanged between two builds.")
+    diff.add_argument("old", help="The build deployed now.")
+    diff.add_argument("new", help="The build to deploy.")
+    diff.add_argument("--no-compare-contents", action="store_true",
+                      help="Compare modification times instead of contents of same sized files.")
+    diff.add_argument("--dest", help="A deployment of the old build, files that differ from it count as changed.")
+
+    upgrade_command = commands.add_parser("upgrade", help="Turn a deployment of one build into one of another, "
+                                                          "copying only what changed and removing stale files.")
+    upgrade_command.add_argument("old", help="The build the destination holds now.")
+    upgrade_command.add_argument("new", help="The build the destination should hold.")
+    upgrade_command.add_argument("--dest", required=True, help="The location holding the deployment.")
+    upgrade_command.add_argument("--jobs", type=int, default=copy.default_workers,
+                                 help="The number of files copied at a time.")
+    upgrade_command.add_argument("--device-jobs", type=int, default=copy.default_per_device_workers,
+                                 help="The number of files copied at a time between the same pair of devices.")
+    upgrade_command.add_argument("--no-compare-contents", action="store_true",
+                                 help="Compare modification times instead of contents of same sized files.")
+    upgrade_command.add_argument("--dry-run", action="store_true", help="Only print what would change.")
+    upgrade_command.add_argument("--force", action="store_true", help="Copy even if the destination looks too small.")
+
+    crawl = commands.add_parser("crawl", help="Rebuild file-list.ini.")
+    crawl.add_argument("--full", action="store_true", help="List every directory again instead of only changed ones.")
+
+    watch = commands.add_parser("watch", help="Keep file-list.ini up to date as files come and go, until interrupted. "
+                                              "Every update is reported on the standard error.")
+    watch.add_argument("--poll-interval", type=float,
+                       help="The number of seconds between two checks of directories that cannot be watched, "
+                            "30 by default.")
+    watch.add_argument("--poll-only", action="store_true", help="Check every directory by polling.")
+
+    listing = commands.add_parser("list", help="List the builds, or the options and files of a build.")
+    listing.add_argument("build", nargs="?", help="The build name.")
+
+    add = commands.add_parser("add", help="Add a build.")
+    add.add_argument("build", help="The new build's name.")
+    add.add_argument("options", nargs="*", metavar="OPTION=FILES",
+                     help="The build's options, e.g. firmware=\"test_1.1, test_1.2\".")
+
+    remove = commands.add_parser("remove", help="Remove a build.")
+    remove.add_argument("build", help="The build name.")
+
+    export = commands.add_parser("export", help="Write config.ini with every pending build change folded in.")
+    export.add_argument("output", nargs="?", default="-",
+                        help="The file to write, \"-\" for the standard output. The JSON result then goes to the "
+                             "standard error.")
+
+    verify = commands.add_parser("verify", help="Check a destination against its manifest.")
+    verify.add_argument("dest", help="The location the files were copied to.")
+    verify.add_argument("--jobs", type=int, help="The number of files hashed at a time, 4 by default.")
+    return parser.parse_args(argv)
+
+
+def run_command(arguments: argparse.Namespace) -> Tuple[bool, Dict]:
+    """
+    Runs a non-interactive command.
+
+    :param arguments: The arguments returned by parse_arguments.
+    :return: True if the command succeeded, and its JSON serializable result.
+    """
+    # The modules of the commands are imported here, so commands that never copy, archive or watch start faster.
+    if arguments.init:
+        initialization.initialize()
+    if arguments.command == "deploy":
+        skipped_options, files = build.build_paths(arguments.build)
+        if arguments.archive:
+            import archive
+            results = archive.write_archive(files, arguments.archive, arguments.compress, arguments.level,
+                                            arguments.compress_jobs or archive.default_workers)
+            return all(map(lambda x: not x.error, results)), {"build": arguments.build, "skipped": skipped_options,
+                                                              "files": [_copy_result_to_json(x) for x in results]}
+        file_list = build.get_options(initialization.get_config(), initialization.CONFIGURATION_SECTION)[
+            initialization.file_list_config_name]
+        import planner
+        import staging_cache
+        plans = [planner.plan_deploy(files, x, sync=not arguments.no_sync, copy_workers=arguments.jobs)
+                 for x in arguments.dest]
+        result = {"build": arguments.build, "skipped": skipped_options}
+        if len(plans) == 1:
+            result["plan"] = _plan_to_json(plans[0])
+        else:
+            result["plans"] = collections.OrderedDict((x.destination_directory, _plan_to_json(x)) for x in plans)
+        fits = all(map(lambda x: x.fits, plans))
+        if arguments.dry_run:
+            return fits, result
+        if not fits and not arguments.force:
+            result["error"] = "Not enough free space at the destination, use --force to copy anyway."
+            return False, result
+        cache = None if arguments.no_cache else staging_cache.get_cache()
+        sources = None
+        if cache is not None:
+            sources = staging_cache.stage_plans(cache, plans)
+            result["staged"] = len(sources)
+        if len(plans) == 1:
+            results = planner.execute_plan(plans[0], workers=arguments.jobs, per_device_workers=arguments.device_jobs,
+                                           compare_contents=arguments.compare_contents, delta=arguments.delta,
+                                           digest=arguments.digest, dedup=arguments.dedup, file_list=file_list,
+                                           sources=sources)
+            result["files"] = [_copy_result_to_json(x) for x in results]
+            return all(map(lambda x: not x.error, results)), result
+        # The sources are read once for every destination, the first plan's stats serve them all.
+        copies = copy.copy_files(files, arguments.dest, workers=arguments.jobs,
+                                 per_device_workers=arguments.device_jobs, sync=not arguments.no_sync,
+                                 compare_contents=arguments.compare_contents, digest=arguments.digest,
+                                 prepared=(plans[0].jobs, plans[0].results), sources=sources)
+        result["destinations"] = collections.OrderedDict(
+            (k, [_copy_result_to_json(x) for x in v]) for k, v in copies.items())
+        return all(map(lambda x: not x.error, [x for v in copies.values() for x in v])), result
+    elif arguments.command in ["diff", "upgrade"]:
+        import planner
+        import upgrade
+        file_list = build.get_options(initialization.get_config(), initialization.CONFIGURATION_SECTION)[
+            initialization.file_list_config_name]
+        build_diff = upgrade.diff_builds(arguments.old, arguments.new,
+                                         compare_contents=not arguments.no_compare_contents, file_list=file_list,
+                                         destination_directory=getattr(arguments, "dest", None))
+        result = _diff_to_json(build_diff)
+        if arguments.command == "diff":
+            return True, result
+        plan = planner.plan_deploy(upgrade.upgrade_files(build_diff), arguments.dest, sync=False,
+                                   copy_workers=arguments.jobs)
+        result["plan"] = _plan_to_json(plan)
+        if arguments.dry_run:
+            return plan.fits, result
+        if not plan.fits and not arguments.force:
+            result["error"] = "Not enough free space at the destination, use --force to copy anyway."
+            return False, result
+        outcome = upgrade.upgrade(build_diff, arguments.dest, plan, arguments.jobs, arguments.device_jobs, file_list)
+        result["files"] = [_copy_result_to_json(x) for x in outcome.copies]
+        result["removals"] = [x._asdict() for x in outcome.removals]
+        return all(map(lambda x: not x.error, outcome.copies + outcome.removals)), result
+    elif arguments.command == "crawl":
+        visited, relisted = initialization.crawl_system(incremental=not arguments.full)
+        return True, {"directories": visited, "listed": relisted}
+    elif arguments.command == "watch":
+        import watcher
+        updates = []
+
+        def report(update: watcher.WatchUpdate):
+            updates.append(update)
+            print(json.dumps(update._asdict()), file=sys.stderr, flush=True)
+
+        try:
+            watcher.watch(on_update=report, poll_interval=arguments.poll_interval or watcher.default_poll_interval,
+                          poll_only=arguments.poll_only)
+        except KeyboardInterrupt:
+            pass
+        return True, {"updates": len(updates)}
+    elif arguments.command == "list":
+        if arguments.build is None:
+            return True, {"builds": build.get_builds()}
+        skipped_options, files = build.build_paths(arguments.build)
+        return True, {"build": arguments.build, "options": build.get_options(initialization.get_config(),
+                                                                             arguments.build),
+                      "skipped": skipped_options, "files": [{"section": x[0], "path": x[1]} for x in files]}
+    elif arguments.command == "add":
+        if arguments.build in build.get_builds():
+            return False, {"error": "The build [%s] already exists!" % arguments.build}
+        options = collections.OrderedDict()
+        for option in arguments.options:
+            key, separator, value = option.partition("=")
+            if not separator or not key.strip():
+                return False, {"error": "Invalid option [%s], expected OPTION=FILES." % option}
+            options[key.strip()] = value.strip()
+        build.add_new_build(arguments.build, options)
+        return True, {"build": arguments.build, "options": options}
+    elif arguments.command == "remove":
+        if arguments.build not in build.get_builds():
+            return False, {"error": "The build [%s] does not exist!" % arguments.build}
+        build.remove_build(arguments.build)
+        return True, {"build": arguments.build}
+    elif arguments.command == "export":
+        if arguments.output == "-":
+            builds = build_store.export(initialization.get_config(), sys.stdout)
+        else:
+            temp_path = arguments.output + ".tmp"
+            with open(temp_path, "w") as output_file:
+                builds = build_store.export(initialization.get_config(), output_file)
+            os.replace(temp_path, arguments.output)
+        return True, {"output": arguments.output, "sections": builds}
+    elif arguments.command == "verify":
+        import manifest
+        results = manifest.verify_manifest(arguments.dest, arguments.jobs or manifest.default_workers)
+        return all(map(lambda x: x.ok, results)), {"files": [x._asdict() for x in results]}
+
+
+def _copy_result_to_json(result: copy.CopyResult) -> Dict:
+    entry = result._asdict()
+    entry["stats"] = result.stats._asdict() if result.stats else None
+    return entry
+
+
+def _diff_to_json(build_diff: "upgrade.BuildDiff") -> Dict:
+    import upgrade
+    result = collections.OrderedDict([("old", build_diff.old_build), ("new", build_diff.new_build),
+                                      ("old_skipped", build_diff.old_skipped),
+                                      ("new_skipped", build_diff.new_skipped)])
+    for status in [upgrade.added_status, upgrade.removed_status, upgrade.changed_status, upgrade.unchanged_status]:
+        result[status] = [collections.OrderedDict([("name", x.name), ("old", x.old_source), ("new", x.new_source),
+                                                   ("size", x.size)]) for x in build_diff.of(status)]
+    return result
+
+
+def _plan_to_json(plan: "planner.DeployPlan") -> Dict:
+    return {"categories": collections.OrderedDict((k, v._asdict()) for k, v in plan.categories.items()),
+            "space": [x._asdict() for x in plan.space], "fits": plan.fits, "transfer": plan.transfer,
+            "estimated_seconds": plan.estimated_seconds}
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Runs the command given on the command line, or the interactive menu if there is none.
+
+    :param argv: The command line arguments, without the program name. Defaults to sys.argv.
+    :return: The exit code.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        menu()
+        return 0
+    arguments = parse_arguments(argv)
+    if arguments.profile:
+        instrumentation.start_profiling(cpu=arguments.profile in ["cpu", "all"],
+                                        memory=arguments.profile in ["memory", "all"])
+    try:
+        ok, result = run_command(arguments)
+    except (configparser.Error, build.EmptySectionError, KeyError, OSError, ValueError) as e:
+        ok, result = False, {"error": str(e) or type(e).__name__}
+    finally:
+        instrumentation.stop_profiling()
+    result = collections.OrderedDict([("command", arguments.command), ("ok", ok)] + list(result.items()))
+    if arguments.report or arguments.profile:
+        result["report"] = instrumentation.get_report()
+    # The standard output may be carrying an archive or an exported configuration.
+    to_stderr = "-" in [getattr(arguments, "archive", None), getattr(arguments, "output", None)]
+    print(json.dumps(result, indent=2), file=sys.stderr if to_stderr else sys.stdout)
+    return 0 if ok else 1
+
+
+def menu():
     # TESTING
     test_env.create_test_storage_environment()
     initialization.initialize()
@@ -178,9 +522,7 @@ def main():
         print("\t4). Edit a build.")
         print("\t5). Cherry-pick from build.")
         print("\t6). Rebuild file-list.ini.")
-        # Will try to associate files to build options and print
-        # what's not being used as well as what files are missing for a build.
-        print("\t7). Print report (Not implemented yet).")
+        print("\t7). Print report.")
         print("\t8). Print verbose tree structure (Not implemented yet).")
         print("\t9). Reset test environment.")
         print("\t0). Exit.")
@@ -188,8 +530,10 @@ def main():
             selection = input("Enter a number: ")
             if selection == "1":
                 # Select a build.
-                selected_build = select_build()
+                selected_build = select_build(prefetch=True)
                 if selected_build:
+                    import planner
+                    import staging_cache
                     skipped_options, files = build.build_paths(selected_build)
                     if skipped_options:
                         print("\n*WARNING* File association does not exist in [%s] for the following" 
@@ -202,7 +546,25 @@ def main():
                     print("Copying the following files to %s:" % destination)
                     for file in files:
                         print("\t %s" % file[1])
-                    copy.copy_files(files, destination)
+                    plan = planner.plan_deploy(files, destination)
+                    display_plan(plan)
+                    if not plan.fits:
+                        print("\n*WARNING* There is not enough free space at the destination for this build!")
+                    confirm = input("Enter 'y/Y' to start copying: ")
+                    if confirm in ["y", "Y"]:
+                        file_list = build.get_options(initialization.get_config(),
+                                                      initialization.CONFIGURATION_SECTION)[
+                            initialization.file_list_config_name]
+                        cache = staging_cache.get_cache()
+                        sources = staging_cache.stage_plans(cache, [plan]) if cache is not None else None
+                        # Hashing the whole build for dedup saves nothing on a first deploy.
+                        reuse = planner.has_previous_deploy(plan)
+                        results = planner.execute_plan(plan, workers=copy.default_workers, delta=reuse, dedup=reuse,
+                                                       file_list=file_list, sources=sources)
+                        display_copy_results(results)
+                    else:
+                        staging_cache.cancel_prefetches()
+                        print("Aborting operation.")
             elif selection == "2":
                 # Remove a build.
                 selected_build = select_build()
@@ -262,12 +624,17 @@ def main():
                         print("Copying the following files to %s:" % destination)
                         for file in filtered_files:
                             print("\t %s" % file[1])
-                        copy.copy_files(filtered_files, destination)
+                        results = copy.copy_files(filtered_files, destination, sync=True, delta=True)
+                        display_copy_results(results)
                     else:
                         print("Could not located the file associated with the selected option [%s]..." % selection)
             elif selection == "6":
                 # initialization.create_file_list_config()
-                initialization.crawl_system()
+                visited, relisted = initialization.crawl_system(incremental=True)
+                print("Re-listed %d of %d directories." % (relisted, visited))
+            elif selection == "7":
+                # Where the time went since the menu started.
+                print(instrumentation.format_report())
             elif selection == "9":
                 shutil.rmtree(initialization.project_root)
                 shutil.rmtree(os.path.join(os.path.abspath(os.sep), "file-picker-dev1"))
@@ -287,4 +654,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # Content hashing uses a process pool, which needs this in a PyInstaller executable. It must run first thing,
+    # the pool's worker processes start the executable again and are taken over here.
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
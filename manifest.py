@@ -0,0 +1,173 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import instrumentation
+
+manifest_name = "manifest.json"
+buffer_size = 1024 * 1024
+default_workers = 4
+
+
+class VerifyResult(NamedTuple):
+    """
+    The outcome of checking a single file against a manifest.
+    """
+    # The file's path, relative to the destination.
+    path: str
+    ok: bool
+    # Why the file does not match, None if it does.
+    error: Optional[str]
+
+
+def get_manifest(destination_directory: str) -> str:
+    """
+    Retrieves the path of the manifest of a destination.
+
+    :param destination_directory: The location the files were copied to.
+    :return: The manifest path.
+    """
+    return os.path.join(destination_directory, manifest_name)
+
+
+def file_digest(path: str, algorithm: str = "blake2b") -> str:
+    """
+    Computes the digest of a file's contents.
+
+    :param path: The absolute path of the file.
+    :param algorithm: The hashlib algorithm to use.
+    :return: The hexadecimal digest.
+    """
+    digest = hashlib.new(algorithm)
+    file_in = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        for x in iter(lambda: os.read(file_in, buffer_size), b''):
+            digest.update(x)
+    finally:
+        os.close(file_in)
+    return digest.hexdigest()
+
+
+def load_manifest(destination_directory: str) -> Optional[Dict]:
+    """
+    Loads the manifest of a destination.
+
+    :param destination_directory: The location the files were copied to.
+    :return: {"algorithm": name, "files": {relative path: {"size": bytes, "mtime": ns, "digest": hex}}}, or None if
+             the destination has no readable manifest.
+    """
+    try:
+        with open(get_manifest(destination_directory), "r") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(destination_directory: str, algorithm: str, entries: List[Tuple[str, int, Optional[str]]],
+                   workers: int = default_workers, merge: bool = True):
+    """
+    Atomically writes the manifest of a destination.
+
+    Files without a digest (e.g. skipped by a sync) take theirs from the previous manifest if the file still has the
+    size and modification time recorded there, otherwise the copy at the destination is hashed.
+
+    :param destination_directory: The location the files were copied to.
+    :param algorithm: The hashlib algorithm of the digests.
+    :param entries: An (absolute destination path, size, digest or None) for every file.
+    :param workers: The number of files hashed at the same time.
+    :param merge: True to keep the files of the previous manifest that are not in entries, e.g. after copying only
+                  some files into the destination. Kept files listed with another algorithm are hashed again if they
+                  still exist. False to list only the entries.
+    """
+    previous = load_manifest(destination_directory)
+    kept = {}
+    if merge and previous is not None:
+        listed = set(map(lambda x: _relative_path(destination_directory, x[0]), entries))
+        if previous.get("algorithm") == algorithm:
+            kept = {k: v for k, v in previous["files"].items() if k not in listed}
+        else:
+            entries = list(entries)
+            for relative_path in previous["files"]:
+                path = os.path.join(destination_directory, *relative_path.split("/"))
+                if relative_path not in listed and os.path.isfile(path):
+                    entries.append((path, os.stat(path).st_size, None))
+    if previous is None or previous.get("algorithm") != algorithm:
+        previous = {"files": {}}
+
+    def describe(entry: Tuple[str, int, Optional[str]]) -> Tuple[str, Dict]:
+        path, size, digest = entry
+        relative_path = _relative_path(destination_directory, path)
+        mtime = os.stat(path).st_mtime_ns
+        if digest is None:
+            known = previous["files"].get(relative_path)
+            if known is not None and (known["size"], known["mtime"]) == (size, mtime):
+                digest = known["digest"]
+            else:
+                digest = file_digest(path, algorithm)
+        return relative_path, {"size": size, "mtime": mtime, "digest": digest}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        files = dict(executor.map(describe, entries))
+    files.update(kept)
+    temp_path = get_manifest(destination_directory) + ".tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump({"algorithm": algorithm, "files": files}, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_path, get_manifest(destination_directory))
+
+
+def verify_manifest(destination_directory: str, workers: int = default_workers) -> List[VerifyResult]:
+    """
+    Checks every file of a destination against its manifest, several files at a time.
+
+    :param destination_directory: The location the files were copied to.
+    :param workers: The number of files hashed at the same time.
+    :return: A VerifyResult for every file in the manifest, sorted by path. Raises a FileNotFoundError if the
+             destination has no readable manifest.
+    """
+    manifest = load_manifest(destination_directory)
+    if manifest is None:
+        raise FileNotFoundError("No manifest in %s!" % destination_directory)
+
+    def verify(item: Tuple[str, Dict]) -> VerifyResult:
+        relative_path, expected = item
+        path = os.path.join(destination_directory, *relative_path.split("/"))
+        start = time.perf_counter()
+        try:
+            size = os.stat(path).st_size
+            if size != expected["size"]:
+                return VerifyResult(relative_path, False, "size is %d instead of %d" % (size, expected["size"]))
+            digest = file_digest(path, manifest["algorithm"])
+            counter.add(1, size)
+            if digest != expected["digest"]:
+                return VerifyResult(relative_path, False, "digest mismatch")
+            return VerifyResult(relative_path, True, None)
+        except os.error as e:
+            return VerifyResult(relative_path, False, str(e))
+        finally:
+            instrumentation.record_latency("verify", time.perf_counter() - start)
+
+    with instrumentation.phase("verify") as counter:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(verify, sorted(manifest["files"].items())))
+
+
+def _relative_path(destination_directory: str, path: str) -> str:
+    # Manifests always use forward slashes so they can be checked from another platform.
+    return os.path.relpath(path, destination_directory).replace(os.sep, "/")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify a destination against its manifest.")
+    parser.add_argument("destination", help="The location the files were copied to.")
+    parser.add_argument("--jobs", type=int, default=default_workers, help="The number of files hashed at a time.")
+    arguments = parser.parse_args()
+    results = verify_manifest(arguments.destination, arguments.jobs)
+    for result in filter(lambda x: not x.ok, results):
+        print("%s: %s" % (result.path, result.error))
+    print("%d of %d file(s) verified." % (len(list(filter(lambda x: x.ok, results))), len(results)))
+    sys.exit(0 if all(map(lambda x: x.ok, results)) else 1)
@@ -0,0 +1,236 @@
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, NamedTuple, Optional, OrderedDict, Tuple
+
+import copy
+import initialization
+import instrumentation
+import manifest
+
+history_name = "throughput.json"
+# The number of previous runs the transfer time estimate is based on.
+history_length = 20
+# Runs that transferred less than this are dominated by per-file overhead and say little about throughput.
+history_minimum_bytes = 64 * 1024 * 1024
+# Stat'ing is bound by metadata latency on network mounts rather than CPU, so oversubscribe the cores.
+default_stat_workers = min(32, (os.cpu_count() or 1) * 4)
+
+
+class CategoryTotals(NamedTuple):
+    """
+    The size of the files of a single category (file list section) of a deploy.
+    """
+    files: int
+    # The sum of the file sizes.
+    logical: int
+    # The number of bytes the files take on disk, less than logical if some are sparse.
+    allocated: int
+    # The number of bytes of data (holes excluded) of the files that are not already up to date at the destination.
+    transfer: int
+
+
+class DeviceSpace(NamedTuple):
+    """
+    The room a deploy needs on a single destination device.
+    """
+    # The existing directory the free space was measured on.
+    path: str
+    needed: int
+    free: int
+
+
+class DeployPlan(NamedTuple):
+    """
+    Everything a deploy will do, worked out without writing anything. Run it with execute_plan.
+    """
+    files: List[Tuple[str, str]]
+    destination_directory: str
+    sync: bool
+    jobs: List[copy.CopyJob]
+    # One slot per file, holding a failed CopyResult for every file that could not be stat'ed.
+    results: List[Optional[copy.CopyResult]]
+    categories: OrderedDict[str, CategoryTotals]
+    space: List[DeviceSpace]
+    # The number of bytes that will actually be copied.
+    transfer: int
+    # The estimated number of seconds the copy takes, None if there is no previous run to base it on.
+    estimated_seconds: Optional[float]
+
+    @property
+    def fits(self) -> bool:
+        return all(map(lambda x: x.needed <= x.free, self.space))
+
+
+@instrumentation.measured("planning",
+                          lambda x: (len(x.jobs), sum(map(lambda y: y.logical, x.categories.values()))))
+def plan_deploy(file_name: List[Tuple[str, str]], destination_directory: str, sync: bool = True,
+                workers: int = default_stat_workers, copy_workers: int = copy.default_workers) -> DeployPlan:
+    """
+    Stats every file of a deploy and the destination, several files at a time, to total what the deploy will copy.
+
+    :param file_name: The files in (section name, absolute path) tuple pair to be copied.
+    :param destination_directory: The location where the files will be copied to, it does not have to exist yet.
+    :param sync: True if files already at the destination with the same size and modification time will be skipped.
+    :param workers: The number of files stat'ed at the same time.
+    :param copy_workers: The number of files that will be copied at the same time.
+    :return: The plan of the deploy.
+    """
+    jobs, results = copy.prepare_jobs(file_name, destination_directory, workers)
+
+    def existing_size(job: copy.CopyJob) -> Tuple[bool, int]:
+        if sync and copy.is_unchanged(job):
+            return True, 0
+        try:
+            return False, copy.allocated_size(os.stat(job.destination))
+        except os.error:
+            return False, 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        existing = list(executor.map(existing_size, jobs))
+
+    categories = collections.OrderedDict((section, CategoryTotals(0, 0, 0, 0)) for section, _ in file_name)
+    needed = collections.OrderedDict()
+    replaced = collections.OrderedDict()
+    paths = {}
+    for job, (unchanged, replaced_size) in zip(jobs, existing):
+        totals = categories[job.section]
+        categories[job.section] = CategoryTotals(totals.files + 1, totals.logical + job.size,
+                                                 totals.allocated + job.allocated,
+                                                 totals.transfer + (0 if unchanged else min(job.size, job.allocated)))
+        if not unchanged:
+            # The copy replaces the previous file only once it is complete, so both are on disk in the meantime.
+            needed[job.destination_device] = needed.get(job.destination_device, 0) + job.allocated - replaced_size
+            replaced.setdefault(job.destination_device, []).append(replaced_size)
+            if job.destination_device not in paths:
+                paths[job.destination_device] = copy.nearest_existing_directory(os.path.dirname(job.destination))
+
+    space = []
+    for device, path in paths.items():
+        # At most one previous file per worker is still on disk next to its replacement at any time.
+        overlap = sum(sorted(replaced[device], reverse=True)[:max(1, copy_workers)])
+        space.append(DeviceSpace(path, max(0, needed[device]) + overlap, shutil.disk_usage(path).free))
+
+    transfer = sum(map(lambda x: x.transfer, categories.values()))
+    estimated_seconds = 0.0
+    if transfer:
+        throughput = get_throughput(destination_directory)
+        estimated_seconds = transfer / throughput if throughput else None
+    return DeployPlan(file_name, destination_directory, sync, jobs, results, categories, space, transfer,
+                      estimated_seconds)
+
+
+def execute_plan(plan: DeployPlan, workers: int = copy.default_workers,
+                 per_device_workers: int = copy.default_per_device_workers, compare_contents: bool = False,
+                 delta: bool = False, digest: str = None, dedup: bool = False,
+                 file_list: str = None, sources: Dict[str, str] = None) -> List[copy.CopyResult]:
+    """
+    Copies the files of a plan, reusing the stats it was made with, and records the throughput of the copy for the
+    estimates of later plans.
+
+    :param plan: The plan returned by plan_deploy.
+    :param workers: The number of files copied at the same time.
+    :param per_device_workers: The number of files copied at the same time between the same pair of devices.
+    :param compare_contents: True to also compare the contents of files sync would skip.
+    :param delta: True to only rewrite the blocks that differ when the destination already exists.
+    :param digest: The hashlib algorithm of the digests saved in a manifest at the destination, None to skip hashing.
+    :param dedup: True to copy identical files only once.
+    :param file_list: The full path to the file list configuration file whose catalog caches content digests.
+    :param sources: A {absolute path: local path} of files to read from elsewhere, see copy.copy_files.
+    :return: A CopyResult for every file, in the same order as the plan's files.
+    """
+    start = time.monotonic()
+    results = copy.copy_files(plan.files, plan.destination_directory, workers=workers,
+                              per_device_workers=per_device_workers, sync=plan.sync,
+                              compare_contents=compare_contents, delta=delta, digest=digest, dedup=dedup,
+                              file_list=file_list, prepared=(plan.jobs, plan.results),
+                              sources=sources)
+    transferred = sum(map(lambda x: x.stats.transferred, filter(lambda x: x.stats, results)))
+    record_throughput(plan.destination_directory, transferred, time.monotonic() - start)
+    return results
+
+
+def has_previous_deploy(plan: DeployPlan) -> bool:
+    """
+    Checks if the destination of a plan already holds something dedup or delta copies can reuse, both only cost time
+    when it is empty.
+
+    :param plan: The plan returned by plan_deploy.
+    :return: True if the destination has a manifest with the digests dedup uses, or any of the plan's files.
+    """
+    previous = manifest.load_manifest(plan.destination_directory)
+    if previous is not None and previous.get("algorithm") == copy.dedup_algorithm:
+        return True
+    return any(map(lambda x: os.path.exists(x.destination), plan.jobs))
+
+
+def get_history(path: str = initialization.project_root, file_name: str = history_name) -> str:
+    """
+    Retrieves the path of the file keeping the throughput of previous deploys.
+
+    :param path: The path to the history file.
+    :param file_name: The name of the history file.
+    :return: The history file path.
+    """
+    return str(os.path.join(path, file_name))
+
+
+def load_history(history_path: str = None) -> Dict[str, List[List[float]]]:
+    """
+    Loads the throughput of previous deploys.
+
+    :param history_path: The full path to the history file, defaults to get_history().
+    :return: A {absolute destination directory: [[bytes transferred, seconds], ...]}, oldest run first. Empty if there
+             is no readable history.
+    """
+    try:
+        with open(history_path or get_history(), "r") as history_file:
+            return json.load(history_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_throughput(destination_directory: str, transferred: int, seconds: float, history_path: str = None):
+    """
+    Adds a deploy to the throughput history, runs too small to measure are ignored.
+
+    :param destination_directory: The location the files were copied to.
+    :param transferred: The number of bytes that were actually written.
+    :param seconds: How long the copy took.
+    :param history_path: The full path to the history file, defaults to get_history().
+    """
+    if transferred < history_minimum_bytes or seconds <= 0:
+        return
+    history_path = history_path or get_history()
+    history = load_history(history_path)
+    runs = history.setdefault(os.path.abspath(destination_directory), [])
+    runs.append([transferred, seconds])
+    del runs[:-history_length]
+    try:
+        temp_path = history_path + ".tmp"
+        with open(temp_path, "w") as history_file:
+            json.dump(history, history_file)
+        os.replace(temp_path, history_path)
+    except OSError:
+        # The history only improves estimates.
+        pass
+
+
+def get_throughput(destination_directory: str, history_path: str = None) -> Optional[float]:
+    """
+    Estimates the copy throughput to a destination from previous deploys to it, or to any destination if there were
+    none.
+
+    :param destination_directory: The location the files will be copied to.
+    :param history_path: The full path to the history file, defaults to get_history().
+    :return: The throughput in bytes per second, None if there is no history.
+    """
+    history = load_history(history_path)
+    runs = history.get(os.path.abspath(destination_directory))
+    if not runs:
+        runs = [run for destination_runs in history.values() for run in destination_runs]
+    seconds = sum(map(lambda x: x[1], runs))
+    return sum(map(lambda x: x[0], runs)) / seconds if seconds else None
@@ -0,0 +1,481 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import config_cache
+import copy
+import initialization
+import instrumentation
+import planner
+
+index_name = "index.db"
+objects_directory_name = "objects"
+# The files of a deploy fetched from the repository at the same time, the repository shares are usually remote.
+default_workers = 4
+# A file another process started fetching this long ago is taken as abandoned, e.g. the process was killed.
+abandoned_fetch_seconds = 60 * 60
+size_units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+_schema = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,
+                                    source TEXT NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    mtime INTEGER NOT NULL,
+                                    stored INTEGER NOT NULL,
+                                    last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_by_source ON entries (source);
+CREATE INDEX IF NOT EXISTS entries_by_last_used ON entries (stored, last_used);
+"""
+
+# The fetches running in this process by key, so a deploy waits for a prefetch of the same file instead of fetching
+# it a second time.
+_fetching: Dict[str, concurrent.futures.Future] = {}
+_prefetches: List["Prefetch"] = []
+_lock = threading.Lock()
+
+
+class CacheSettings(NamedTuple):
+    """
+    Where the staging cache keeps its copies and how much room they may take.
+    """
+    directory: str
+    # The number of bytes the copies may take in total.
+    capacity: int
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class Prefetch:
+    """
+    Files being fetched into the staging cache in the background, see prefetch.
+    """
+
+    def __init__(self, threads: List[threading.Thread], cancelled: threading.Event):
+        self._threads = threads
+        self._cancelled = cancelled
+
+    def cancel(self):
+        """
+        Stops the prefetch, the files being fetched are abandoned and nothing more is fetched.
+        """
+        self._cancelled.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits for the prefetch to finish.
+
+        :param timeout: The maximum number of seconds to wait, None to wait until it finishes.
+        :return: True if the prefetch finished.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not self.running
+
+    @property
+    def running(self) -> bool:
+        return any(map(lambda x: x.is_alive(), self._threads))
+
+
+def get_cache(config_file: str = None) -> Optional[CacheSettings]:
+    """
+    Reads the staging cache settings, the cache_directory and cache_capacity options of the CONFIGURATION section.
+
+    :param config_file: The full path to the configuration file, defaults to get_config().
+    :return: The cache settings, or None if cache_directory is blank or missing and there is no cache. Raises a
+             ValueError if cache_capacity is not a size.
+    """
+    if config_file is None:
+        config_file = initialization.get_config()
+    config = config_cache.read_config(config_file)
+    section = initialization.CONFIGURATION_SECTION
+    if not config.has_option(section, "cache_directory") or not config.get(section, "cache_directory").strip():
+        return None
+    capacity = config.get(section, "cache_capacity") if config.has_option(section, "cache_capacity") else ""
+    return CacheSettings(os.path.abspath(os.path.expanduser(config.get(section, "cache_directory").strip())),
+                         parse_size(capacity or initialization.base_paths["cache_capacity"]))
+
+
+def parse_size(value: str) -> int:
+    """
+    Converts a size written with an optional binary unit, e.g. 512M or 20G, to bytes.
+
+    :param value: The size.
+    :return: The number of bytes. Raises a ValueError if the value is not a size.
+    """
+    value = value.strip().upper()
+    if value.endswith("B"):
+        value = value[:-1]
+    unit = value[-1:] if value[-1:] in size_units else ""
+    number = value[:len(value) - len(unit)].strip()
+    try:
+        size = float(number)
+    except ValueError:
+        raise ValueError("Invalid size [%s], expected a number of bytes with an optional K, M, G or T." % value)
+    if size < 0:
+        raise ValueError("Invalid size [%s], it cannot be negative." % value)
+    return int(size * size_units[unit])
+
+
+def lookup(cache: CacheSettings, source: str, size: int, mtime: int) -> Optional[str]:
+    """
+    Finds the cached copy of a file.
+
+    :param cache: The cache settings returned by get_cache.
+    :param source: The file's absolute path in the repository.
+    :param size: The file's size.
+    :param mtime: The file's modification time in nanoseconds.
+    :return: The full path to the copy, or None if the file, at this size and modification time, is not cached.
+    """
+    key = _key(source, size, mtime)
+    path = _object_path(cache, key)
+    try:
+        with _transaction(cache) as connection:
+            row = connection.execute("SELECT 1 FROM entries WHERE key = ? AND stored = 1", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.isfile(path):
+                # Removed behind the cache's back.
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error:
+        # An unusable cache is as good as no cache.
+        return None
+    return path
+
+
+def fetch(cache: CacheSettings, source: str, size: int, mtime: int,
+          update: Callable[[int], object] = None) -> Optional[str]:
+    """
+    Finds the cached copy of a file, copying the file into the cache first if it is not cached yet. The least recently
+    used copies are evicted to make room for it. Waits for a fetch of the same file already running in this process
+    instead of starting another.
+
+    :param cache: The cache settings returned by get_cache.
+    :param source: The file's absolute path in the repository.
+    :param size: The file's size, as stat'ed when the deploy was planned.
+    :param mtime: The file's modification time in nanoseconds, as stat'ed when the deploy was planned.
+    :param update: Called with the number of bytes copied into the cache as the copy progresses.
+    :return: The full path to the copy, or None if the file could not be cached, e.g. it is larger than the cache, it
+             changed since it was stat'ed or it could not be read. The file should be read from the repository then.
+    """
+    key = _key(source, size, mtime)
+    with _lock:
+        future = _fetching.get(key)
+        owner = future is None
+        if owner:
+            future = concurrent.futures.Future()
+            _fetching[key] = future
+    if not owner:
+        return future.result()
+    path = None
+    try:
+        path = lookup(cache, source, size, mtime)
+        if path is None:
+            path = _fetch(cache, key, source, size, mtime, update)
+        return path
+    finally:
+        with _lock:
+            _fetching.pop(key, None)
+        future.set_result(path)
+
+
+def stage(cache: CacheSettings, files: List[Tuple[str, int, int]], workers: int = default_workers,
+          progress: bool = True) -> Dict[str, str]:
+    """
+    Makes sure files are in the cache before a deploy reads them, joining a prefetch of the same files. Only as many
+    files as fit in the cache together are fetched, the others are only staged if they are cached already so a large
+    deploy does not evict its own files.
+
+    :param cache: The cache settings returned by get_cache.
+    :param files: The files in (absolute path, size, modification time in nanoseconds) tuples.
+    :param workers: The number of files fetched at the same time.
+    :param progress: True to show a progress bar.
+    :return: A {absolute path: full path to the copy} of the files that are cached, ready for copy.copy_files.
+    """
+    files = list({x[0]: x for x in files}.values())
+    fetched = _fitting(cache, files)
+
+    # Imported here so commands that never copy start faster.
+    import tqdm
+
+    staged = {}
+    with instrumentation.phase("staging") as counter, \
+            tqdm.tqdm(desc="Staging", total=sum(map(lambda x: x[1], files)), unit="B", unit_scale=True,
+                      disable=not progress) as bar:
+        bar_lock = threading.Lock()
+
+        def update(n: int):
+            with bar_lock:
+                bar.update(n)
+
+        def run(file: Tuple[str, int, int]) -> Optional[str]:
+            copied = 0
+
+            def count(n: int):
+                nonlocal copied
+                copied += n
+                update(n)
+
+            path = fetch(cache, *file, update=count) if file[0] in fetched else lookup(cache, *file)
+            # A cache hit, a file fetched by a prefetch or a file left to the deploy is done all at once.
+            update(max(0, file[1] - copied))
+            return path
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for file, path in zip(files, executor.map(run, files)):
+                if path is not None:
+                    staged[file[0]] = path
+                    counter.add(1, file[1])
+    return staged
+
+
+def stage_plans(cache: CacheSettings, plans: List[planner.DeployPlan], workers: int = default_workers,
+                progress: bool = True) -> Dict[str, str]:
+    """
+    Stages the files deploy plans will copy, files already up to date at every destination are left out.
+
+    :param cache: The cache settings returned by get_cache.
+    :param plans: The plans returned by planner.plan_deploy for the same files.
+    :param workers: The number of files fetched at the same time.
+    :param progress: True to show a progress bar.
+    :return: A {absolute path: full path to the copy} of the files that are cached, see stage.
+    """
+    files = []
+    for plan in plans:
+        for job in plan.jobs:
+            if not plan.sync or not copy.is_unchanged(job):
+                files.append((job.source, job.size, job.source_mtime))
+    return stage(cache, files, workers, progress)
+
+
+def prefetch(cache: CacheSettings, paths: List[str], workers: int = default_workers) -> Prefetch:
+    """
+    Starts fetching files into the cache in the background, e.g. while the user still has to confirm a deploy. The
+    deploy's stage then only waits for what is not fetched yet. Like stage, only as many files as fit in the cache
+    together are fetched.
+
+    :param cache: The cache settings returned by get_cache.
+    :param paths: The absolute paths of the files, e.g. from build.build_paths.
+    :param workers: The number of files fetched at the same time.
+    :return: The running prefetch.
+    """
+    paths = list(dict.fromkeys(paths))
+    pending = queue.Queue()
+    for path in paths:
+        pending.put(path)
+    stats = {}
+    selected = queue.Queue()
+    cancelled = threading.Event()
+
+    def cancellable(n: int):
+        if cancelled.is_set():
+            raise _Cancelled()
+
+    def select():
+        # The files are stat'ed first so the ones that fit are chosen in build order, the same ones stage fetches.
+        files = [(x, stats[x].st_size, stats[x].st_mtime_ns) for x in paths if x in stats]
+        fitting = _fitting(cache, files)
+        for file in files:
+            if file[0] in fitting:
+                selected.put(file)
+
+    def run():
+        while not cancelled.is_set():
+            try:
+                path = pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                stats[path] = os.stat(path)
+            except os.error:
+                # The deploy reports the files it cannot read.
+                pass
+        barrier.wait()
+        while not cancelled.is_set():
+            try:
+                file = selected.get_nowait()
+            except queue.Empty:
+                return
+            fetch(cache, *file, update=cancellable)
+
+    # Daemon threads so a prefetch never holds the program open, an abandoned fetch is cleaned up by later ones.
+    threads = [threading.Thread(target=run, name="staging-prefetch", daemon=True)
+               for _ in range(max(1, min(workers, len(paths))))]
+    barrier = threading.Barrier(len(threads), select)
+    handle = Prefetch(threads, cancelled)
+    with _lock:
+        _prefetches[:] = [x for x in _prefetches if x.running] + [handle]
+    for thread in threads:
+        thread.start()
+    return handle
+
+
+def cancel_prefetches():
+    """
+    Cancels every prefetch started by this process.
+    """
+    with _lock:
+        prefetches = list(_prefetches)
+        _prefetches.clear()
+    for handle in prefetches:
+        handle.cancel()
+
+
+def evict(cache: CacheSettings, size: int) -> int:
+    """
+    Removes the least recently used copies until the cache has room for a number of bytes.
+
+    :param cache: The cache settings returned by get_cache.
+    :param size: The number of bytes to make room for, 0 to only shrink the cache to its capacity.
+    :return: The number of bytes freed.
+    """
+    with _transaction(cache) as connection:
+        victims = _evict(connection, cache, size)
+    for key in victims:
+        _remove_object(cache, key)
+    return sum(victims.values())
+
+
+def clear(cache: CacheSettings) -> int:
+    """
+    Removes every copy, fetches running in other processes are abandoned.
+
+    :param cache: The cache settings returned by get_cache.
+    :return: The number of bytes freed.
+    """
+    with _transaction(cache) as connection:
+        victims = dict(connection.execute("SELECT key, size FROM entries").fetchall())
+        connection.execute("DELETE FROM entries")
+    for key in victims:
+        _remove_object(cache, key)
+    return sum(victims.values())
+
+
+def _fitting(cache: CacheSettings, files: List[Tuple[str, int, int]]) -> Set[str]:
+    # The paths of the files that fit in the cache together, in the order given, so fetching them evicts none of the
+    # others.
+    room = cache.capacity
+    fitting = set()
+    for file in files:
+        if file[1] <= room:
+            fitting.add(file[0])
+            room -= file[1]
+    return fitting
+
+
+def _fetch(cache: CacheSettings, key: str, source: str, size: int, mtime: int,
+           update: Optional[Callable[[int], object]]) -> Optional[str]:
+    if size > cache.capacity:
+        return None
+    path = _object_path(cache, key)
+    try:
+        with _transaction(cache) as connection:
+            row = connection.execute("SELECT last_used FROM entries WHERE key = ? AND stored = 0", (key,)).fetchone()
+            if row is not None and row[0] >= time.time() - abandoned_fetch_seconds:
+                # Another process is fetching it, the deploy reads it from the repository rather than wait.
+                return None
+            victims = _evict(connection, cache, size)
+            used = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if used + size > cache.capacity:
+                # The rest of the room is taken by files other processes are fetching right now.
+                return None
+            # Reserve the room, the copy counts against the capacity while it is being made.
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, 0, ?)",
+                               (key, source, size, mtime, time.time()))
+    except sqlite3.Error:
+        return None
+    for victim in victims:
+        _remove_object(cache, victim)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        copy.copy_file(source, path, update)
+        stat = os.stat(path)
+        if stat.st_size != size or abs(stat.st_mtime_ns - mtime) > copy.sync_mtime_tolerance_ns:
+            # Changed since the deploy stat'ed it, the deploy reads it from the repository and reports that.
+            raise os.error("%s changed since it was stat'ed." % source)
+        with _transaction(cache) as connection:
+            if connection.execute("UPDATE entries SET stored = 1, last_used = ? WHERE key = ?",
+                                  (time.time(), key)).rowcount == 0:
+                # Evicted as abandoned, or the cache was cleared, while it was being copied.
+                raise os.error("%s was evicted while it was fetched." % source)
+            # Older versions of the same file are not deployed again.
+            stale = [x[0] for x in connection.execute("SELECT key FROM entries WHERE source = ? AND key != ? "
+                                                      "AND stored = 1", (source, key)).fetchall()]
+            connection.executemany("DELETE FROM entries WHERE key = ?", ((x,) for x in stale))
+    except (os.error, sqlite3.Error, _Cancelled):
+        try:
+            with _transaction(cache) as connection:
+                connection.execute("DELETE FROM entries WHERE key = ? AND stored = 0", (key,))
+        except sqlite3.Error:
+            # Reclaimed once it counts as abandoned.
+            pass
+        _remove_object(cache, key)
+        return None
+    for victim in stale:
+        _remove_object(cache, victim)
+    return path
+
+
+def _evict(connection: sqlite3.Connection, cache: CacheSettings, size: int) -> Dict[str, int]:
+    # Copies being fetched are only evicted once they count as abandoned, stored copies least recently used first.
+    used = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    victims = {}
+    rows = connection.execute("SELECT key, size FROM entries WHERE stored = 1 OR last_used < ? "
+                              "ORDER BY stored, last_used", (time.time() - abandoned_fetch_seconds,))
+    for key, victim_size in rows.fetchall():
+        if used + size <= cache.capacity:
+            break
+        victims[key] = victim_size
+        used -= victim_size
+    connection.executemany("DELETE FROM entries WHERE key = ?", ((x,) for x in victims))
+    return victims
+
+
+@contextlib.contextmanager
+def _transaction(cache: CacheSettings) -> Iterator[sqlite3.Connection]:
+    os.makedirs(cache.directory, exist_ok=True)
+    # Several processes may deploy from the same cache, the index serializes them.
+    connection = sqlite3.connect(os.path.join(cache.directory, index_name), timeout=30, isolation_level=None)
+    try:
+        connection.executescript(_schema)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def _remove_object(cache: CacheSettings, key: str):
+    path = _object_path(cache, key)
+    # The copy, and what an interrupted copy left behind.
+    for leftover in [path, path + copy.partial_suffix, path + copy.partial_suffix + copy.checkpoint_suffix]:
+        try:
+            os.remove(leftover)
+        except FileNotFoundError:
+            pass
+        except os.error:
+            # Removed by the next eviction of the same key.
+            pass
+
+
+def _object_path(cache: CacheSettings, key: str) -> str:
+    return os.path.join(cache.directory, objects_directory_name, key[:2], key)
+
+
+def _key(source: str, size: int, mtime: int) -> str:
+    return hashlib.sha256(("%s\0%d\0%d" % (source, size, mtime)).encode("utf-8")).hexdigest()
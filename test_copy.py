@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import copy
+
+
+class CopyFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.destination = os.path.join(self.root, "destination")
+        os.makedirs(self.destination)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path: str, data: bytes, mtime_ns: int = None) -> str:
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    def test_sync_keeps_last_file_with_same_destination(self):
+        # Same size and modification time, a sync must not mistake the second file for the copy of the first.
+        mtime = 1600000000 * 10 ** 9
+        first = self._write("dev1/tools/install", b"A" * 4096, mtime)
+        last = self._write("dev2/tools/sub/install", b"B" * 4096, mtime)
+        for _ in range(2):
+            results = copy.copy_files([("tools", first), ("tools", last)], self.destination, workers=2, sync=True)
+            self.assertTrue(all(x.error is None for x in results))
+            with open(os.path.join(self.destination, "tools", "install"), "rb") as f:
+                self.assertEqual(f.read(), b"B" * 4096)
+
+    def test_delta_keeps_holes_of_sparse_source(self):
+        size = 8 * copy.delta_block_size
+        source = os.path.join(self.root, "dev1", "firmware", "sparse.img")
+        os.makedirs(os.path.dirname(source))
+        with open(source, "wb") as f:
+            f.write(b"A" * copy.delta_block_size)
+            f.seek(size - copy.delta_block_size)
+            f.write(b"B" * copy.delta_block_size)
+        if copy.allocated_size(os.stat(source)) >= size:
+            self.skipTest("The filesystem does not support sparse files.")
+        # A fully allocated old copy, with data where the source has holes.
+        old = self._write("destination/firmware/sparse.img", b"C" * size)
+
+        result = copy.copy_files(("firmware", source), self.destination, delta=True)[0]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.stats.strategy, "delta")
+        self.assertEqual(result.stats.holes, size - 2 * copy.delta_block_size)
+        with open(source, "rb") as f, open(old, "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertLess(copy.allocated_size(os.stat(old)), size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,57 @@
+import collections
+import math
 import os
 import random
 from pathlib import Path
+from typing import Callable, List, NamedTuple, OrderedDict, Tuple
+
+size_distributions = ["fixed", "uniform", "lognormal"]
+# How much of a sparse file is data, the rest is a hole.
+sparse_data_ratio = 0.125
+write_size = 1024 * 1024
+
+
+class RepositorySpec(NamedTuple):
+    """
+    The shape of a synthetic repository made by create_synthetic_repository.
+    """
+    # The number of base directories, the same as file-picker-dev1, file-picker-dev2, ...
+    bases: int = 3
+    # The number of directory levels below each base directory.
+    depth: int = 3
+    # The number of subdirectories of every directory above the deepest level.
+    fan_out: int = 4
+    # The number of files, duplicates included.
+    files: int = 200
+    # One of size_distributions.
+    size_distribution: str = "lognormal"
+    # The mean file size in bytes.
+    mean_size: int = 256 * 1024
+    # The share of the files written as sparse files.
+    sparse_ratio: float = 0.0
+    # The share of the files that are identical copies, same name and contents, of another file in another directory.
+    duplicate_ratio: float = 0.1
+    # The category directory names, the first directory level of each base cycles through them.
+    categories: Tuple[str, ...] = ("firmware", "network", "volume", "iso_images", "configs", "deltas", "tools")
+    # The seed of the layout, the same seed always makes the same directories, names and sizes.
+    seed: int = 0
+
+
+class SyntheticRepository(NamedTuple):
+    """
+    A synthetic repository made by create_synthetic_repository.
+    """
+    # The absolute paths of the base directories.
+    bases: List[str]
+    # The number of directories, base directories included.
+    directories: int
+    # An ordered {category: [file names]} of the files below a category directory, in creation order.
+    categories: OrderedDict[str, List[str]]
+    files: int
+    # The sum of the file sizes.
+    size: int
+    # The number of bytes of data, holes excluded.
+    data: int
 
 
 def create_test_storage_environment():
@@ -25,3 +76,128 @@ def create_test_storage_environment():
             f.write(os.urandom(16 * 1024 * 1024))  # 16 MB fake files.
             # f.write(os.urandom(128 * 1024)) # 128 KB fake files.
             f.close()
+
+
+def create_synthetic_repository(root: str, spec: RepositorySpec = RepositorySpec()) -> SyntheticRepository:
+    """
+    Creates a repository of random files, laid out like the build repositories the file list is crawled from.
+
+    Every base directory holds one directory per category, cycling through the categories if there are more
+    subdirectories than categories, and "other" directories once every category has one. Below them the directories
+    are named d0, d1, ... The files are spread over all the directories at random.
+
+    :param root: The directory the base directories are created in, it is created if necessary and should not hold
+                 a previous repository.
+    :param spec: The shape of the repository.
+    :return: What was created. Raises a ValueError if the spec is invalid.
+    """
+    if spec.size_distribution not in size_distributions:
+        raise ValueError("The size distribution [%s] is not one of %s!" % (spec.size_distribution,
+                                                                          ", ".join(size_distributions)))
+    if spec.bases < 1 or spec.depth < 1 or spec.fan_out < 1 or spec.files < 0 or spec.mean_size < 0:
+        raise ValueError("The repository needs at least one base directory, level and subdirectory!")
+    generator = random.Random(spec.seed)
+
+    # (absolute path, category or None) of every directory.
+    directories = []
+    bases = []
+    for base in range(spec.bases):
+        base_path = os.path.join(root, "file-picker-dev%d" % (base + 1))
+        bases.append(base_path)
+        directories.append((base_path, None))
+        level = [(base_path, None)]
+        for depth in range(spec.depth):
+            next_level = []
+            for parent, category in level:
+                for child in range(spec.fan_out):
+                    if depth > 0:
+                        name = "d%d" % child
+                    elif child < len(spec.categories):
+                        name, category = spec.categories[child], spec.categories[child]
+                    else:
+                        name, category = "other%d" % child, None
+                    next_level.append((os.path.join(parent, name), category))
+            directories.extend(next_level)
+            level = next_level
+    for path, _ in directories:
+        os.makedirs(path, exist_ok=True)
+
+    categories = collections.OrderedDict((x, []) for x in spec.categories)
+    # (path, size, sparse) of the files duplicates can copy.
+    originals = []
+    size = 0
+    data = 0
+    files = 0
+    for position in range(spec.files):
+        index = generator.randrange(len(directories))
+        if originals and generator.random() < spec.duplicate_ratio:
+            source, file_size, sparse = originals[generator.randrange(len(originals))]
+            if directories[index][0] == os.path.dirname(source):
+                # A copy in the same directory would overwrite the original, use the next directory instead.
+                index = (index + 1) % len(directories)
+            path = os.path.join(directories[index][0], os.path.basename(source))
+            if len(directories) == 1 or os.path.exists(path):
+                continue
+            source_file = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                data += _write_file(path, file_size, sparse,
+                                    lambda offset, length: _read_at(source_file, offset, length))
+            finally:
+                os.close(source_file)
+        else:
+            file_size = _file_size(generator, spec)
+            sparse = generator.random() < spec.sparse_ratio
+            path = os.path.join(directories[index][0], "file_%06d.bin" % position)
+            data += _write_file(path, file_size, sparse, lambda offset, length: os.urandom(length))
+            originals.append((path, file_size, sparse))
+        files += 1
+        size += file_size
+        category = directories[index][1]
+        if category is not None and os.path.basename(path) not in categories[category]:
+            categories[category].append(os.path.basename(path))
+    return SyntheticRepository(bases, len(directories), categories, files, size, data)
+
+
+def _file_size(generator: random.Random, spec: RepositorySpec) -> int:
+    if spec.size_distribution == "fixed":
+        return spec.mean_size
+    elif spec.size_distribution == "uniform":
+        return generator.randint(0, 2 * spec.mean_size)
+    # Most files small and a long tail of big ones, like builds of configs next to disk images. A sigma of 1 with
+    # this mu keeps the mean at mean_size.
+    if spec.mean_size == 0:
+        return 0
+    return int(generator.lognormvariate(math.log(spec.mean_size) - 0.5, 1.0))
+
+
+def _write_file(path: str, size: int, sparse: bool, read: Callable[[int, int], bytes]) -> int:
+    # A sparse file is data at its start and end with a hole in between. Returns the number of bytes of data written.
+    if sparse:
+        head = int(size * sparse_data_ratio / 2)
+        extents = [(0, head), (size - head, head)]
+    else:
+        extents = [(0, size)]
+    written = 0
+    file_out = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                chunk = read(offset, min(write_size, end - offset))
+                # Not pwrite, Windows does not have it.
+                os.lseek(file_out, offset, os.SEEK_SET)
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(file_out, view):]
+                offset += len(chunk)
+                written += len(chunk)
+        os.ftruncate(file_out, size)
+    finally:
+        os.close(file_out)
+    return written
+
+
+def _read_at(file_descriptor: int, offset: int, length: int) -> bytes:
+    # Not pread, Windows does not have it.
+    os.lseek(file_descriptor, offset, os.SEEK_SET)
+    return os.read(file_descriptor, length)
@@ -0,0 +1,238 @@
+import collections
+import concurrent.futures
+import os
+from typing import List, NamedTuple, Optional, OrderedDict, Tuple
+
+import build
+import copy
+import instrumentation
+import manifest
+import planner
+
+added_status = "added"
+removed_status = "removed"
+changed_status = "changed"
+unchanged_status = "unchanged"
+
+
+class FileDiff(NamedTuple):
+    """
+    How a single file of a deployment differs between two builds.
+    """
+    # One of added_status, removed_status, changed_status or unchanged_status.
+    status: str
+    section: str
+    # The file's path in a deployment, <section>/<file name> with forward slashes.
+    name: str
+    # The file's absolute path in the repository for each build, None if the build does not have the file.
+    old_source: Optional[str]
+    new_source: Optional[str]
+    # The file's size in the new build, or in the old build if it was removed. 0 if it could not be stat'ed.
+    size: int
+
+
+class BuildDiff(NamedTuple):
+    """
+    Everything that changes in a deployment going from one build to another.
+    """
+    old_build: str
+    new_build: str
+    # The files of the new build in build order, then the files only the old build has.
+    files: List[FileDiff]
+    # The {option: file names} of each build that could not be found, see build.build_paths.
+    old_skipped: OrderedDict[str, str]
+    new_skipped: OrderedDict[str, str]
+
+    def of(self, status: str) -> List[FileDiff]:
+        return [x for x in self.files if x.status == status]
+
+
+class RemovalResult(NamedTuple):
+    """
+    The outcome of removing a single file the new build no longer has from a deployment.
+    """
+    # The file's absolute path in the deployment.
+    path: str
+    # Why the file could not be removed, None if it was removed or was already gone.
+    error: Optional[str]
+
+
+class UpgradeResult(NamedTuple):
+    """
+    The outcome of upgrading a deployment.
+    """
+    # A CopyResult for every added or changed file.
+    copies: List[copy.CopyResult]
+    removals: List[RemovalResult]
+
+
+@instrumentation.measured("diff", lambda x: (len(x.files), 0))
+def diff_builds(old_build: str, new_build: str, config_file: str = None, compare_contents: bool = True,
+                file_list: str = None, destination_directory: str = None,
+                workers: int = planner.default_stat_workers) -> BuildDiff:
+    """
+    Compares the files two builds deploy, both resolved through the artifact catalog like build_paths does.
+
+    A file both builds take from the same path is unchanged. A file taken from different paths is changed if the
+    sizes differ, otherwise the contents are compared, or the modification times if compare_contents is False. With
+    a deployment of the old build to compare against, a file that is unchanged between the builds is still changed if
+    the deployed copy does not have the size and modification time of the new build's file, e.g. because the artifact
+    was rebuilt in place since it was deployed.
+
+    :param old_build: The build the deployment holds now.
+    :param new_build: The build the deployment should hold.
+    :param config_file: The full path to the configuration file holding the builds, defaults to get_config().
+    :param compare_contents: True to compare the contents of files of the same size taken from different paths.
+    :param file_list: The full path to the file list configuration file whose catalog caches content digests, or None.
+    :param destination_directory: The location holding a deployment of the old build, None to only compare the
+                                  builds.
+    :param workers: The number of files stat'ed at the same time.
+    :return: The differences. May raise a configparser.NoSectionError if a build does not exist.
+    """
+    old_skipped, old_files = build.build_paths(old_build, config_file)
+    new_skipped, new_files = build.build_paths(new_build, config_file)
+    # Several files with the same name end up at the same place in a deployment, the last one copied stays.
+    old_names = collections.OrderedDict((_deployed_name(x), x) for x in old_files)
+    new_names = collections.OrderedDict((_deployed_name(x), x) for x in new_files)
+
+    def stat(path: str) -> Optional[os.stat_result]:
+        try:
+            return os.stat(path)
+        except os.error:
+            return None
+
+    paths = list(collections.OrderedDict((x[1], None) for x in old_files + new_files))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        stats = dict(zip(paths, executor.map(stat, paths)))
+
+    # (name, old path, new path) of the files whose contents decide.
+    undecided = []
+    statuses = {}
+    for name, (section, new_source) in new_names.items():
+        if name not in old_names:
+            statuses[name] = added_status
+            continue
+        old_source = old_names[name][1]
+        old_stat, new_stat = stats[old_source], stats[new_source]
+        if old_source == new_source:
+            statuses[name] = unchanged_status
+        elif old_stat is None or new_stat is None or old_stat.st_size != new_stat.st_size:
+            statuses[name] = changed_status
+        elif compare_contents:
+            undecided.append((name, old_source, new_source))
+        else:
+            same_time = abs(old_stat.st_mtime_ns - new_stat.st_mtime_ns) <= copy.sync_mtime_tolerance_ns
+            statuses[name] = unchanged_status if same_time else changed_status
+    if undecided:
+        hashed = [(path, stats[path].st_size, stats[path].st_mtime_ns)
+                  for _, old_source, new_source in undecided for path in (old_source, new_source)]
+        digests = copy.file_digests(hashed, file_list)
+        for name, old_source, new_source in undecided:
+            same = digests.get(old_source) is not None and digests.get(old_source) == digests.get(new_source)
+            statuses[name] = unchanged_status if same else changed_status
+    if destination_directory is not None:
+        unchanged = [x for x in new_names if statuses[x] == unchanged_status]
+        deployed = [os.path.join(destination_directory, *x.split("/")) for x in unchanged]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for name, deployed_stat in zip(unchanged, executor.map(stat, deployed)):
+                # The same test a sync makes, copies keep the modification time of their source.
+                source_stat = stats[new_names[name][1]]
+                if deployed_stat is None or source_stat is None or deployed_stat.st_size != source_stat.st_size or \
+                        abs(deployed_stat.st_mtime_ns - source_stat.st_mtime_ns) > copy.sync_mtime_tolerance_ns:
+                    statuses[name] = changed_status
+
+    files = []
+    for name, (section, new_source) in new_names.items():
+        old_source = old_names[name][1] if name in old_names else None
+        files.append(FileDiff(statuses[name], section, name, old_source, new_source, _size(stats[new_source])))
+    for name, (section, old_source) in old_names.items():
+        if name not in new_names:
+            files.append(FileDiff(removed_status, section, name, old_source, None, _size(stats[old_source])))
+    return BuildDiff(old_build, new_build, files, old_skipped, new_skipped)
+
+
+def upgrade_files(diff: BuildDiff) -> List[Tuple[str, str]]:
+    """
+    Retrieves the files an upgrade copies.
+
+    :param diff: The differences returned by diff_builds.
+    :return: The added and changed files in (section name, absolute path) tuple pair, ready for planner.plan_deploy.
+    """
+    return [(x.section, x.new_source) for x in diff.files if x.status in [added_status, changed_status]]
+
+
+def upgrade(diff: BuildDiff, destination_directory: str, plan: planner.DeployPlan = None,
+            workers: int = copy.default_workers, per_device_workers: int = copy.default_per_device_workers,
+            file_list: str = None) -> UpgradeResult:
+    """
+    Turns a deployment of the old build into one of the new build: copies the added and changed files, rewriting only
+    the blocks that differ in changed ones, then removes the files the new build no longer has. Unchanged files are
+    not touched. A manifest at the destination is brought up to date with the new build.
+
+    :param diff: The differences returned by diff_builds, given the destination to find what changed since the old
+                 build was deployed.
+    :param destination_directory: The location holding the deployment of the old build.
+    :param plan: The plan returned by planner.plan_deploy for upgrade_files(diff) with sync False, None to plan the
+                 copy now.
+    :param workers: The number of files copied at the same time.
+    :param per_device_workers: The number of files copied at the same time between the same pair of devices.
+    :param file_list: The full path to the file list configuration file, see planner.execute_plan.
+    :return: The outcome of every copy and removal.
+    """
+    if plan is None:
+        # The diff already decided what to copy, a sync would skip a changed file whose deployed copy has the same
+        # size and modification time.
+        plan = planner.plan_deploy(upgrade_files(diff), destination_directory, sync=False, copy_workers=workers)
+    # A delta copy of a file an interrupted upgrade already copied rewrites nothing.
+    copies = planner.execute_plan(plan, workers=workers, per_device_workers=per_device_workers, delta=True,
+                                  file_list=file_list)
+    removals = []
+    sections = set()
+    for file_diff in diff.of(removed_status):
+        path = os.path.join(destination_directory, *file_diff.name.split("/"))
+        try:
+            os.remove(path)
+            removals.append(RemovalResult(path, None))
+        except FileNotFoundError:
+            removals.append(RemovalResult(path, None))
+        except os.error as e:
+            removals.append(RemovalResult(path, str(e)))
+        sections.add(os.path.dirname(path))
+    for section in sections:
+        try:
+            # Only succeeds if nothing is left in it.
+            os.rmdir(section)
+        except os.error:
+            pass
+
+    previous = manifest.load_manifest(destination_directory)
+    if previous is not None:
+        _update_manifest(diff, destination_directory, previous["algorithm"], copies, workers)
+    return UpgradeResult(copies, removals)
+
+
+def _update_manifest(diff: BuildDiff, destination_directory: str, algorithm: str, copies: List[copy.CopyResult],
+                     workers: int):
+    # Unchanged files keep the digests the manifest already has, the copied ones are hashed again.
+    failed = set(map(lambda x: x.destination, filter(lambda x: x.error, copies)))
+    entries = []
+    for file_diff in diff.files:
+        if file_diff.status == removed_status:
+            continue
+        path = os.path.join(destination_directory, *file_diff.name.split("/"))
+        try:
+            size = os.stat(path).st_size
+        except os.error:
+            continue
+        if path not in failed:
+            entries.append((path, size, None))
+    # Every file of the new build is listed, the ones it no longer has must not be kept.
+    manifest.write_manifest(destination_directory, algorithm, entries, workers, merge=False)
+
+
+def _deployed_name(entry: Tuple[str, str]) -> str:
+    return entry[0] + "/" + os.path.split(entry[1])[1]
+
+
+def _size(stat: Optional[os.stat_result]) -> int:
+    return 0 if stat is None else stat.st_size
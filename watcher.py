@@ -0,0 +1,313 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import initialization
+
+# How long to wait for a burst of events (e.g. a whole build being copied in) to settle before updating the index.
+default_settle_time = 1.0
+# A burst that never settles, e.g. a long running copy into the repository, still updates the index this often.
+max_settle_time = 10.0
+# Network file systems do not report changes made by other hosts, directories on them are checked this often.
+default_poll_interval = 30.0
+network_file_systems = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "9p", "ceph", "glusterfs",
+                        "fuse.sshfs", "fuse.glusterfs", "fuse.s3fs", "davfs", "lustre", "gpfs"}
+
+# From sys/inotify.h.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+_watch_mask = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+               IN_DONT_FOLLOW)
+_event_header = struct.Struct("iIII")
+
+
+class WatchUpdate(NamedTuple):
+    """
+    A single update of the file list made by watch.
+    """
+    # The number of directories in the directory index after the update.
+    directories: int
+    # The number of directories whose changes triggered the update, None if it came from polling.
+    changed: Optional[int]
+    # The number of seconds spent updating the file list, the artifact catalog and the directory index.
+    seconds: float
+
+
+def watch(path: str = initialization.project_root, file_name: str = initialization.file_list_config_name,
+          on_update: Callable[[WatchUpdate], object] = None, stop: threading.Event = None,
+          settle_time: float = default_settle_time, poll_interval: float = default_poll_interval,
+          poll_only: bool = False, workers: int = initialization.default_crawl_workers):
+    """
+    Keeps the file list, its artifact catalog and its directory index up to date until stopped.
+
+    The file list is brought up to date with an incremental crawl first. On Linux, every directory below the base
+    directories is then watched with inotify and only the directories that report a change are listed again. Base
+    directories on network file systems, or every base directory when inotify is unavailable, are checked with an
+    incremental crawl every poll_interval seconds instead.
+
+    Every update only rewrites the catalog and directory index rows of the directories that changed, lookups are
+    answered from the catalog. The file list itself is rewritten once watching stops.
+
+    :param path: The location of the configuration file.
+    :param file_name: The name of the configuration file.
+    :param on_update: Called with a WatchUpdate every time the file list is updated.
+    :param stop: Watching stops once this is set, None to watch until interrupted.
+    :param settle_time: The number of seconds without events to wait for before updating the file list.
+    :param poll_interval: The number of seconds between two checks of the polled base directories.
+    :param poll_only: True to poll every base directory, even where inotify would work.
+    :param workers: The maximum number of directories listed at the same time.
+    """
+    if stop is None:
+        stop = threading.Event()
+    initialization.crawl_system(path, file_name, workers, incremental=True)
+    config, tops = initialization.get_crawl_config(path, file_name)
+    rules = initialization.get_crawl_rules(config)
+    index = initialization.load_directory_index(initialization.get_directory_index(path, file_name))
+    notifier = None
+    if not poll_only:
+        try:
+            notifier = _Inotify()
+        except OSError:
+            # Not on Linux, or out of inotify instances.
+            notifier = None
+    watched_tops = [] if notifier is None else [x for x in tops if not is_network_file_system(x)]
+    polled_tops = [x for x in tops if x not in watched_tops]
+
+    # The directory index the catalog matches. Index entries are replaced, never changed, so a shallow copy is enough.
+    written = dict(index)
+    # True once the catalog holds changes the file list does not.
+    stale_file_list = False
+
+    def write_all():
+        nonlocal written, stale_file_list
+        # write_artifacts fills the configuration in, start from a fresh one every time. New categories are picked up
+        # as well, but changed crawl rules only apply once watching starts over.
+        fresh_config, _ = initialization.get_crawl_config(path, file_name)
+        initialization.write_artifacts(path, file_name, fresh_config,
+                                       initialization.listing_from_index(tops, index, rules), index)
+        written = dict(index)
+        stale_file_list = False
+
+    def update(changed: Optional[int]):
+        nonlocal written, stale_file_list
+        start = time.monotonic()
+        # Only the rows of the directories that changed are rewritten, the whole file list only once watching stops.
+        if initialization.update_artifacts(path, file_name, written, index, rules):
+            written = dict(index)
+            stale_file_list = True
+        else:
+            # The file list was edited, or the catalog is missing.
+            write_all()
+        if on_update is not None:
+            on_update(WatchUpdate(len(index), changed, time.monotonic() - start))
+
+    def watch_all():
+        for directory in list(index):
+            if any(_is_below(directory, top) for top in watched_tops):
+                notifier.add(directory)
+
+    try:
+        if notifier is not None:
+            watch_all()
+            # Catch what changed between the crawl and the watches being in place.
+            if initialization.poll_directories(watched_tops, index, workers, rules):
+                watch_all()
+                update(None)
+        next_poll = time.monotonic() + poll_interval
+        dirty = set()
+        dirty_since = None
+        overflow = False
+        while not stop.is_set():
+            timeout = max(0.0, next_poll - time.monotonic())
+            if dirty or overflow:
+                timeout = min(timeout, settle_time)
+            # Wake up regularly to notice stop.
+            timeout = min(timeout, 1.0)
+            if notifier is not None:
+                events = notifier.wait(timeout)
+            else:
+                stop.wait(timeout)
+                events = []
+            if events is None:
+                # The kernel dropped events, only checking every watched directory can tell what changed.
+                overflow = True
+                continue
+            if events and dirty_since is None:
+                dirty_since = time.monotonic()
+            for directory, mask, _ in events:
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    # The parent reports the directory as gone, or moved to where it will be watched again.
+                    notifier.forget(directory)
+                    if directory in watched_tops:
+                        dirty.add(directory)
+                else:
+                    dirty.add(directory)
+            if events and time.monotonic() - dirty_since < max_settle_time:
+                # Wait for the burst to settle.
+                continue
+
+            if overflow:
+                changed = None
+                modified = initialization.poll_directories(watched_tops, index, workers, rules)
+                watch_all()
+            elif dirty:
+                changed = len(dirty)
+                modified = initialization.refresh_directories(list(dirty), index, notifier.add, tops, rules)
+            else:
+                changed = None
+                modified = False
+            if overflow or dirty:
+                notifier.prune(index)
+                overflow = False
+                dirty.clear()
+                dirty_since = None
+                if modified:
+                    update(changed)
+
+            if time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + poll_interval
+                modified = False
+                if polled_tops:
+                    modified = initialization.poll_directories(polled_tops, index, workers, rules)
+                if notifier is not None:
+                    # A watched base directory that was deleted may have come back.
+                    missing = [x for x in watched_tops if x not in index]
+                    if missing:
+                        modified |= initialization.refresh_directories(missing, index, notifier.add, tops, rules)
+                if modified:
+                    update(None)
+    finally:
+        if notifier is not None:
+            notifier.close()
+        if stale_file_list:
+            write_all()
+
+
+def is_network_file_system(path: str) -> bool:
+    """
+    Checks if a path is on a network file system, where inotify does not report changes made by other hosts.
+
+    :param path: The absolute path to check.
+    :return: True if the path's mount is of a known network file system type. Always False where the mounts cannot be
+             read, i.e. anywhere but Linux.
+    """
+    try:
+        with open("/proc/self/mounts", "r") as mounts:
+            entries = [line.split() for line in mounts]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best = ""
+    file_system = None
+    for entry in entries:
+        if len(entry) < 3:
+            continue
+        # Spaces and other special characters in mount points are octal escaped.
+        mount_point = entry[1].encode().decode("unicode_escape")
+        if _is_below(path, mount_point) and len(mount_point) >= len(best):
+            best, file_system = mount_point, entry[2]
+    return file_system in network_file_systems
+
+
+def _is_below(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class _Inotify:
+    """
+    A minimal inotify binding, only watching directories for entries being added, removed or renamed.
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux.")
+        # The interpreter is linked against libc, looking it up by name would need ctypes.util, which is slow to import.
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._libc.inotify_init1.argtypes = [ctypes.c_int]
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        # IN_NONBLOCK and IN_CLOEXEC share the values of O_NONBLOCK and O_CLOEXEC.
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._directories: Dict[int, str] = {}
+        self._watches: Dict[str, int] = {}
+
+    def add(self, directory: str):
+        if directory in self._watches:
+            return
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _watch_mask)
+        if descriptor < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                # The standard output holds the watch command's JSON result.
+                print("Out of inotify watches, raise fs.inotify.max_user_watches to watch %s!" % directory,
+                      file=sys.stderr)
+            # A directory that is already gone again is dropped from the index by its parent's event.
+            return
+        # Watches follow the directory, not its path. A directory below a moved one is still watched under its old
+        # path, which the watch now leaves for the new one.
+        previous = self._directories.get(descriptor)
+        if previous is not None:
+            self._watches.pop(previous, None)
+        self._directories[descriptor] = directory
+        self._watches[directory] = descriptor
+
+    def forget(self, directory: str):
+        descriptor = self._watches.pop(directory, None)
+        if descriptor is not None and self._directories.get(descriptor) == directory:
+            del self._directories[descriptor]
+            # Fails harmlessly if the kernel already removed the watch.
+            self._libc.inotify_rm_watch(self._fd, descriptor)
+
+    def prune(self, index: Dict[str, list]):
+        # Directories dropped from the index are either gone or moved outside of the watched trees.
+        for directory in [x for x in self._watches if x not in index]:
+            self.forget(directory)
+
+    def wait(self, timeout: float) -> Optional[List[Tuple[str, int, str]]]:
+        """
+        Waits for events.
+
+        :param timeout: The maximum number of seconds to wait.
+        :return: The (watched directory, event mask, entry name) of every event, empty if none came in time, None if
+                 the kernel's event queue overflowed and events were lost.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        events = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory = self._directories.get(descriptor)
+                if directory is not None:
+                    events.append((directory, mask, name))
+        return None if overflow else events
+
+    def close(self):
+        os.close(self._fd)